@@ -0,0 +1,205 @@
+import asyncio
+import functools
+import math
+import os
+import time
+from collections import deque
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Deque, Dict, Iterable, List
+
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+
+from app.metrics import Counter, Gauge, Histogram, current_request
+from app.profiling import profiled
+
+AUDIO_EXTENSIONS = ("mp3", "m4a")
+
+ADMISSION_IN_FLIGHT = Gauge(
+    "chatpdf_admission_in_flight", "Requests admitted and running, per pool.", ("pool",))
+ADMISSION_QUEUED = Gauge(
+    "chatpdf_admission_queued", "Requests waiting for a slot, per pool.", ("pool",))
+ADMISSION_WAIT = Histogram(
+    "chatpdf_admission_wait_seconds", "Time requests waited for a slot, per pool.", ("pool",))
+ADMISSION_REJECTED = Counter(
+    "chatpdf_admission_rejected_total", "Requests rejected with 503 because a pool was full.", ("pool", "reason"))
+
+
+class AdmissionPool:
+    """
+    Bounded concurrency for one kind of work on this worker.
+
+    At most `limit` requests run at once and at most `max_queue` wait, each
+    for up to `max_wait` seconds, in arrival order. Anything beyond that is
+    rejected right away with a 503 and a `Retry-After` estimated from how long
+    requests in this pool recently took, so clients back off instead of
+    holding a connection until the worker timeout.
+
+    The pool's blocking work runs on its own thread limiter (see `run_sync`),
+    so it never takes the threads chat requests need.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int, max_wait: float) -> None:
+        self.name = name
+        self.limit = max(1, limit)
+        self.max_queue = max(0, max_queue)
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._waiters: Deque["asyncio.Future[None]"] = deque()
+        # Moving average of how long an admitted request holds its slot
+        self._service_seconds = 1.0
+        self._thread_limiter = None
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely to be free for a new request."""
+        backlog = (len(self._waiters) + 1) / self.limit
+        return max(1, min(300, math.ceil(self._service_seconds * backlog)))
+
+    def _reject(self, reason: str) -> None:
+        ADMISSION_REJECTED.inc(pool=self.name, reason=reason)
+        retry_after = self.retry_after()
+        raise HTTPException(
+            status_code=503, headers={"Retry-After": str(retry_after)},
+            detail=f"The server is busy with {self.name} requests, retry in {retry_after} seconds")
+
+    def _release(self) -> None:
+        # Hand the slot straight to the oldest waiter still waiting
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                ADMISSION_QUEUED.set(len(self._waiters), pool=self.name)
+                return
+        self.in_flight -= 1
+        ADMISSION_IN_FLIGHT.set(self.in_flight, pool=self.name)
+
+    async def _acquire(self) -> None:
+        if self.in_flight < self.limit and not self._waiters:
+            self.in_flight += 1
+            ADMISSION_IN_FLIGHT.set(self.in_flight, pool=self.name)
+            return
+        if len(self._waiters) >= self.max_queue:
+            self._reject("queue_full")
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        ADMISSION_QUEUED.set(len(self._waiters), pool=self.name)
+        try:
+            await asyncio.wait_for(waiter, self.max_wait)
+        except asyncio.TimeoutError:
+            self._forget(waiter)
+            self._reject("timeout")
+        except asyncio.CancelledError:
+            # The client went away: give back a slot that was already handed over
+            if waiter.done() and not waiter.cancelled():
+                self._release()
+            else:
+                self._forget(waiter)
+            raise
+
+    def _forget(self, waiter: "asyncio.Future[None]") -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+        ADMISSION_QUEUED.set(len(self._waiters), pool=self.name)
+
+    @asynccontextmanager
+    async def admit(self) -> AsyncIterator[None]:
+        """Hold a slot of this pool for the duration of the block, or raise a 503."""
+        started = time.perf_counter()
+        await self._acquire()
+        waited = time.perf_counter() - started
+        ADMISSION_WAIT.observe(waited, pool=self.name)
+        context = current_request()
+        if context is not None:
+            context.timings.append((f"admission_{self.name}", waited))
+        admitted = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._service_seconds = 0.8 * self._service_seconds + 0.2 * (time.perf_counter() - admitted)
+            self._release()
+
+    async def run_sync(self, func: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Run blocking work of this pool in a thread, on threads reserved for the pool."""
+        import anyio.to_thread
+        if self._thread_limiter is None:
+            # Created on first use, inside the worker's event loop
+            self._thread_limiter = anyio.CapacityLimiter(self.limit)
+        return await anyio.to_thread.run_sync(profiled(functools.partial(func, *args, **kwargs)),
+                                              limiter=self._thread_limiter)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"limit": self.limit, "in_flight": self.in_flight, "queued": len(self._waiters),
+                "max_queue": self.max_queue, "max_wait_seconds": self.max_wait,
+                "service_seconds": round(self._service_seconds, 3), "retry_after": self.retry_after()}
+
+
+def _pool(name: str, limit: str, max_queue: str, max_wait: str) -> AdmissionPool:
+    prefix = f"ADMISSION_{name.upper()}"
+    return AdmissionPool(name,
+                         limit=int(os.environ.get(f'{prefix}_LIMIT', limit)),
+                         max_queue=int(os.environ.get(f'{prefix}_QUEUE', max_queue)),
+                         max_wait=float(os.environ.get(f'{prefix}_WAIT', max_wait)))
+
+
+# Per worker. Chat has its own, larger pool, so it is admitted however much
+# ingestion and transcription work is in flight.
+CHAT_POOL = _pool("chat", limit='32', max_queue='64', max_wait='5')
+INGESTION_POOL = _pool("ingestion", limit='2', max_queue='4', max_wait='10')
+TRANSCRIPTION_POOL = _pool("transcription", limit='1', max_queue='2', max_wait='10')
+POOLS = (CHAT_POOL, INGESTION_POOL, TRANSCRIPTION_POOL)
+
+
+def pool_for_file(filename: str) -> AdmissionPool:
+    """The pool that processes a file: transcription for audio, ingestion otherwise."""
+    return TRANSCRIPTION_POOL if filename.split(".")[-1].lower() in AUDIO_EXTENSIONS else INGESTION_POOL
+
+
+@asynccontextmanager
+async def admit_files(filenames: Iterable[str]) -> AsyncIterator[None]:
+    """
+    Hold a slot in every pool needed to process `filenames`, or raise a 503.
+
+    Pools are always taken in the same order, so requests holding one while
+    waiting for another cannot block each other.
+    """
+    needed = {pool_for_file(filename).name for filename in filenames}
+    pools: List[AdmissionPool] = [pool for pool in POOLS if pool.name in needed]
+    async with _admit_all(pools):
+        yield
+
+
+@asynccontextmanager
+async def _admit_all(pools: List[AdmissionPool]) -> AsyncIterator[None]:
+    if not pools:
+        yield
+        return
+    async with pools[0].admit():
+        async with _admit_all(pools[1:]):
+            yield
+
+
+class AdmittedStreamingResponse(StreamingResponse):
+    """
+    A streamed response holding admission slots until it was sent.
+
+    The slots are released once the response is done, whether it was sent in
+    full, failed, or its client went away before the body was ever iterated.
+    """
+
+    def __init__(self, content: Any, admission: AsyncExitStack, **kwargs: Any) -> None:
+        super().__init__(content, **kwargs)
+        self.admission = admission
+
+    async def __call__(self, scope: Any, receive: Any, send: Any) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.admission.aclose()
+
+
+def admission_report() -> Dict[str, Dict[str, Any]]:
+    """Current state of every pool on this worker."""
+    return {pool.name: pool.snapshot() for pool in POOLS}
@@ -1,12 +1,15 @@
-import boto3
 import logging
 from dotenv import load_dotenv
-from botocore.exceptions import ClientError
 import tempfile
-from langchain.schema.document import Document
-from typing import Tuple, List, Any
-from langchain.document_loaders import TextLoader
+from typing import Tuple, List, Any, TYPE_CHECKING
 import os
+from app.metrics import stage_timer
+from app.usage import record_usage
+from app.rate_limiter import INGESTION, call_openai
+
+if TYPE_CHECKING:
+    import boto3
+    from langchain.schema.document import Document
 
 
 # Load environment variables from the .env file
@@ -16,7 +19,7 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 
-def process_audio(s3_client: boto3.client, bucket_name: str, file_key: str, openai_client: Any) -> Tuple[List[Document], str]:
+def process_audio(s3_client: 'boto3.client', bucket_name: str, file_key: str, openai_client: Any) -> Tuple[List['Document'], str]:
     """
     Download a audio file from an S3 bucket, process it to extract text, and return the extracted text and temporary file path.
 
@@ -29,13 +32,16 @@ def process_audio(s3_client: boto3.client, bucket_name: str, file_key: str, open
     Returns:
     tuple: A tuple containing the extracted text data and the temporary file path of the downloaded PDF.
     """
+    from botocore.exceptions import ClientError
+
     try:
         logging.info(f"Downloading audio file from S3: {file_key}")
 
         # Download the audio file from S3
-        s3_object = s3_client.get_object(
-            Bucket=os.environ.get('YOUR_BUCKET_NAME'), Key=file_key)
-        audio_file_bytes = s3_object['Body'].read()
+        with stage_timer("s3_download"):
+            s3_object = s3_client.get_object(
+                Bucket=os.environ.get('YOUR_BUCKET_NAME'), Key=file_key)
+            audio_file_bytes = s3_object['Body'].read()
 
         # Get the file extension
         _, file_extension = os.path.splitext(file_key)
@@ -49,16 +55,27 @@ def process_audio(s3_client: boto3.client, bucket_name: str, file_key: str, open
 
             logging.info(f"Processing audio: {file_key}")
 
-            audio_file = open(temp_audio_path, 'rb')
-            result = openai_client.audio.transcriptions.create(
-                model='whisper-1', file=audio_file, response_format='text')
-            audio_file.close()
+            with stage_timer("transcription"):
+                # The bytes are passed rather than a file handle so retries can resend them;
+                # verbose_json also reports the audio duration, which is what whisper is billed on
+                transcription = call_openai(
+                    openai_client.audio.transcriptions, INGESTION, 0,
+                    model='whisper-1', file=(os.path.basename(temp_audio_path), audio_file_bytes),
+                    response_format='verbose_json')
+            # One transcript segment per line, so chunks break between segments
+            segments = getattr(transcription, 'segments', None) or []
+            result = "\n".join(
+                (segment["text"] if isinstance(segment, dict) else segment.text).strip() for segment in segments
+            ) or transcription.text
+            record_usage("transcription", "whisper-1",
+                         whisper_seconds=float(getattr(transcription, 'duration', 0) or 0))
 
             with tempfile.NamedTemporaryFile(mode='w+', delete=False) as temp_audio_file:
                 temp_audio_file.write(result)
                 temp_audiot_path = temp_audio_file.name
 
             # Load data from the temporary file
+            from langchain.document_loaders import TextLoader
             loader = TextLoader(temp_audiot_path)
             data = loader.load()
 
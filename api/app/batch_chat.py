@@ -0,0 +1,140 @@
+import asyncio
+import logging
+import os
+import time
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+import anyio
+import anyio.to_thread
+
+from app.chat import NO_CONTEXT_ANSWER, NO_CONTEXT_QUERIES, get_completion, retrieve_scored_context, vectorize_texts
+from app.metrics import Counter, log_event
+from app.rate_limiter import INGESTION
+
+MAX_BATCH_QUERIES = int(os.environ.get('CHAT_BATCH_MAX_QUERIES', '1000'))
+# Per batch: vector searches and completions running at the same time
+SEARCH_CONCURRENCY = int(os.environ.get('CHAT_BATCH_SEARCH_CONCURRENCY', '16'))
+COMPLETION_CONCURRENCY = int(os.environ.get('CHAT_BATCH_CONCURRENCY', '8'))
+# Batch jobs are not interactive, so their OpenAI calls wait behind /chat/ requests
+BATCH_PRIORITY = INGESTION
+
+BATCH_QUERIES = Counter("chatpdf_batch_queries_total", "Queries answered through /chat/batch/.", ("status",))
+
+
+class QueryBatch:
+    """
+    The distinct queries of a batch with their vectors.
+
+    Queries that only differ in whitespace are answered once; `positions`
+    maps each distinct query to the positions it answers in the request.
+    """
+
+    def __init__(self, queries: List[str]) -> None:
+        self.queries = queries
+        self.distinct: List[str] = []
+        self.positions: List[List[int]] = []
+        self.empty: List[int] = []
+        self.vectors: List[List[float]] = []
+        seen: Dict[str, int] = {}
+        for position, query in enumerate(queries):
+            key = " ".join(query.split())
+            if not key:
+                self.empty.append(position)
+                continue
+            if key not in seen:
+                seen[key] = len(self.distinct)
+                self.distinct.append(query)
+                self.positions.append([])
+            self.positions[seen[key]].append(position)
+
+
+def prepare_batch(queries: List[str]) -> QueryBatch:
+    """
+    Group the queries of a batch and vectorize the distinct ones in batched embeddings requests.
+
+    Parameters:
+    queries (List[str]): The user queries, in request order.
+
+    Returns:
+    QueryBatch: The distinct queries and their vectors.
+    """
+    batch = QueryBatch(queries)
+    if batch.distinct:
+        batch.vectors = vectorize_texts(batch.distinct, BATCH_PRIORITY)
+    return batch
+
+
+async def _answer(query: str, query_vector: List[float], search_slots: asyncio.Semaphore,
+                  completion_slots: asyncio.Semaphore, threads: anyio.CapacityLimiter) -> Dict[str, str]:
+    try:
+        async with search_slots:
+            context, _, top_score = await anyio.to_thread.run_sync(
+                retrieve_scored_context, query, query_vector, limiter=threads)
+        if context:
+            async with completion_slots:
+                answer = await anyio.to_thread.run_sync(
+                    get_completion, query, context, "", BATCH_PRIORITY, top_score, limiter=threads)
+        else:
+            NO_CONTEXT_QUERIES.inc()
+            answer = NO_CONTEXT_ANSWER
+        BATCH_QUERIES.inc(status="ok")
+        return {"response": answer or ''}
+    except Exception as e:
+        # One failed query does not fail the rest of the batch
+        logging.error(f"Batch query failed: {e}")
+        BATCH_QUERIES.inc(status="failed")
+        return {"error": str(e)}
+
+
+async def answer_batch(batch: QueryBatch) -> AsyncIterator[Tuple[int, Dict[str, str]]]:
+    """
+    Answer the queries of a batch concurrently.
+
+    Vector searches and completions are bounded by SEARCH_CONCURRENCY and
+    COMPLETION_CONCURRENCY. Results are yielded as they complete, with the
+    position of the query they answer; closing the iterator cancels the
+    queries still running.
+
+    Parameters:
+    batch (QueryBatch): The batch returned by `prepare_batch`.
+
+    Yields:
+    Tuple[int, Dict[str, str]]: The position of a query and its result, with
+    either a `response` or an `error`.
+    """
+    started = time.perf_counter()
+    for position in batch.empty:
+        BATCH_QUERIES.inc(status="failed")
+        yield position, {"query": batch.queries[position], "error": "User query is empty"}
+
+    search_slots = asyncio.Semaphore(SEARCH_CONCURRENCY)
+    completion_slots = asyncio.Semaphore(COMPLETION_CONCURRENCY)
+    # The batch's own threads, so it never takes the threads of /chat/ requests
+    threads = anyio.CapacityLimiter(SEARCH_CONCURRENCY + COMPLETION_CONCURRENCY)
+    tasks: Dict["asyncio.Task[Dict[str, str]]", int] = {
+        asyncio.ensure_future(_answer(query, vector, search_slots, completion_slots, threads)): i
+        for i, (query, vector) in enumerate(zip(batch.distinct, batch.vectors))
+    }
+    pending = set(tasks)
+    failed = len(batch.empty)
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                result = task.result()
+                for position in batch.positions[tasks[task]]:
+                    failed += "error" in result
+                    yield position, dict(result, query=batch.queries[position])
+    finally:
+        for task in pending:
+            task.cancel()
+        log_event("chat_batch", queries=len(batch.queries), distinct=len(batch.distinct),
+                  failed=failed, cancelled=len(pending), seconds=round(time.perf_counter() - started, 4))
+
+
+async def collect_batch(batch: QueryBatch) -> List[Optional[Dict[str, str]]]:
+    """Answer the queries of a batch and return the results in request order."""
+    results: List[Optional[Dict[str, str]]] = [None] * len(batch.queries)
+    async for position, result in answer_batch(batch):
+        results[position] = result
+    return results
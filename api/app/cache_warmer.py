@@ -0,0 +1,170 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from app.chat import MAX_QUERY_TOKENS, MAX_RESPONSE_TOKENS, answer_query, completion_model
+from app.embedding_index import index_watcher
+from app.metrics import Counter, background_context, log_event
+from app.query_cache import QUERY_CACHE_ENABLED, get_query_cache
+from app.rate_limiter import INGESTION
+from app.retrieval_config import get_retrieval_config
+from app.usage import estimate_cost
+
+# Most frequent recent queries answered ahead of users in each warm cycle
+CACHE_WARM_TOP_N = int(os.environ.get('CACHE_WARM_TOP_N', '20'))
+# Most estimated OpenAI spend of one warm cycle, in USD
+CACHE_WARM_BUDGET_USD = float(os.environ.get('CACHE_WARM_BUDGET_USD', '1.0'))
+# Seconds to wait after an ingestion, so a burst of uploads triggers one cycle
+CACHE_WARM_DELAY = float(os.environ.get('CACHE_WARM_DELAY', '30'))
+# Seconds between scheduled cycles; 0 only warms after ingestions
+CACHE_WARM_INTERVAL = float(os.environ.get('CACHE_WARM_INTERVAL', '0'))
+# A cycle running longer than this is assumed dead and another worker may start one
+WARM_LEASE_SECONDS = 900
+
+WARMED_QUERIES = Counter(
+    "chatpdf_cache_warm_queries_total", "Queries answered by the cache warmer, by outcome.", ("status",))
+
+
+def _query_cost_estimate() -> float:
+    """Upper bound of the cost of answering one query: a full context and the longest completion."""
+    prompt_tokens = int(get_retrieval_config().context_fraction * MAX_QUERY_TOKENS) + 500
+    return estimate_cost(completion_model, prompt_tokens=prompt_tokens, completion_tokens=MAX_RESPONSE_TOKENS)
+
+
+def warm_cache(top_n: int = CACHE_WARM_TOP_N, budget_usd: float = CACHE_WARM_BUDGET_USD) -> Dict[str, Any]:
+    """
+    Answer the most frequent recent queries that have no current cached answer.
+
+    Calls are made at ingestion priority, so they wait behind chat requests,
+    and the cycle stops before a query could take its spend over `budget_usd`.
+    Only one cycle runs at a time across the workers of this instance.
+
+    Parameters:
+    top_n (int): The number of most frequent queries considered.
+    budget_usd (float): The most estimated OpenAI spend of the cycle.
+
+    Returns:
+    Dict[str, Any]: What the cycle did: queries warmed, already fresh, failed,
+    left for lack of budget, and the spend.
+    """
+    cache = get_query_cache()
+    if not cache.try_lease("warm", WARM_LEASE_SECONDS):
+        return {"status": "skipped", "reason": "another worker is warming the cache"}
+    started = time.perf_counter()
+    report = {"status": "done", "considered": 0, "warmed": 0, "fresh": 0, "failed": 0, "over_budget": 0}
+    try:
+        cache.prune()
+        queries = cache.top_queries(top_n)
+        report["considered"] = len(queries)
+        # Queries are budgeted at the costliest one seen so far, and at the
+        # worst case until one cost anything
+        worst_case, costliest = _query_cost_estimate(), 0.0
+        with background_context("cache-warmer") as context:
+            for query, _ in queries:
+                if cache.is_fresh(query):
+                    report["fresh"] += 1
+                    continue
+                spent = context.usage.get("cost_usd", 0.0)
+                if spent + (costliest or worst_case) > budget_usd:
+                    report["over_budget"] += 1
+                    continue
+                try:
+                    answer_query(query, cache, INGESTION)
+                    costliest = max(costliest, context.usage.get("cost_usd", 0.0) - spent)
+                    report["warmed"] += 1
+                    WARMED_QUERIES.inc(status="warmed")
+                except Exception as e:
+                    logging.error(f"Cache warmer failed on a query: {e}")
+                    report["failed"] += 1
+                    WARMED_QUERIES.inc(status="failed")
+            report["cost_usd"] = round(context.usage.get("cost_usd", 0.0), 6)
+        if report["over_budget"]:
+            WARMED_QUERIES.inc(report["over_budget"], status="over_budget")
+    finally:
+        cache.release_lease("warm")
+    report["seconds"] = round(time.perf_counter() - started, 4)
+    log_event("cache_warm", **report)
+    return report
+
+
+class CacheWarmer:
+    """
+    Background thread of one worker that runs warm cycles after ingestions and on a schedule.
+
+    `notify_ingestion` marks cached answers stale and schedules a cycle
+    CACHE_WARM_DELAY seconds later; further ingestions within the delay push
+    it back, so a batch of uploads is followed by a single cycle.
+    """
+
+    def __init__(self, delay: float = CACHE_WARM_DELAY, interval: float = CACHE_WARM_INTERVAL) -> None:
+        self.delay = delay
+        self.interval = interval
+        self._due: Optional[float] = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        with self._condition:
+            if self._thread is None:
+                self._stopped = False
+                if self.interval:
+                    self._due = time.monotonic() + self.interval
+                self._thread = threading.Thread(target=self._run, name="cache-warmer", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join(timeout=5)
+
+    def notify_ingestion(self) -> None:
+        get_query_cache().bump_generation()
+        with self._condition:
+            self._due = time.monotonic() + self.delay
+            self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                while not self._stopped and (self._due is None or self._due > time.monotonic()):
+                    self._condition.wait(None if self._due is None else self._due - time.monotonic())
+                if self._stopped:
+                    return
+                self._due = time.monotonic() + self.interval if self.interval else None
+            try:
+                warm_cache()
+            except Exception as e:
+                logging.error(f"Cache warm cycle failed: {e}")
+
+
+cache_warmer = CacheWarmer()
+
+
+def start_cache_warmer() -> None:
+    """Start this worker's warmer thread; called from the app's lifespan, after the fork."""
+    if QUERY_CACHE_ENABLED:
+        cache_warmer.start()
+
+
+def stop_cache_warmer() -> None:
+    cache_warmer.stop()
+
+
+def notify_ingestion(publish: bool = True) -> None:
+    """
+    Mark cached answers stale after documents were ingested, and schedule a warm cycle.
+
+    Parameters:
+    publish (bool): Whether to record the ingestion in Pinecone, so every
+    other instance marks its cached answers stale as well.
+    """
+    if QUERY_CACHE_ENABLED:
+        cache_warmer.notify_ingestion()
+        if publish:
+            index_watcher.publish_corpus_change()
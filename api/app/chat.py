@@ -1,87 +1,145 @@
 import os
-import openai
-import pinecone
 from dotenv import load_dotenv
-from typing import List, Dict, Union, Tuple
+from typing import List, Dict, Optional, Union, Tuple
 from collections import defaultdict, namedtuple
 import datetime
+import time
+import openai
 import pytz
 
-from app.utils import initialize_openai
+from app.clients import get_openai_client, get_pinecone_index
+from app.embedding_index import EmbeddingSpec, active_index
+from app.model_router import STRONG_COMPLETION_MODEL, STRONG_MAX_RESPONSE_TOKENS, observe_completion, refiner_route, route_query
+from app.metrics import Counter, log_event, stage_timer
+from app.usage import record_response_usage
+from app.rate_limiter import CHAT, call_openai, estimate_tokens
+from app.singleflight import SingleFlight
+from app.retrieval_config import RetrievalConfig, ScoreThresholds, get_retrieval_config, score_thresholds
+from app.document_summaries import shortlist_documents
+from app.query_cache import QUERY_CACHE_ENABLED, QueryCache, get_query_cache
+from app.deadlines import DEADLINES_EXCEEDED, MIN_COMPLETION_SECONDS, DeadlineExceeded, hedged, remaining, stage_timeout
 # Load environment variables from the .env file
 load_dotenv()
 
-# Set up OpenAI API key
-client = initialize_openai()
-
 # Max number of tokens allowed by OpenAI and "text-davinci-003"
 MAX_TOKENS = 8000
-MAX_RESPONSE_TOKENS = 800
+# The response budget of the strong model tier, the largest one
+MAX_RESPONSE_TOKENS = STRONG_MAX_RESPONSE_TOKENS
 MAX_QUERY_TOKENS = MAX_TOKENS - MAX_RESPONSE_TOKENS
-MAX_CONTEXT_TOKENS = int(0.3 * MAX_QUERY_TOKENS)
 MAX_HISTORY_TOKENS = int(0.6 * MAX_QUERY_TOKENS)
+# The context budget, top_k and characters per token come from the retrieval config
 
-# Max character length for prompt
-CHARACTERS_PER_TOKEN = 4
-MAX_CONTEXT_LENGTH = MAX_CONTEXT_TOKENS * CHARACTERS_PER_TOKEN
-MAX_HISTORY_LENGTH = MAX_HISTORY_TOKENS * CHARACTERS_PER_TOKEN
+CONTEXT_SEPARATOR = "\n\n---\n\n"
 
-# Name of your Pinecone index
-index_name = os.environ.get('YOUR_INDEX_NAME')
+# Answer given without calling the chat model when no match clears the score threshold
+NO_CONTEXT_ANSWER = ("No encontré información relevante en los documentos cargados "
+                     "para responder a esta pregunta.")
 
-# Define OpenAI embedding model
-embed_model = "text-embedding-ada-002"
+NO_CONTEXT_QUERIES = Counter(
+    "chatpdf_no_context_queries_total", "Queries answered without a completion because no match cleared the threshold.")
 
-# Define OpenAI completion model
-completion_model = "gpt-4-1106-preview"
+# Answer given when the request's time budget leaves no room for a completion,
+# followed by the best retrieved passages
+DEGRADED_ANSWER = ("No pude generar una respuesta a tiempo. Estos son los fragmentos "
+                   "de los documentos más relevantes para tu pregunta:")
+# Passages quoted in a degraded answer
+DEGRADED_PASSAGES = 3
 
+DEGRADED_ANSWERS = Counter(
+    "chatpdf_degraded_answers_total", "Queries answered without a completion because the deadline was near, by source.",
+    ("source",))
 
-def initialize_pinecone() -> None:
-    """
-    Initialize Pinecone with API key and environment variables from .env file.
-    """
-    pinecone_api_key = os.environ.get('PINECONE_API_KEY')
-    pinecone_env = os.environ.get('PINECONE_API_ENV')
-    pinecone.init(
-        api_key=pinecone_api_key,
-        environment=pinecone_env
-    )
+# The index searched and the embedding model queries are vectorized with come
+# from app.embedding_index: they change together when an index is migrated
 
+# Define OpenAI completion model: the strong tier, used when a query is not
+# routed to the fast one (see app.model_router)
+completion_model = STRONG_COMPLETION_MODEL
 
-def vectorize_text(text: str) -> List[float]:
+# Identical texts embedded concurrently on this worker share one OpenAI call
+embedding_flight = SingleFlight("embedding")
+
+# Inputs per embeddings request when vectorizing many queries at once
+EMBED_BATCH_SIZE = 256
+
+
+def vectorize_text(text: str, spec: Optional[EmbeddingSpec] = None) -> List[float]:
     """
     Vectorize the given text using OpenAI's embedding model.
 
     Parameters:
     text (str): The text to be vectorized.
+    spec (EmbeddingSpec): The model and vector length, by default those of the active index.
 
     Returns:
     List[float]: The vector representation of the text.
     """
     text = text.replace("\n", " ")
+    spec = spec or active_index().spec
+
+    def embed(timeout: float) -> List[float]:
+        with stage_timer("embedding"):
+            response = call_openai(get_openai_client().embeddings, CHAT, estimate_tokens(text),
+                                   input=[text], timeout=timeout, **spec.request_options())
+        record_response_usage("query_embedding", spec.model, response, embedding=True)
+        return response.data[0].embedding
 
-    res = client.embeddings.create(
-        input=[text], model=embed_model).data[0].embedding
-    return res
+    return embedding_flight.do((spec, text), lambda: hedged("embedding", embed))
 
 
-def search_in_pinecone(query_vector: List[float], index_name: str) -> Dict[str, Union[str, List[Dict[str, Union[str, float]]]]]:
+def vectorize_texts(texts: List[str], priority: str = CHAT, spec: Optional[EmbeddingSpec] = None) -> List[List[float]]:
+    """
+    Vectorize many texts with one embeddings request per EMBED_BATCH_SIZE texts.
+
+    Parameters:
+    texts (List[str]): The texts to be vectorized.
+    priority (str): The rate limiter priority of the requests.
+    spec (EmbeddingSpec): The model and vector length, by default those of the active index.
+
+    Returns:
+    List[List[float]]: The vector representations, in the order of `texts`.
+    """
+    texts = [text.replace("\n", " ") for text in texts]
+    spec = spec or active_index().spec
+    vectors: List[List[float]] = []
+    for start in range(0, len(texts), EMBED_BATCH_SIZE):
+        batch = texts[start:start + EMBED_BATCH_SIZE]
+        with stage_timer("embedding"):
+            response = call_openai(get_openai_client().embeddings, priority,
+                                   sum(estimate_tokens(text) for text in batch),
+                                   input=batch, **spec.request_options())
+        record_response_usage("query_embedding", spec.model, response, embedding=True)
+        vectors.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+    return vectors
+
+
+def search_in_pinecone(query_vector: List[float], index_name: str, top_k: Optional[int] = None,
+                       documents: Optional[List[str]] = None) -> Dict[str, Union[str, List[Dict[str, Union[str, float]]]]]:
     """
     Search the Pinecone index using the given query vector.
 
     Parameters:
     query_vector (List[float]): The vector representation of the query.
+    top_k (int): The number of matches, by default `candidate_k` from the retrieval config.
+    documents (List[str]): Only search the chunks of these documents, by default all chunks.
 
     Returns:
     Dict: The search results from Pinecone.
     """
+    index = get_pinecone_index(index_name)
+
+    def search(timeout: float) -> Dict:
+        with stage_timer("search"):
+            return index.query(
+                vector=query_vector,
+                top_k=top_k or get_retrieval_config().candidate_k,
+                filter={"documents": {"$in": documents}} if documents else None,
+                include_metadata=True,
+                _request_timeout=timeout
+            )
+
     try:
-        index = pinecone.Index(index_name)
-        results = index.query(
-            vector=query_vector,
-            top_k=6,
-            include_metadata=True
-        )
+        results = hedged("search", search)
     except Exception as e:
         print(f"Error: {e}")
         raise
@@ -89,13 +147,14 @@ def search_in_pinecone(query_vector: List[float], index_name: str) -> Dict[str,
 
 
 def get_conversation_log(history_buffer: List[Dict[str, str]], index_name: str) -> str:
-    ''' Get the conversation log from the history buffer such that the length of the conversation log is <= MAX_HISTORY_LENGTH.'''
+    ''' Get the conversation log from the history buffer such that the length of the conversation log fits MAX_HISTORY_TOKENS.'''
 
+    max_history_length = MAX_HISTORY_TOKENS * get_retrieval_config().characters_per_token
     conversation_log = ""
     for message in history_buffer[::-1]:
         conversation_log_temp = f"{message['role']}: {message['content']}\n" + \
             conversation_log
-        if len(conversation_log_temp) > MAX_HISTORY_LENGTH:
+        if len(conversation_log_temp) > max_history_length:
             break
         conversation_log = conversation_log_temp
     return conversation_log.strip()
@@ -108,54 +167,133 @@ def query_refiner(query: str, conversation_log: str) -> Tuple[str, Dict[str, int
         + f"an answer from a knowledge base.\n\nCONVERSATION LOG:\n{conversation_log}\n\nQUERY:{query}\n\nREFINED QUERY:"
 
     system_prompt = "You are a knowledge management assistant, respond in a polite and direct manner, and always respond in the language of the QUERY"
-    response = client.chat.completions.create(
-        model=completion_model,
-        messages=[{"role": "system", "content": system_prompt},
-                  {"role": "user", "content": prompt}],
-        temperature=0.2,
-        max_tokens=MAX_RESPONSE_TOKENS,
-        frequency_penalty=0.2,
-        presence_penalty=0
-    )
+    route = refiner_route()
+    with stage_timer("refine"):
+        response = call_openai(
+            get_openai_client().chat.completions, CHAT,
+            estimate_tokens(system_prompt + prompt) + route.max_tokens,
+            model=route.model,
+            messages=[{"role": "system", "content": system_prompt},
+                      {"role": "user", "content": prompt}],
+            temperature=0.2,
+            max_tokens=route.max_tokens,
+            frequency_penalty=0.2,
+            presence_penalty=0
+        )
+    record_response_usage("refine", route.model, response)
     return response.choices[0].message.content, response.usage
 
 
-def retrieve_context(query: str) -> Tuple[str, List[Dict[str, str]]]:
+def retrieve_context(query: str, query_vector: Optional[List[float]] = None) -> Tuple[str, List[Dict[str, str]]]:
+    ''' Retrieve the context of a query and its sources; see `retrieve_scored_context`. '''
+    context, reference, _ = retrieve_scored_context(query, query_vector)
+    return context, reference
+
+
+def retrieve_scored_context(query: str, query_vector: Optional[List[float]] = None) -> Tuple[str, List[Dict[str, str]], Optional[float]]:
     '''
     Retrieve the most relevant context based on the query in adition
-    to the filename of the source documents
+    to the filename of the source documents. The query is vectorized
+    unless its vector is given. The context is empty when no match is
+    relevant enough.
+
+    With a `document_shortlist` in the retrieval config, only the chunks of
+    the documents whose summary vectors are closest to the query are
+    searched; all chunks are searched if no summary is stored yet.
+
+    The score of the best match kept, None if none was, is returned last.
     '''
 
-    query_vector = vectorize_text(query)
-    res = search_in_pinecone(query_vector, index_name)
+    target = active_index()
+    # A vector computed before the index was migrated does not fit the new one
+    if query_vector is None or len(query_vector) != target.spec.dimensions:
+        query_vector = vectorize_text(query, target.spec)
+    shortlist = get_retrieval_config().document_shortlist
+    documents = None
+    if shortlist:
+        documents = shortlist_documents(get_pinecone_index(target.name), query_vector, shortlist) or None
+    res = search_in_pinecone(query_vector, target.name, documents=documents)
+    matches = select_matches([x for x in res['matches'] if 'metadata' in x and 'text' in x['metadata']])
 
     # Save the contexts
-    contexts = []
-    for x in res['matches']:
-        if 'metadata' in x and 'text' in x['metadata']:
-            contexts.append(x['metadata']['text'])
+    contexts = [x['metadata']['text'] for x in matches]
 
     # Save the reference of the contexts
     sources = set([])
-    for x in res['matches']:
+    for x in matches:
         if 'metadata' in x and 'source' in x['metadata']:
             sources.add(x['metadata']['source'])
     reference = [{'source': source} for source in sources]
 
-    # Add context until reaching MAX_CONTEXT_LENGTH
-    context = ''
-    for i in range(1, len(contexts)):
-        if len("\n\n---\n\n".join(contexts[:i])) > MAX_CONTEXT_LENGTH:
-            context = "\n\n---\n\n".join(contexts[:i-1])
-            break
-        elif i == len(contexts)-1:
-            context = "\n\n---\n\n".join(contexts)
+    return assemble_context(contexts), reference, matches[0]['score'] if matches else None
+
+
+_uncalibrated_models = set()
 
-    return context, reference
 
+def active_score_thresholds(config: Optional[RetrievalConfig] = None) -> ScoreThresholds:
+    '''
+    Return the score cutoffs of the active index's embedding model.
 
-def get_completion(query: str, context: str, conversation_log: str) -> str:
-    ''' Get a completion based on the query, context, and conversation log. '''
+    An index of a model without calibrated cutoffs is only active if it was
+    set up outside a migration, e.g. restored from a snapshot; its matches
+    are then only cut relative to the best one, and no lookup is vouched for.
+    '''
+    model = active_index().spec.model
+    thresholds = score_thresholds(model, config)
+    if thresholds is None:
+        if model not in _uncalibrated_models:
+            _uncalibrated_models.add(model)
+            log_event("uncalibrated_scores", model=model)
+        thresholds = ScoreThresholds(0.0, None)
+    return thresholds
+
+
+def select_matches(matches: List[Dict], config: Optional[RetrievalConfig] = None,
+                   thresholds: Optional[ScoreThresholds] = None) -> List[Dict]:
+    '''
+    Keep the matches worth putting in the prompt, from matches sorted by score.
+
+    A match is kept if it clears `min_score` and is within `max_score_gap`
+    (relative) of the best match, up to `top_k` matches: a focused question
+    keeps only its few close matches, a broad one keeps more, and an
+    off-topic one keeps none. `min_score` is the one calibrated for the
+    active index's embedding model unless `thresholds` are given.
+    '''
+    config = config or get_retrieval_config()
+    if not matches:
+        return []
+    thresholds = thresholds or active_score_thresholds(config)
+    floor = max(thresholds.min_score, matches[0]['score'] * (1 - config.max_score_gap))
+    return [x for x in matches[:config.top_k] if x['score'] >= floor]
+
+
+def max_context_length(config: RetrievalConfig) -> int:
+    ''' The number of characters of retrieved context that fit in the prompt. '''
+    return int(config.context_fraction * MAX_QUERY_TOKENS * config.characters_per_token)
+
+
+def fitting_contexts(contexts: List[str], config: Optional[RetrievalConfig] = None) -> List[str]:
+    '''
+    Return the best matches, in order, that fit the context budget together.
+    A match that would exceed the budget ends the context.
+    '''
+    max_length = max_context_length(config or get_retrieval_config())
+    length = -len(CONTEXT_SEPARATOR)
+    for i, text in enumerate(contexts):
+        length += len(CONTEXT_SEPARATOR) + len(text)
+        if length > max_length:
+            return contexts[:i]
+    return contexts
+
+
+def assemble_context(contexts: List[str], config: Optional[RetrievalConfig] = None) -> str:
+    ''' Join the matches that fit the context budget into the prompt context. '''
+    return CONTEXT_SEPARATOR.join(fitting_contexts(contexts, config))
+
+
+def build_completion_prompt(query: str, context: str, conversation_log: str) -> Tuple[str, str]:
+    ''' Return the system prompt and the user prompt of a completion. '''
 
     prompt = ("Please provide an answer based solely on the available context and conversation history. "
               "Do not include information beyond what is provided in the context. "
@@ -169,16 +307,41 @@ def get_completion(query: str, context: str, conversation_log: str) -> str:
               "ANSWER:")
 
     system_prompt = "You are a knowledge management assistant, respond in a polite and detailed manner, and always respond in spanish"
+    return system_prompt, prompt
+
+
+def get_completion(query: str, context: str, conversation_log: str, priority: str = CHAT,
+                   top_score: Optional[float] = None) -> str:
+    '''
+    Get a completion based on the query, context, and conversation log, from
+    the model tier the query is routed to. `top_score` is the similarity of the
+    best retrieved match, when known.
+    '''
+
+    system_prompt, prompt = build_completion_prompt(query, context, conversation_log)
+    route = route_query(query, context, top_score, active_score_thresholds().fast_min_score)
 
-    response = client.chat.completions.create(
-        model=completion_model,
-        messages=[{"role": "system", "content": system_prompt},
-                  {"role": "user", "content": prompt}],
-        temperature=0,
-        max_tokens=MAX_RESPONSE_TOKENS,
-        frequency_penalty=0.6,
-        presence_penalty=0
-    )
+    # Completions are not hedged: a duplicate would double their cost
+    started = time.perf_counter()
+    try:
+        with stage_timer("completion"):
+            response = call_openai(
+                get_openai_client().chat.completions, priority,
+                estimate_tokens(system_prompt + prompt) + route.max_tokens,
+                model=route.model,
+                messages=[{"role": "system", "content": system_prompt},
+                          {"role": "user", "content": prompt}],
+                temperature=0,
+                max_tokens=route.max_tokens,
+                frequency_penalty=0.6,
+                presence_penalty=0,
+                timeout=stage_timeout("completion")
+            )
+    except openai.APITimeoutError as e:
+        DEADLINES_EXCEEDED.inc(stage="completion")
+        raise DeadlineExceeded("completion") from e
+    observe_completion(route, time.perf_counter() - started)
+    record_response_usage("completion", route.model, response)
 
     return response.choices[0].message.content
 
@@ -201,15 +364,15 @@ def process_user_query(user_query: str) -> Tuple[str, List[Dict[str, str]]]:
     user_rut = os.environ.get('USER_RUT')
     s3_bucket_name = os.environ.get('S3_BUCKET_NAME')
 
-    # Inicializa Pinecone
-    initialize_pinecone()
-
     if not user_query:
         raise ValueError("User query is empty")
 
-    # Obtiene el contexto y la respuesta basada en la consulta del usuario
-    context, reference = retrieve_context(user_query)
-    answer = get_completion(user_query, context, "")
+    # Obtiene el contexto y la respuesta basada en la consulta del usuario,
+    # registrándola para el precalentamiento de la caché
+    cache = get_query_cache() if QUERY_CACHE_ENABLED else None
+    if cache is not None:
+        cache.record(user_query)
+    answer = answer_query(user_query, cache)
 
     # Crea una lista de referencia vacía
     reference = []
@@ -218,3 +381,91 @@ def process_user_query(user_query: str) -> Tuple[str, List[Dict[str, str]]]:
         answer = ''
 
     return answer
+
+
+def answer_query(query: str, cache: Optional[QueryCache] = None, priority: str = CHAT) -> str:
+    """
+    Answer a query, reusing and filling the query cache when one is given.
+
+    A current cached answer is returned as is; otherwise the cached query
+    vector and retrieved context are reused when present and the rest is
+    computed.
+
+    When the deadline of the request leaves no time to finish, the answer is
+    degraded instead of failing: see `degraded_answer`.
+
+    Parameters:
+    query (str): The user query.
+    cache (QueryCache): The query cache, or None to compute everything.
+    priority (str): The rate limiter priority of the OpenAI calls.
+
+    Returns:
+    str: The answer.
+    """
+    cached = cache.lookup(query) if cache is not None else None
+    if cached is not None and cached.answer is not None:
+        return cached.answer
+    # Read before retrieving, so an ingestion finishing meanwhile makes this entry stale
+    generation = cache.generation() if cache is not None else 0
+
+    vector = cached.vector if cached is not None else None
+    context = cached.context if cached is not None else None
+    # Unknown for a cached context: it is then routed on the other features
+    top_score = None
+    try:
+        if vector is None:
+            vector = vectorize_text(query) if priority == CHAT else vectorize_texts([query], priority)[0]
+        if context is None:
+            context, _, top_score = retrieve_scored_context(query, vector)
+    except DeadlineExceeded:
+        return degraded_answer(query, None, cache)
+
+    degraded = False
+    if not context:
+        NO_CONTEXT_QUERIES.inc()
+        answer = NO_CONTEXT_ANSWER
+    elif remaining() < MIN_COMPLETION_SECONDS:
+        answer, degraded = degraded_answer(query, context, cache), True
+    else:
+        try:
+            answer = get_completion(query, context, "", priority, top_score)
+        except DeadlineExceeded:
+            answer, degraded = degraded_answer(query, context, cache), True
+
+    # A degraded answer is not stored, so it does not replace the last full one
+    if cache is not None and not degraded:
+        # An empty answer is not worth serving again
+        cache.store(query, vector, context, answer or None, generation)
+    return answer
+
+
+def degraded_answer(query: str, context: Optional[str], cache: Optional[QueryCache] = None) -> str:
+    """
+    Answer a query without a completion, when its deadline is nearly spent.
+
+    The last answer cached for the query is returned even if an ingestion made
+    it stale; otherwise the best passages of the retrieved context, or of the
+    last context cached for it, are quoted.
+
+    Parameters:
+    query (str): The user query.
+    context (str): The retrieved context, or None when retrieval did not finish.
+    cache (QueryCache): The query cache, or None.
+
+    Returns:
+    str: The degraded answer.
+
+    Raises:
+    DeadlineExceeded: When there is neither a cached answer nor a context to quote.
+    """
+    last = cache.last_known(query) if cache is not None else None
+    if last is not None and last.answer:
+        DEGRADED_ANSWERS.inc(source="stale_answer")
+        return last.answer
+    context = context or (last.context if last is not None else None)
+    if not context:
+        DEGRADED_ANSWERS.inc(source="none")
+        raise DeadlineExceeded("retrieval")
+    DEGRADED_ANSWERS.inc(source="context")
+    passages = context.split(CONTEXT_SEPARATOR)[:DEGRADED_PASSAGES]
+    return DEGRADED_ANSWER + "\n\n" + CONTEXT_SEPARATOR.join(passages)
@@ -0,0 +1,251 @@
+import logging
+import re
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, List, NamedTuple, Optional
+
+from app.rate_limiter import estimate_tokens
+
+if TYPE_CHECKING:
+    from langchain.schema.document import Document
+
+# Chunks are packed from the structure of each extracted part (a PDF page, a
+# slide, a DOCX body, a transcript): paragraphs, headings, table rows and
+# transcript segments, and only for a piece longer than a whole chunk,
+# sentences and words. Sizes are counted in tokens of the embedding models'
+# encoding, so chunks cost and weigh in the prompt about the same. A heading
+# starts a chunk and never ends one, and a table continued in a new chunk
+# repeats its header row. Chunks do not span parts, so each one keeps its
+# part's metadata (page, slide).
+
+# The encoding of ada-002, the text-embedding-3 models and the chat models
+ENCODING_NAME = "cl100k_base"
+# Longest line taken for a heading
+HEADING_MAX_WORDS = 12
+
+# Put between two units of a chunk
+BLOCK, LINE, SPACE = "\n\n", "\n", " "
+
+_BLANK_LINE_RE = re.compile(r"\n[ \t\r\f\v]*\n")
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?…])[\"'”»)\]]*(\s+)")
+_SPACE_RE = re.compile(r"(\s+)")
+# Markdown headings, numbered sections ("2.1 Alcance", "IV. Anexos") and named ones
+_HEADING_RE = re.compile(
+    r"^(#{1,6}\s|\d+(\.\d+)*\.?\s+\w|[IVXLC]+\.\s+\w|"
+    r"(cap[ií]tulo|chapter|secci[oó]n|section|parte|part|anexo|annex|ap[eé]ndice|appendix|art[ií]culo|article)\b)",
+    re.IGNORECASE)
+
+_counter: Optional[Callable[[str], int]] = None
+_encoding = None
+
+
+def token_counter() -> Callable[[str], int]:
+    """Count tokens with the embedding models' encoding, or estimate them if it cannot be loaded."""
+    global _counter, _encoding
+    if _counter is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(ENCODING_NAME)
+            _counter = lambda text: len(_encoding.encode_ordinary(text))  # noqa: E731
+        except Exception as e:
+            logging.warning(f"tiktoken unavailable ({e}), estimating tokens from characters")
+            _counter = estimate_tokens
+    return _counter
+
+
+def _cut(text: str, max_tokens: int) -> List[str]:
+    """Cut a text with no break in it, e.g. a long URL, into pieces of at most `max_tokens` tokens."""
+    token_counter()
+    if _encoding is None:
+        # estimate_tokens counts about 4 characters per token
+        step = max(1, (max_tokens - 1) * 4)
+        return [text[start:start + step] for start in range(0, len(text), step)]
+    tokens = _encoding.encode_ordinary(text)
+    return [_encoding.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
+
+
+class _Unit(NamedTuple):
+    """A piece a chunk is packed from, never split further."""
+
+    text: str
+    tokens: int
+    # Put before the unit when it follows another one in the same chunk
+    joiner: str
+    heading: bool = False
+    # Never the last unit of a chunk: headings and table header rows
+    keep_with_next: bool = False
+    # The header row of a table row, repeated when the table continues in a new chunk
+    header: Optional["_Unit"] = None
+
+
+def _pieces(text: str, pattern: "re.Pattern") -> Iterator[tuple]:
+    """Split `text` at the whitespace matched by `pattern`, with the whitespace each piece followed."""
+    start, joiner = 0, SPACE
+    for match in pattern.finditer(text):
+        piece = text[start:match.start(1)]
+        if piece:
+            yield piece, joiner
+        joiner = LINE if "\n" in match.group(1) else SPACE
+        start = match.end(1)
+    if text[start:]:
+        yield text[start:], joiner
+
+
+def _text_units(text: str, joiner: str, max_tokens: int, count: Callable[[str], int],
+                level: int = 0) -> Iterator[_Unit]:
+    """A text as one unit if it fits in a chunk, else as sentences, words, then cut pieces."""
+    if level == 2:
+        for position, piece in enumerate(_cut(text, max_tokens)):
+            yield _Unit(piece, count(piece), joiner if position == 0 else "")
+        return
+    # The pieces are counted once, and their sum is the text's count give or take the joiners
+    pieces = list(_pieces(text, _SENTENCE_END_RE if level == 0 else _SPACE_RE))
+    counts = [count(piece) for piece, _ in pieces]
+    total = sum(counts) + len(pieces) - 1
+    if total <= max_tokens:
+        yield _Unit(text, total, joiner)
+        return
+    for position, ((piece, piece_joiner), tokens) in enumerate(zip(pieces, counts)):
+        piece_joiner = joiner if position == 0 else piece_joiner
+        if tokens <= max_tokens:
+            yield _Unit(piece, tokens, piece_joiner)
+        else:
+            yield from _text_units(piece, piece_joiner, max_tokens, count, level + 1)
+
+
+def _is_heading(line: str, previous: Optional[str], alone: bool = False) -> bool:
+    words = line.split()
+    if not words or len(words) > HEADING_MAX_WORDS or line[-1] in ".,;":
+        return False
+    if alone:
+        # A paragraph of one short line, e.g. a DOCX heading or a slide title,
+        # but not a label and its value such as a slide's notes
+        if _HEADING_RE.match(line):
+            return True
+        return ": " not in line and (line[0].isupper() or line[0] in "¿¡")
+    # Inside a paragraph, e.g. a PDF page, only at its start or after a finished sentence
+    if previous is not None and previous[-1] not in ".!?:…":
+        return False
+    return bool(_HEADING_RE.match(line)) or (line.isupper() and any(c.isalpha() for c in line))
+
+
+def _is_table(lines: List[str]) -> bool:
+    # Tables are extracted as one line per row with ` | ` between cells
+    return len(lines) >= 2 and sum(" | " in line for line in lines) * 2 > len(lines)
+
+
+def _block_units(block: str, max_tokens: int, count: Callable[[str], int]) -> Iterator[_Unit]:
+    lines = [line.strip() for line in block.splitlines() if line.strip()]
+    if _is_table(lines):
+        header = None
+        for position, row in enumerate(lines):
+            tokens = count(row)
+            if tokens > max_tokens // 2:
+                # A row too long to repeat or to share a chunk with its header
+                yield from _text_units(row, BLOCK if position == 0 else LINE, max_tokens, count, level=1)
+                continue
+            unit = _Unit(row, tokens, BLOCK if position == 0 else LINE, keep_with_next=position == 0, header=header)
+            if position == 0:
+                header = unit
+            yield unit
+        return
+    if len(lines) == 1:
+        if _is_heading(lines[0], None, alone=True):
+            yield _Unit(lines[0], count(lines[0]), BLOCK, heading=True, keep_with_next=True)
+        else:
+            yield from _text_units(lines[0], BLOCK, max_tokens, count)
+        return
+    # Split the paragraph at the headings inside it
+    paragraph: List[str] = []
+    previous = None
+    for line in lines:
+        if _is_heading(line, previous):
+            if paragraph:
+                yield from _text_units("\n".join(paragraph), BLOCK, max_tokens, count)
+            yield _Unit(line, count(line), BLOCK, heading=True, keep_with_next=True)
+            paragraph = []
+        else:
+            paragraph.append(line)
+        previous = line
+    if paragraph:
+        yield from _text_units("\n".join(paragraph), BLOCK, max_tokens, count)
+
+
+def _units(text: str, max_tokens: int, count: Callable[[str], int]) -> Iterator[_Unit]:
+    for block in _BLANK_LINE_RE.split(text):
+        if block.strip():
+            yield from _block_units(block, max_tokens, count)
+
+
+def _join(units: List[_Unit]) -> str:
+    return "".join(unit.text if position == 0 else unit.joiner + unit.text for position, unit in enumerate(units))
+
+
+def _size(units: List[_Unit]) -> int:
+    # Each joiner is about a token
+    return sum(unit.tokens for unit in units) + max(0, len(units) - 1)
+
+
+def _pack(units: Iterable[_Unit], max_tokens: int, overlap_tokens: int) -> Iterator[str]:
+    """Pack units into chunks of at most `max_tokens` tokens, repeating up to `overlap_tokens` at each break."""
+    current: List[_Unit] = []
+    # Units of `current` that were not in the previous chunk, and `_size(current)`
+    fresh = size = 0
+    for unit in units:
+        if unit.heading and fresh and not all(u.heading for u in current):
+            # A section starts a chunk of its own; no overlap with the previous section
+            yield _join(current)
+            current, fresh = [], 0
+        elif current and size + 1 + unit.tokens > max_tokens:
+            # Headings and header rows the chunk would end with go to the next one
+            trailing = 0
+            while trailing < len(current) and current[-1 - trailing].keep_with_next:
+                trailing += 1
+            kept, carried = current[:len(current) - trailing], current[len(current) - trailing:]
+            if kept and fresh > trailing:
+                yield _join(kept)
+                tail: List[_Unit] = []
+                if not carried:
+                    for previous in reversed(kept):
+                        if _size([previous] + tail) > overlap_tokens:
+                            break
+                        tail.insert(0, previous)
+                current = tail + carried
+            else:
+                current = carried
+            fresh = len(carried)
+            if unit.header is not None and unit.header not in current:
+                current.insert(0, unit.header)
+            # Drop the repeated units that leave no room, then the carried ones if still needed
+            while len(current) > fresh and _size(current) + 1 + unit.tokens > max_tokens:
+                current.pop(0)
+            if current and _size(current) + 1 + unit.tokens > max_tokens:
+                yield _join(current)
+                current, fresh = [], 0
+            size = _size(current)
+        current.append(unit)
+        fresh += 1
+        size = unit.tokens if len(current) == 1 else size + 1 + unit.tokens
+    if fresh:
+        yield _join(current)
+
+
+def iter_chunks(parts: Iterable['Document'], max_tokens: int, overlap_tokens: int = 0,
+                count: Optional[Callable[[str], int]] = None) -> Iterator['Document']:
+    """
+    Split extracted documents into chunks of at most `max_tokens` tokens, one part at a time.
+
+    Parameters:
+    parts (Iterable[Document]): The extracted parts, e.g. the pages of a PDF or the slides of a PPTX.
+    max_tokens (int): The most tokens of a chunk.
+    overlap_tokens (int): The most tokens of the previous chunk repeated at the start of the next one
+    of the same section; only whole paragraphs, sentences or rows are repeated.
+    count (Callable[[str], int]): Counts the tokens of a text, by default with the embedding models' encoding.
+
+    Returns:
+    Iterator[Document]: The chunks, in order, each with the metadata of its part.
+    """
+    from langchain.schema.document import Document
+    count = count or token_counter()
+    for part in parts:
+        for text in _pack(_units(part.page_content, max_tokens, count), max_tokens, overlap_tokens):
+            if text.strip():
+                yield Document(page_content=text, metadata=dict(part.metadata))
@@ -0,0 +1,173 @@
+import importlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from app.metrics import log_event
+
+# Heavy modules that are otherwise imported on first use. In preload mode they
+# are imported once in the gunicorn master and shared copy-on-write by the workers.
+PRELOAD_MODULES = (
+    "langchain.document_loaders",
+    "tiktoken",
+    "unstructured.partition.auto",
+    "pinecone",
+    "boto3",
+)
+
+_clients: Dict[str, Any] = {}
+_indexes: Dict[str, Any] = {}
+_lock = threading.Lock()
+
+# Filled in while the app starts; served by /admin/startup/ and logged once ready
+startup_report: Dict[str, Any] = {"pid": os.getpid(), "preloaded": False, "imports": {}, "clients": {}}
+
+
+def preload_enabled() -> bool:
+    """Whether `PRELOAD_APP` asks for heavy modules to be imported before the workers fork."""
+    return os.environ.get('PRELOAD_APP', '').lower() in ("1", "true", "yes")
+
+
+def preload_modules() -> Dict[str, float]:
+    """
+    Import the heavy parser and SDK modules up front and report the time spent on each.
+
+    Modules that are not installed are skipped, since the parsers that need
+    them fail on their own when they are actually used.
+    """
+    timings = {}
+    for module in PRELOAD_MODULES:
+        started = time.perf_counter()
+        try:
+            importlib.import_module(module)
+        except ImportError as e:
+            logging.warning(f"Could not preload {module}: {e}")
+            continue
+        timings[module] = round(time.perf_counter() - started, 4)
+    startup_report["preloaded"] = True
+    startup_report["imports"] = timings
+    return timings
+
+
+def _create_openai() -> Any:
+    from app.utils import initialize_openai
+    return initialize_openai()
+
+
+def _create_s3() -> Any:
+    from app.s3_operations import initialize_s3_client
+    return initialize_s3_client()
+
+
+def _create_pinecone() -> Any:
+    import pinecone
+    pinecone.init(
+        api_key=os.environ.get('PINECONE_API_KEY'),
+        environment=os.environ.get('PINECONE_API_ENV')
+    )
+    return pinecone
+
+
+_FACTORIES: Dict[str, Callable[[], Any]] = {
+    "openai": _create_openai,
+    "s3": _create_s3,
+    "pinecone": _create_pinecone,
+}
+
+
+# One lock per client so the clients can be created concurrently
+_creation_locks = {name: threading.Lock() for name in _FACTORIES}
+
+
+def _get(name: str) -> Any:
+    client = _clients.get(name)
+    if client is None:
+        with _creation_locks[name]:
+            client = _clients.get(name)
+            if client is None:
+                started = time.perf_counter()
+                client = _clients[name] = _FACTORIES[name]()
+                startup_report["clients"][name] = round(time.perf_counter() - started, 4)
+    return client
+
+
+def get_openai_client() -> Any:
+    """Return the OpenAI client shared by this worker."""
+    return _get("openai")
+
+
+def get_s3_client() -> Any:
+    """Return the S3 client shared by this worker."""
+    return _get("s3")
+
+
+def initialize_pinecone() -> None:
+    """Initialize Pinecone once per worker; later calls are no-ops."""
+    _get("pinecone")
+
+
+def get_pinecone_index(index_name: str) -> Any:
+    """Return a cached `pinecone.Index` handle, initializing Pinecone if necessary."""
+    index = _indexes.get(index_name)
+    if index is None:
+        pinecone = _get("pinecone")
+        with _lock:
+            index = _indexes.get(index_name)
+            if index is None:
+                index = _indexes[index_name] = pinecone.Index(index_name)
+    return index
+
+
+def register_client(name: str, client: Any) -> None:
+    """Use an already constructed client (e.g. a preconfigured one) instead of creating it."""
+    if name not in _FACTORIES:
+        raise ValueError(f"Unknown client: {name}")
+    with _lock:
+        _clients[name] = client
+
+
+def initialize_clients() -> Dict[str, Any]:
+    """
+    Create every client that is not created yet, concurrently.
+
+    Called from the application lifespan so each worker builds its clients
+    once, after gunicorn has forked it.
+
+    Returns:
+    dict: The startup report.
+    """
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(_FACTORIES), thread_name_prefix="client-init") as executor:
+        futures = {name: executor.submit(_get, name) for name in _FACTORIES}
+        for name, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                # A missing client only breaks the routes that need it; the
+                # next use retries the creation
+                logging.error(f"Failed to initialize the {name} client: {e}")
+    startup_report["clients_seconds"] = round(time.perf_counter() - started, 4)
+    startup_report["pid"] = os.getpid()
+    return startup_report
+
+
+def close_clients() -> None:
+    """Close the clients that hold connection pools and forget every client."""
+    with _lock:
+        openai_client = _clients.get("openai")
+        if openai_client is not None and hasattr(openai_client, "close"):
+            try:
+                openai_client.close()
+            except Exception as e:
+                logging.error(f"Error closing the OpenAI client: {e}")
+        _clients.clear()
+        _indexes.clear()
+
+
+def report_startup(**fields: Any) -> None:
+    """Add `fields` to the startup report and log it as one structured event."""
+    startup_report.update(fields)
+    log_event("startup", **startup_report)
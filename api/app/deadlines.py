@@ -0,0 +1,215 @@
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from typing import Callable, Deque, Dict, Iterator, Optional, TypeVar
+
+from app.metrics import Counter
+from app.profiling import profile_thread
+
+# A chat request has an overall time budget. Every upstream call it makes is
+# bounded by what is left of it, and by the cap of its stage, so one stalled
+# call cannot hold the request until the worker timeout. Idempotent calls
+# (embedding, vector search) are hedged: when the first attempt is slower
+# than the stage's recent p95, a duplicate is sent and the first to succeed
+# wins.
+
+# Seconds a /chat/ request may take end to end, including the wait for admission
+CHAT_DEADLINE_SECONDS = float(os.environ.get('CHAT_DEADLINE_SECONDS', '30'))
+# Longest each stage may take, also outside a chat request (ingestion, cache warming)
+STAGE_TIMEOUTS = {
+    "embedding": float(os.environ.get('EMBEDDING_TIMEOUT', '5')),
+    "search": float(os.environ.get('SEARCH_TIMEOUT', '5')),
+    "completion": float(os.environ.get('COMPLETION_TIMEOUT', '60')),
+}
+# A completion is not started with less than this left of the budget; the answer is degraded instead
+MIN_COMPLETION_SECONDS = float(os.environ.get('MIN_COMPLETION_SECONDS', '3'))
+HEDGING_ENABLED = os.environ.get('HEDGE_REQUESTS', '1').lower() not in ("0", "false", "no")
+# Hedges are sent once an attempt is slower than this percentile of the stage's recent latencies
+HEDGE_PERCENTILE = 0.95
+HEDGE_WINDOW = 200
+# Until a stage has this many samples its hedge delay is DEFAULT_HEDGE_DELAY
+HEDGE_MIN_SAMPLES = 20
+DEFAULT_HEDGE_DELAY = 1.0
+MIN_HEDGE_DELAY = 0.05
+# Threads running hedged attempts, two per admitted chat request
+HEDGE_THREADS = 64
+# Extra time given to the HTTP timeout of an attempt, so the stage deadline
+# always expires first and is reported as such
+TIMEOUT_GRACE = 1.0
+
+T = TypeVar("T")
+
+HEDGED_CALLS = Counter(
+    "chatpdf_hedged_calls_total", "Duplicate attempts sent for slow idempotent calls, by stage and winner.",
+    ("stage", "winner"))
+DEADLINES_EXCEEDED = Counter(
+    "chatpdf_deadlines_exceeded_total", "Stages abandoned because their deadline passed.", ("stage",))
+
+
+class DeadlineExceeded(TimeoutError):
+    """A stage did not finish within its deadline."""
+
+    def __init__(self, stage: str) -> None:
+        super().__init__(f"Deadline exceeded in stage {stage}")
+        self.stage = stage
+
+
+_deadline: ContextVar[Optional[float]] = ContextVar("chatpdf_deadline", default=None)
+# Set in the threads of hedged attempts; a lost attempt stops retrying once it is set
+_abandoned: ContextVar[Optional[threading.Event]] = ContextVar("chatpdf_abandoned", default=None)
+
+
+@contextmanager
+def deadline_scope(seconds: float) -> Iterator[None]:
+    """Give the work done inside the block, in this thread and the threads it hands work to, `seconds` to finish."""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> float:
+    """Seconds left before the current deadline; infinite outside a deadline scope."""
+    deadline = _deadline.get()
+    return math.inf if deadline is None else deadline - time.monotonic()
+
+
+def attempt_abandoned() -> bool:
+    """Whether this thread runs a hedged attempt whose result is no longer wanted."""
+    abandoned = _abandoned.get()
+    return abandoned is not None and abandoned.is_set()
+
+
+def stage_timeout(stage: str) -> float:
+    """
+    The seconds a stage may take: its cap, bounded by what is left of the deadline.
+
+    Raises:
+    DeadlineExceeded: When nothing is left.
+    """
+    timeout = min(STAGE_TIMEOUTS[stage], remaining())
+    if timeout <= 0:
+        DEADLINES_EXCEEDED.inc(stage=stage)
+        raise DeadlineExceeded(stage)
+    return timeout
+
+
+class _LatencyWindow:
+    """The most recent successful latencies of a stage."""
+
+    def __init__(self) -> None:
+        self._samples: Deque[float] = deque(maxlen=HEDGE_WINDOW)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds: float) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+
+    def hedge_delay(self) -> float:
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return DEFAULT_HEDGE_DELAY
+        return max(MIN_HEDGE_DELAY, samples[min(len(samples) - 1, int(HEDGE_PERCENTILE * len(samples)))])
+
+
+_latencies: Dict[str, _LatencyWindow] = {stage: _LatencyWindow() for stage in STAGE_TIMEOUTS}
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=HEDGE_THREADS, thread_name_prefix="hedge")
+        return _executor
+
+
+def hedge_delay(stage: str) -> float:
+    """Seconds after which a duplicate of a slow attempt of `stage` is sent."""
+    return _latencies[stage].hedge_delay()
+
+
+def hedged(stage: str, call: Callable[[float], T]) -> T:
+    """
+    Run an idempotent call within its stage deadline, hedging it when slow.
+
+    `call` receives the HTTP timeout its attempt must use. If the first
+    attempt has not finished after the stage's hedge delay, a second one is
+    sent and the first success is returned. The other attempt is cancelled if
+    it has not started, and otherwise abandoned: it stops at its next retry
+    and its HTTP timeout bounds how long it keeps its thread.
+
+    Parameters:
+    stage (str): The stage, one of STAGE_TIMEOUTS.
+    call (Callable[[float], T]): The call, given its timeout in seconds.
+
+    Returns:
+    T: The result of the first attempt to succeed.
+
+    Raises:
+    DeadlineExceeded: When no attempt succeeded within the stage deadline.
+    Exception: The error of the last attempt, when every attempt failed before the deadline.
+    """
+    timeout = stage_timeout(stage)
+    deadline = time.monotonic() + timeout
+    abandoned = threading.Event()
+
+    def attempt() -> T:
+        _abandoned.set(abandoned)
+        started = time.monotonic()
+        with profile_thread():
+            result = call(max(0.0, deadline - started) + TIMEOUT_GRACE)
+        _latencies[stage].observe(time.monotonic() - started)
+        return result
+
+    executor = _get_executor()
+    # Each attempt runs in its own copy of the caller's context: the request's
+    # timings, usage and deadline follow it into the executor's threads
+    attempts = [executor.submit(copy_context().run, attempt)]
+    pending = set(attempts)
+    error: Optional[BaseException] = None
+    hedge_at = time.monotonic() + hedge_delay(stage) if HEDGING_ENABLED else math.inf
+    try:
+        while pending:
+            now = time.monotonic()
+            if len(attempts) == 1 and now >= hedge_at:
+                attempts.append(executor.submit(copy_context().run, attempt))
+                pending.add(attempts[-1])
+            wake = min(deadline, hedge_at) if len(attempts) == 1 else deadline
+            if wake <= now:
+                break
+            done, pending = wait(pending, timeout=wake - now, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if len(attempts) > 1:
+                        HEDGED_CALLS.inc(stage=stage, winner="hedge" if future is attempts[1] else "first")
+                    return future.result()
+                error = future.exception()
+        if not pending:
+            # Every attempt failed before the deadline, after its own retries
+            raise error
+        if len(attempts) > 1:
+            HEDGED_CALLS.inc(stage=stage, winner="none")
+        DEADLINES_EXCEEDED.inc(stage=stage)
+        raise DeadlineExceeded(stage)
+    finally:
+        abandoned.set()
+        for future in pending:
+            future.cancel()
+
+
+def shutdown_hedge_executor() -> None:
+    """Stop the threads of hedged attempts, if they were started."""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,339 @@
+import hashlib
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter as TallyCounter
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from app.metrics import Counter
+
+DEDUP_ENABLED = os.environ.get('DEDUP_ENABLED', 'true').lower() not in ("0", "false", "no")
+# Estimated Jaccard similarity above which two chunks are considered the same text
+DEDUP_THRESHOLD = float(os.environ.get('DEDUP_THRESHOLD', '0.85'))
+# A line is boilerplate when it appears on at least this share of a document's pages
+BOILERPLATE_PAGE_FRACTION = float(os.environ.get('BOILERPLATE_PAGE_FRACTION', '0.5'))
+# Documents with fewer pages are too short to tell boilerplate from content
+BOILERPLATE_MIN_PAGES = 3
+
+NUM_PERMUTATIONS = 128
+# 16 bands of 8 rows: chunks with a similarity of ~0.7 or more share a band
+# with high probability, and candidates are then checked against the threshold
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+SHINGLE_WORDS = 5
+
+_MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+_MAX_HASH = np.uint64((1 << 32) - 1)
+_permutation_rng = np.random.RandomState(1)
+_PERM_A = _permutation_rng.randint(1, (1 << 61) - 1, size=NUM_PERMUTATIONS, dtype=np.uint64)
+_PERM_B = _permutation_rng.randint(0, (1 << 61) - 1, size=NUM_PERMUTATIONS, dtype=np.uint64)
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_DIGITS_RE = re.compile(r"\d+")
+_SPACE_RE = re.compile(r"\s+")
+
+BOILERPLATE_LINES = Counter(
+    "chatpdf_boilerplate_lines_removed_total", "Lines removed because they repeat across a document's pages.")
+UPLOAD_CHECKS = Counter(
+    "chatpdf_upload_checks_total", "Files looked up by content digest before ingestion, by whether they were known.",
+    ("result",))
+SKIPPED_UPLOAD_BYTES = Counter(
+    "chatpdf_upload_bytes_skipped_total", "Bytes of files not stored nor processed again because the same content was already ingested.")
+
+
+def _normalize_line(line: str) -> str:
+    # Page numbers and dates differ from page to page in otherwise identical headers
+    return _SPACE_RE.sub(" ", _DIGITS_RE.sub("#", line)).strip().lower()
+
+
+def strip_repeated_lines(pages: List[Any]) -> int:
+    """
+    Remove headers, footers and other lines repeated across the pages of one document.
+
+    Parameters:
+    pages (list): The pages of the document as langchain documents; their
+    `page_content` is modified in place.
+
+    Returns:
+    int: The number of lines removed.
+    """
+    if not DEDUP_ENABLED or len(pages) < BOILERPLATE_MIN_PAGES:
+        return 0
+    page_lines = [page.page_content.splitlines() for page in pages]
+    pages_per_line: TallyCounter = TallyCounter()
+    for lines in page_lines:
+        pages_per_line.update({_normalize_line(line) for line in lines} - {""})
+    min_pages = max(2, math.ceil(BOILERPLATE_PAGE_FRACTION * len(pages)))
+    boilerplate = {line for line, count in pages_per_line.items() if count >= min_pages}
+    if not boilerplate:
+        return 0
+
+    removed = 0
+    for page, lines in zip(pages, page_lines):
+        kept = [line for line in lines if _normalize_line(line) not in boilerplate]
+        removed += len(lines) - len(kept)
+        page.page_content = "\n".join(kept)
+    BOILERPLATE_LINES.inc(removed)
+    return removed
+
+
+def minhash_signature(text: str) -> np.ndarray:
+    """
+    MinHash signature of the word shingles of `text`.
+
+    The share of equal positions in two signatures estimates the Jaccard
+    similarity of the two texts.
+    """
+    words = [_DIGITS_RE.sub("#", word) for word in _WORD_RE.findall(text.lower())]
+    if len(words) <= SHINGLE_WORDS:
+        shingles = {" ".join(words)}
+    else:
+        shingles = {" ".join(words[i:i + SHINGLE_WORDS]) for i in range(len(words) - SHINGLE_WORDS + 1)}
+    hashes = np.array(
+        [int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=4).digest(), "little")
+         for shingle in shingles],
+        dtype=np.uint64)
+    # Universal hashing (a * x + b) mod p, one permutation per row; uint64 wrap-around is intended
+    permuted = np.bitwise_and((np.outer(hashes, _PERM_A) + _PERM_B) % _MERSENNE_PRIME, _MAX_HASH)
+    return permuted.min(axis=0).astype(np.uint32)
+
+
+def _band_keys(signature: np.ndarray) -> List[bytes]:
+    return [
+        hashlib.blake2b(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS].tobytes(), digest_size=8).digest()
+        for band in range(LSH_BANDS)
+    ]
+
+
+class DedupIndex:
+    """
+    Persistent MinHash/LSH index of the chunks stored in the vector index.
+
+    Signatures are banded so a lookup only compares a chunk against the few
+    stored chunks that share a band with it. The index is a local SQLite file
+    shared by the workers of this instance.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_signatures ("
+                " chunk_id TEXT PRIMARY KEY,"
+                " document TEXT,"
+                " signature BLOB NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS lsh_bands ("
+                " band INTEGER NOT NULL,"
+                " bucket BLOB NOT NULL,"
+                " chunk_id TEXT NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS lsh_bands_bucket ON lsh_bands (band, bucket)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_documents ("
+                " chunk_id TEXT NOT NULL,"
+                " document TEXT NOT NULL,"
+                " PRIMARY KEY (chunk_id, document))"
+            )
+
+    def find(self, signature: np.ndarray, threshold: float = DEDUP_THRESHOLD) -> Optional[Tuple[str, Optional[str], float]]:
+        """Return (chunk id, document, similarity) of the most similar stored chunk above `threshold`."""
+        with self._lock:
+            candidates = {
+                row[0] for band, key in enumerate(_band_keys(signature))
+                for row in self._conn.execute(
+                    "SELECT chunk_id FROM lsh_bands WHERE band = ? AND bucket = ?", (band, key))
+            }
+            if not candidates:
+                return None
+            placeholders = ",".join("?" * len(candidates))
+            rows = self._conn.execute(
+                f"SELECT chunk_id, document, signature FROM chunk_signatures WHERE chunk_id IN ({placeholders})",
+                tuple(candidates)).fetchall()
+        best = None
+        for chunk_id, document, stored in rows:
+            similarity = float(np.mean(np.frombuffer(stored, dtype=np.uint32) == signature))
+            if similarity >= threshold and (best is None or similarity > best[2]):
+                best = (chunk_id, document, similarity)
+        return best
+
+    def add(self, chunk_id: str, signature: np.ndarray, document: Optional[str]) -> None:
+        """Index a chunk that was stored in the vector index."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO chunk_signatures (chunk_id, document, signature, created_at)"
+                " VALUES (?, ?, ?, ?)", (chunk_id, document, signature.tobytes(), time.time()))
+            self._conn.executemany(
+                "INSERT INTO lsh_bands (band, bucket, chunk_id) VALUES (?, ?, ?)",
+                [(band, key, chunk_id) for band, key in enumerate(_band_keys(signature))])
+            if document:
+                self._conn.execute(
+                    "INSERT OR IGNORE INTO chunk_documents (chunk_id, document) VALUES (?, ?)", (chunk_id, document))
+
+    def link(self, chunk_id: str, document: str) -> None:
+        """Record that `document` also contains the text of a stored chunk."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO chunk_documents (chunk_id, document) VALUES (?, ?)", (chunk_id, document))
+
+    def documents(self, chunk_id: str) -> List[str]:
+        """The documents containing the text of a stored chunk, first the one it was stored for."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT document FROM chunk_documents WHERE chunk_id = ? ORDER BY rowid", (chunk_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def chunks_after(self, mark: int) -> List[Tuple[int, str]]:
+        """The (position, chunk id) of the chunks indexed after position `mark`, in order; 0 lists them all."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT rowid, chunk_id FROM chunk_signatures WHERE rowid > ? ORDER BY rowid", (mark,)).fetchall()
+
+    def links_after(self, mark: int) -> List[Tuple[int, str, str]]:
+        """The (position, chunk id, document) of the links recorded after position `mark`, in order."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT rowid, chunk_id, document FROM chunk_documents WHERE rowid > ? ORDER BY rowid",
+                (mark,)).fetchall()
+
+    def document_chunks(self, document: str) -> List[str]:
+        """The chunks containing text of a document, in the order they were stored or linked."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_id FROM chunk_documents WHERE document = ? ORDER BY rowid", (document,)).fetchall()
+        return [row[0] for row in rows]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            chunks = self._conn.execute("SELECT COUNT(*) FROM chunk_signatures").fetchone()[0]
+            links = self._conn.execute("SELECT COUNT(*) FROM chunk_documents").fetchone()[0]
+        return {"chunks": chunks, "document_links": links}
+
+
+class FileIndex:
+    """
+    The files ingested so far by content digest, and the documents linked to each user.
+
+    Clients look files up by SHA-256 and size before uploading them: a file
+    already ingested, under any name, is linked to the user instead of being
+    uploaded, stored in S3 and embedded again. It shares the dedup database.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS ingested_files ("
+                " sha256 TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " document TEXT NOT NULL,"
+                " ingested_at REAL NOT NULL,"
+                " PRIMARY KEY (sha256, size))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS ingested_files_document ON ingested_files (document)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS user_documents ("
+                " user TEXT NOT NULL,"
+                " document TEXT NOT NULL,"
+                " linked_at REAL NOT NULL,"
+                " PRIMARY KEY (user, document))"
+            )
+
+    def find(self, sha256: str, size: int) -> Optional[str]:
+        """Return the document a file with this content was ingested as, if any."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT document FROM ingested_files WHERE sha256 = ? AND size = ?", (sha256.lower(), size)).fetchone()
+        return row[0] if row else None
+
+    def add(self, sha256: str, size: int, document: str) -> None:
+        """Record the content of a document that was ingested; it replaces the previous content of that name."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM ingested_files WHERE document = ?", (document,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO ingested_files (sha256, size, document, ingested_at) VALUES (?, ?, ?, ?)",
+                (sha256.lower(), size, document, time.time()))
+
+    def link_user(self, user: str, document: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO user_documents (user, document, linked_at) VALUES (?, ?, ?)",
+                (user, document, time.time()))
+
+    def user_documents(self, user: str) -> List[Dict[str, Any]]:
+        """The documents linked to a user, oldest first."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT document, linked_at FROM user_documents WHERE user = ? ORDER BY linked_at", (user,)).fetchall()
+        return [{"document": document, "linked_at": linked_at} for document, linked_at in rows]
+
+
+_index: Optional[DedupIndex] = None
+_file_index: Optional[FileIndex] = None
+_index_lock = threading.Lock()
+
+
+def get_dedup_index() -> DedupIndex:
+    """Return the process-wide dedup index, opening it on first use."""
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = DedupIndex(os.environ.get('DEDUP_DB_PATH', 'dedup.db'))
+    return _index
+
+
+def get_file_index() -> FileIndex:
+    """Return the process-wide index of ingested files, opening it on first use."""
+    global _file_index
+    if _file_index is None:
+        with _index_lock:
+            if _file_index is None:
+                _file_index = FileIndex(os.environ.get('DEDUP_DB_PATH', 'dedup.db'))
+    return _file_index
+
+
+def link_known_file(sha256: str, size: int, user: Optional[str]) -> Optional[str]:
+    """
+    Look a file up by content and, if it was already ingested, link its document to `user`.
+
+    Parameters:
+    sha256 (str): The hex SHA-256 digest of the file.
+    size (int): The size of the file in bytes.
+    user (str): The user to link the document to, if any.
+
+    Returns:
+    Optional[str]: The document the content was ingested as, or None if it is new.
+    """
+    if not DEDUP_ENABLED:
+        return None
+    index = get_file_index()
+    document = index.find(sha256, size)
+    UPLOAD_CHECKS.inc(result="unknown" if document is None else "known")
+    if document is not None:
+        SKIPPED_UPLOAD_BYTES.inc(size)
+        if user:
+            index.link_user(user, document)
+    return document
+
+
+def record_ingested_file(document: str, sha256: Optional[str], size: Optional[int], user: Optional[str]) -> None:
+    """Record the content of a document that was just ingested, and link it to `user`."""
+    index = get_file_index()
+    if sha256 and size is not None:
+        index.add(sha256, size, document)
+    if user:
+        index.link_user(user, document)
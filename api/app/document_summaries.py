@@ -0,0 +1,125 @@
+import hashlib
+import os
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.deadlines import hedged
+from app.metrics import stage_timer
+
+# Every document gets a summary vector, the normalized mean of its chunk
+# vectors, and long documents one per section of consecutive chunks. They live
+# in their own namespace of the chunk index, so retrieval can first pick the
+# documents closest to a question and then search only their chunks.
+
+SUMMARY_NAMESPACE = os.environ.get('DOCUMENT_SUMMARY_NAMESPACE', 'document-summaries')
+# Chunks per section vector; 0 stores only the document vector
+SECTION_CHUNKS = int(os.environ.get('DOCUMENT_SECTION_CHUNKS', '8'))
+# Summary matches fetched per shortlisted document, since sections of the same
+# document often rank next to each other
+SHORTLIST_OVERFETCH = 4
+# Most ids per Pinecone fetch request
+FETCH_BATCH_SIZE = 1000
+
+
+def _centroid(vectors: Sequence[Sequence[float]]) -> List[float]:
+    matrix = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    mean = (matrix / np.where(norms == 0, 1.0, norms)).mean(axis=0)
+    return (mean / (np.linalg.norm(mean) or 1.0)).tolist()
+
+
+def summary_records(document: str, vectors: Sequence[Sequence[float]]) -> List[Tuple[str, List[float], Dict[str, Any]]]:
+    """
+    Build the summary records of a document from its chunk vectors, in document order.
+
+    Parameters:
+    document (str): The document name, as stored in the chunks' `documents` metadata.
+    vectors (Sequence[Sequence[float]]): The vectors of all the document's chunks.
+
+    Returns:
+    List[Tuple[str, List[float], Dict]]: (id, vector, metadata) records: one for
+    the whole document and, when it has more than SECTION_CHUNKS chunks, one
+    per section.
+    """
+    if not vectors:
+        return []
+    key = hashlib.sha1(document.encode()).hexdigest()
+    records = [(f"{key}-document", _centroid(vectors), {"document": document, "level": "document"})]
+    if SECTION_CHUNKS and len(vectors) > SECTION_CHUNKS:
+        for section, start in enumerate(range(0, len(vectors), SECTION_CHUNKS)):
+            records.append((f"{key}-section-{section}", _centroid(vectors[start:start + SECTION_CHUNKS]),
+                            {"document": document, "level": "section", "section": section}))
+    return records
+
+
+def fetch_vectors(index, ids: List[str]) -> Dict[str, List[float]]:
+    """Fetch the stored vectors of chunks, e.g. duplicates that were not embedded again."""
+    vectors: Dict[str, List[float]] = {}
+    for start in range(0, len(ids), FETCH_BATCH_SIZE):
+        response = index.fetch(ids=ids[start:start + FETCH_BATCH_SIZE])
+        for chunk_id, record in response["vectors"].items():
+            vectors[chunk_id] = record["values"]
+    return vectors
+
+
+def store_document_summaries(index, document: str, vectors: Sequence[Sequence[float]]) -> int:
+    """
+    Replace the summary records of a document with ones built from `vectors`.
+
+    Returns:
+    int: The number of summary records stored.
+    """
+    records = summary_records(document, vectors)
+    with stage_timer("summaries"):
+        if records:
+            index.upsert(vectors=records, namespace=SUMMARY_NAMESPACE)
+        # Drop the sections of a previous, possibly longer, version by their
+        # ids: deleting by metadata filter is not supported by every index type
+        _delete_stale_sections(index, document, max(len(records) - 1, 0),
+                               drop_document=not records)
+    return len(records)
+
+
+def _delete_stale_sections(index, document: str, first: int, drop_document: bool) -> None:
+    # Sections are numbered from 0 without gaps, so probing from the first
+    # unused number finds every section of a previous version
+    key = hashlib.sha1(document.encode()).hexdigest()
+    if drop_document:
+        index.delete(ids=[f"{key}-document"], namespace=SUMMARY_NAMESPACE)
+    while True:
+        ids = [f"{key}-section-{section}" for section in range(first, first + FETCH_BATCH_SIZE)]
+        stale = list(index.fetch(ids=ids, namespace=SUMMARY_NAMESPACE)["vectors"])
+        if stale:
+            index.delete(ids=stale, namespace=SUMMARY_NAMESPACE)
+        if len(stale) < FETCH_BATCH_SIZE:
+            return
+        first += FETCH_BATCH_SIZE
+
+
+def shortlist_documents(index, query_vector: List[float], limit: int) -> List[str]:
+    """
+    Return the documents whose summary vectors are closest to a query, best first.
+
+    Parameters:
+    index: The Pinecone index holding the chunks and the summaries.
+    query_vector (List[float]): The vector representation of the query.
+    limit (int): The most documents returned.
+
+    Returns:
+    List[str]: Up to `limit` document names; empty when no summary is stored.
+    """
+    def search(timeout: float) -> Dict[str, Any]:
+        with stage_timer("shortlist"):
+            return index.query(vector=query_vector, top_k=limit * SHORTLIST_OVERFETCH,
+                               namespace=SUMMARY_NAMESPACE, include_metadata=True, _request_timeout=timeout)
+
+    results = hedged("search", search)
+    documents: List[str] = []
+    for match in results["matches"]:
+        document: Optional[str] = (match.get("metadata") or {}).get("document")
+        if document and document not in documents:
+            documents.append(document)
+            if len(documents) == limit:
+                break
+    return documents
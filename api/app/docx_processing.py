@@ -1,13 +1,15 @@
-import boto3
-from langchain.document_loaders import UnstructuredWordDocumentLoader
 import logging
-from botocore.exceptions import ClientError
 import tempfile
-from langchain.schema.document import Document
-from typing import Tuple, List
+from app.metrics import stage_timer
+from app.ooxml import load_ooxml
+from typing import Tuple, List, TYPE_CHECKING
 
+if TYPE_CHECKING:
+    import boto3
+    from langchain.schema.document import Document
 
-def process_docx(s3_client: boto3.client, bucket_name: str, file_key: str) -> Tuple[List[Document], str]:
+
+def process_docx(s3_client: 'boto3.client', bucket_name: str, file_key: str) -> Tuple[List['Document'], str]:
     """
     Download a .docx file from an S3 bucket, process it to extract text, and return the extracted text and temporary file path.
 
@@ -19,12 +21,15 @@ def process_docx(s3_client: boto3.client, bucket_name: str, file_key: str) -> Tu
     Returns:
     tuple: A tuple containing the extracted text data and the temporary file path of the downloaded DOCX.
     """
+    from botocore.exceptions import ClientError
+
     try:
         logging.info(f"Downloading DOCX from S3: {file_key}")
 
         # Download the DOCX from S3
-        s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        docx_file_bytes = s3_object['Body'].read()
+        with stage_timer("s3_download"):
+            s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+            docx_file_bytes = s3_object['Body'].read()
 
         # Create a temporary file to store the DOCX
         with tempfile.NamedTemporaryFile(delete=False, suffix='.docx') as temp_docx_file:
@@ -34,8 +39,9 @@ def process_docx(s3_client: boto3.client, bucket_name: str, file_key: str) -> Tu
         logging.info(f"Processing DOCX: {file_key}")
 
         # Process the DOCX
-        loader = UnstructuredWordDocumentLoader(temp_docx_path)
-        data = loader.load()
+        with stage_timer("parse"):
+            # Read natively from the archive; Unstructured only if that fails
+            data = load_ooxml(temp_docx_path, "docx")
 
         logging.info(f"DOCX processed successfully: {file_key}")
 
@@ -0,0 +1,536 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from app.clients import get_pinecone_index, initialize_pinecone
+from app.metrics import log_event
+from app.query_cache import QUERY_CACHE_ENABLED, get_query_cache
+
+# The embedding model and the length of its vectors are configured here and
+# nowhere else. Each vector index holds the vectors of one model and records
+# which in a metadata record, so queries are always embedded like the chunks
+# of the index they search. Changing the configuration does not touch the
+# active index: a migration re-embeds the corpus into a new index, which
+# then replaces it. Which index is active is recorded in Pinecone, where
+# every instance reads it, so a switch made on one instance reaches all; so is
+# the last change of the corpus, which makes every instance's cached answers
+# stale.
+
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'text-embedding-ada-002')
+# Length of the vectors; 0 keeps the model's own. Only the text-embedding-3
+# models can shorten their vectors
+EMBEDDING_DIMENSIONS = int(os.environ.get('EMBEDDING_DIMENSIONS', '0'))
+
+NATIVE_DIMENSIONS = {
+    "text-embedding-ada-002": 1536,
+    "text-embedding-3-small": 1536,
+    "text-embedding-3-large": 3072,
+}
+# Indexes created before models were recorded hold ada-002 vectors
+LEGACY_MODEL = "text-embedding-ada-002"
+
+# Namespace and id of the record describing the vectors of an index
+METADATA_NAMESPACE = 'index-metadata'
+METADATA_ID = 'embedding'
+# Id of the record naming the active index, in the metadata namespace of the
+# YOUR_INDEX_NAME index; without it, that index is the active one
+ACTIVE_POINTER_ID = 'active-index'
+# Id of the record changed by every ingestion, next to the active index record
+CORPUS_CHANGE_ID = 'corpus-change'
+# Seconds between two reads of the active index by a worker's watcher thread
+ACTIVE_INDEX_REFRESH = float(os.environ.get('ACTIVE_INDEX_REFRESH', '10'))
+# Longest a read of the active index may take; the last one read is used meanwhile
+ACTIVE_INDEX_READ_TIMEOUT = float(os.environ.get('ACTIVE_INDEX_READ_TIMEOUT', '5'))
+
+# Index states in the registry
+BUILDING, ACTIVE, RETIRED, FAILED = "building", "active", "retired", "failed"
+
+
+class EmbeddingSpec(NamedTuple):
+    """An embedding model and the length of the vectors it is asked for."""
+
+    model: str
+    dimensions: int
+
+    @property
+    def shortened(self) -> bool:
+        return self.dimensions != NATIVE_DIMENSIONS.get(self.model)
+
+    def request_options(self) -> Dict[str, Any]:
+        """The arguments of an embeddings request producing vectors of this spec."""
+        options: Dict[str, Any] = {"model": self.model}
+        if self.shortened:
+            # Sent as an extra field: the pinned client predates the parameter
+            options["extra_body"] = {"dimensions": self.dimensions}
+        return options
+
+
+def parse_embedding_spec(model: str, dimensions: int = 0) -> EmbeddingSpec:
+    """
+    Build a validated spec; `dimensions` 0 means the model's own.
+
+    Raises:
+    ValueError: If the model is unknown and no dimensions are given, or it cannot produce them.
+    """
+    native = NATIVE_DIMENSIONS.get(model)
+    if not dimensions:
+        if native is None:
+            raise ValueError(f"Unknown embedding model {model}: set EMBEDDING_DIMENSIONS")
+        return EmbeddingSpec(model, native)
+    if dimensions < 1 or (native is not None and dimensions > native):
+        raise ValueError(f"{model} cannot produce vectors of {dimensions} dimensions")
+    if model == LEGACY_MODEL and dimensions != native:
+        raise ValueError(f"{model} cannot shorten its vectors")
+    return EmbeddingSpec(model, dimensions)
+
+
+def configured_spec() -> EmbeddingSpec:
+    """The spec set by EMBEDDING_MODEL and EMBEDDING_DIMENSIONS, the one new indexes are built with."""
+    return parse_embedding_spec(EMBEDDING_MODEL, EMBEDDING_DIMENSIONS)
+
+
+class VectorIndex(NamedTuple):
+    """A vector index and the spec of the vectors it holds."""
+
+    name: str
+    spec: EmbeddingSpec
+
+
+def read_index_spec(index) -> Optional[EmbeddingSpec]:
+    """The spec recorded in an index's metadata record, or None if it has none."""
+    record = index.fetch(ids=[METADATA_ID], namespace=METADATA_NAMESPACE)["vectors"].get(METADATA_ID)
+    if record is None:
+        return None
+    metadata = record["metadata"]
+    return EmbeddingSpec(metadata["model"], int(metadata["dimensions"]))
+
+
+def write_index_spec(index, spec: EmbeddingSpec) -> None:
+    """Record the spec of an index's vectors in its metadata record."""
+    index.upsert(vectors=[(METADATA_ID, _metadata_vector(spec.dimensions), {"model": spec.model, "dimensions": spec.dimensions,
+                                                 "recorded_at": time.time()})],
+                 namespace=METADATA_NAMESPACE)
+
+
+def _metadata_vector(dimensions: int) -> List[float]:
+    # Metadata records need a vector of the index's length; cosine indexes refuse zero vectors
+    return [1.0] + [0.0] * (dimensions - 1)
+
+
+def read_shared_state(timeout: Optional[float] = None) -> Tuple[Optional[VectorIndex], Optional[float]]:
+    """
+    Read the records every instance shares, in one request.
+
+    Returns:
+    Tuple[Optional[VectorIndex], Optional[float]]: The active index, or None
+    if no switch was recorded yet, and the value of the last corpus change,
+    or None if none was recorded.
+    """
+    name = os.environ.get('YOUR_INDEX_NAME')
+    if not index_exists(name):
+        return None, None
+    options = {"_request_timeout": timeout} if timeout is not None else {}
+    records = get_pinecone_index(name).fetch(
+        ids=[ACTIVE_POINTER_ID, CORPUS_CHANGE_ID], namespace=METADATA_NAMESPACE, **options)["vectors"]
+    current = None
+    if ACTIVE_POINTER_ID in records:
+        metadata = records[ACTIVE_POINTER_ID]["metadata"]
+        current = VectorIndex(metadata["index"], EmbeddingSpec(metadata["model"], int(metadata["dimensions"])))
+    change = records[CORPUS_CHANGE_ID]["metadata"]["changed_at"] if CORPUS_CHANGE_ID in records else None
+    return current, change
+
+
+def _write_shared_record(index, record_id: str, metadata: Dict[str, Any]) -> None:
+    spec = read_index_spec(index)
+    dimensions = spec.dimensions if spec is not None else int(index.describe_index_stats()["dimension"])
+    index.upsert(vectors=[(record_id, _metadata_vector(dimensions), metadata)], namespace=METADATA_NAMESPACE)
+
+
+def write_active_pointer(current: VectorIndex) -> None:
+    """Record `current` as the active index of every instance; one upsert, so the switch is atomic."""
+    name = os.environ.get('YOUR_INDEX_NAME')
+    if not index_exists(name):
+        # The pointer lives in the well-known index even once it is no longer searched
+        create_vector_index(name, current.spec)
+    _write_shared_record(get_pinecone_index(name), ACTIVE_POINTER_ID,
+                         {"index": current.name, "model": current.spec.model,
+                          "dimensions": current.spec.dimensions, "activated_at": time.time()})
+
+
+def write_corpus_change(change: float) -> None:
+    """Record a change of the corpus for every instance; nothing is recorded before the index exists."""
+    name = os.environ.get('YOUR_INDEX_NAME')
+    if index_exists(name):
+        _write_shared_record(get_pinecone_index(name), CORPUS_CHANGE_ID, {"changed_at": change})
+
+
+def create_vector_index(name: str, spec: EmbeddingSpec) -> Any:
+    """Create an index for vectors of `spec`, unless it exists, and record the spec in it."""
+    pinecone = _pinecone()
+    if name not in pinecone.list_indexes():
+        pinecone.create_index(name=name, dimension=spec.dimensions, metric="cosine")
+        log_event("index_created", index=name, model=spec.model, dimensions=spec.dimensions)
+    index = get_pinecone_index(name)
+    write_index_spec(index, spec)
+    return index
+
+
+def index_exists(name: str) -> bool:
+    return name in _pinecone().list_indexes()
+
+
+def _pinecone() -> Any:
+    import pinecone
+    initialize_pinecone()
+    return pinecone
+
+
+class IndexRegistry:
+    """
+    SQLite-backed registry of the vector indexes of this deployment, shared by
+    the workers of this instance: which one is active, and the ones being
+    built by a migration or replaced by one.
+
+    Exactly one index is active at a time; activating another one retires it
+    in the same transaction. Other instances follow the active index recorded
+    in Pinecone, see `active_index`.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS vector_indexes ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " name TEXT NOT NULL UNIQUE,"
+                " model TEXT NOT NULL,"
+                " dimensions INTEGER NOT NULL,"
+                " status TEXT NOT NULL,"
+                " progress TEXT,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL,"
+                " activated_at REAL)"
+            )
+
+    def active(self) -> Optional[VectorIndex]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, model, dimensions FROM vector_indexes WHERE status = ?", (ACTIVE,)).fetchone()
+        return VectorIndex(row[0], EmbeddingSpec(row[1], row[2])) if row else None
+
+    def bootstrap(self, name: str, spec: EmbeddingSpec) -> VectorIndex:
+        """Register `name` as the active index unless one is; return the active index."""
+        now = time.time()
+        with self._lock, self._conn:
+            if self._conn.execute("SELECT 1 FROM vector_indexes WHERE status = ?", (ACTIVE,)).fetchone() is None:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO vector_indexes"
+                    " (name, model, dimensions, status, created_at, updated_at, activated_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)", (name, spec.model, spec.dimensions, ACTIVE, now, now, now))
+        return self.active()
+
+    def start_building(self, spec: EmbeddingSpec, base_name: str, stale_after: float) -> Optional[str]:
+        """
+        Register a new index for a migration and return its name, or None if
+        another migration updated its progress less than `stale_after` seconds ago.
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            running = self._conn.execute(
+                "SELECT name, updated_at FROM vector_indexes WHERE status = ?", (BUILDING,)).fetchall()
+            if any(now - updated_at < stale_after for _, updated_at in running):
+                return None
+            # The worker running them is gone
+            self._conn.execute(
+                "UPDATE vector_indexes SET status = ?, error = 'abandoned', updated_at = ? WHERE status = ?",
+                (FAILED, now, BUILDING))
+            number = self._conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM vector_indexes").fetchone()[0]
+            name = f"{base_name}-v{number}"
+            self._conn.execute(
+                "INSERT INTO vector_indexes (name, model, dimensions, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)", (name, spec.model, spec.dimensions, BUILDING, now, now))
+        return name
+
+    def update(self, name: str, status: Optional[str] = None, progress: Optional[str] = None,
+               error: Optional[str] = None) -> None:
+        """Record the progress of an index being built; also serves as its heartbeat."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE vector_indexes SET status = COALESCE(?, status), progress = COALESCE(?, progress),"
+                " error = COALESCE(?, error), updated_at = ? WHERE name = ?",
+                (status, progress, error, time.time(), name))
+
+    def get(self, name: str) -> Optional[VectorIndex]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT name, model, dimensions FROM vector_indexes WHERE name = ?", (name,)).fetchone()
+        return VectorIndex(row[0], EmbeddingSpec(row[1], row[2])) if row else None
+
+    def activate(self, name: str) -> None:
+        """Make `name` the active index and retire the previous one, in one transaction."""
+        with self._lock, self._conn:
+            if self._conn.execute("SELECT 1 FROM vector_indexes WHERE name = ?", (name,)).fetchone() is None:
+                raise KeyError(name)
+            self._activate(name)
+
+    def adopt(self, current: VectorIndex) -> None:
+        """Make an index another instance activated the active one here too, registering it if needed."""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO vector_indexes (name, model, dimensions, status, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)", (current.name, current.spec.model, current.spec.dimensions,
+                                               RETIRED, now, now))
+            self._activate(current.name)
+
+    def _activate(self, name: str) -> None:
+        now = time.time()
+        self._conn.execute("UPDATE vector_indexes SET status = ?, updated_at = ? WHERE status = ?",
+                           (RETIRED, now, ACTIVE))
+        self._conn.execute(
+            "UPDATE vector_indexes SET status = ?, updated_at = ?, activated_at = ? WHERE name = ?",
+            (ACTIVE, now, now, name))
+
+    def status(self, name: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("SELECT status FROM vector_indexes WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def indexes(self) -> List[Dict[str, Any]]:
+        """Every registered index, oldest first."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT name, model, dimensions, status, progress, error, created_at, updated_at, activated_at"
+                " FROM vector_indexes ORDER BY id")
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+_registry: Optional[IndexRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_index_registry() -> IndexRegistry:
+    """Return the process-wide index registry, opening it on first use."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                _registry = IndexRegistry(os.environ.get('INDEX_DB_PATH', 'indexes.db'))
+    return _registry
+
+
+class ActiveIndexWatcher:
+    """
+    Background thread of one worker that reads the active index recorded in
+    Pinecone every ACTIVE_INDEX_REFRESH seconds.
+
+    Requests use the last pointer read and never wait on Pinecone, except
+    for the first read of the worker. Without the thread, e.g. in scripts,
+    the caller that finds the pointer stale reads it while the others keep
+    using the last one.
+
+    The thread also records this worker's ingestions in Pinecone and, when
+    it reads one made on another instance, marks the cached answers stale.
+    """
+
+    def __init__(self, interval: float = ACTIVE_INDEX_REFRESH, timeout: float = ACTIVE_INDEX_READ_TIMEOUT) -> None:
+        self.interval = interval
+        self.timeout = timeout
+        self._current: Optional[VectorIndex] = None
+        self._read_at = float("-inf")
+        self._reading = False
+        self._read = threading.Event()
+        self._change: Optional[float] = None
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        with self._condition:
+            if self._thread is None:
+                self._stopped = False
+                self._thread = threading.Thread(target=self._run, name="active-index-watcher", daemon=True)
+                self._thread.start()
+
+    def stop(self) -> None:
+        with self._condition:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+            self._condition.notify_all()
+        if thread is not None:
+            thread.join(timeout=5)
+
+    def current(self) -> Optional[VectorIndex]:
+        """The active index read last, or None if no switch was recorded."""
+        with self._condition:
+            claimed = (self._thread is None and not self._reading
+                       and time.monotonic() - self._read_at >= self.interval)
+            self._reading = self._reading or claimed
+        if claimed:
+            self._refresh()
+        else:
+            # Only waits until the worker's first read is done
+            self._read.wait(self.timeout)
+        with self._condition:
+            return self._current
+
+    def publish_corpus_change(self) -> None:
+        """Record an ingestion for every instance; by the thread, or right away without it."""
+        with self._condition:
+            self._change = time.time()
+            running = self._thread is not None
+            self._condition.notify_all()
+        if not running:
+            self._publish()
+
+    def set(self, current: VectorIndex) -> None:
+        """Use `current` right away, e.g. after this instance switched to it."""
+        with self._condition:
+            self._current, self._read_at = current, time.monotonic()
+        self._read.set()
+
+    def _refresh(self) -> None:
+        # Pinecone is read without holding the lock, so requests keep the last pointer meanwhile
+        try:
+            current, change = read_shared_state(self.timeout)
+        except Exception as e:
+            # Keep the last one read; the registry has it too
+            logging.warning(f"Could not read the active index from Pinecone: {e}")
+            with self._condition:
+                self._reading, self._read_at = False, time.monotonic()
+        else:
+            with self._condition:
+                self._reading, self._current, self._read_at = False, current, time.monotonic()
+            if change is not None:
+                _observe_corpus_change(change, local=False)
+        self._read.set()
+
+    def _publish(self) -> None:
+        with self._condition:
+            change, self._change = self._change, None
+        if change is None:
+            return
+        try:
+            write_corpus_change(change)
+        except Exception as e:
+            # Other instances serve their cached answers until QUERY_CACHE_TTL expires
+            logging.warning(f"Could not record the corpus change in Pinecone: {e}")
+            return
+        _observe_corpus_change(change, local=True)
+
+    def _run(self) -> None:
+        while True:
+            self._publish()
+            with self._condition:
+                claimed = not self._reading
+                self._reading = True
+            if claimed:
+                self._refresh()
+            with self._condition:
+                if not self._stopped and self._change is None:
+                    self._condition.wait(self.interval)
+                if self._stopped:
+                    return
+
+
+index_watcher = ActiveIndexWatcher()
+
+
+def _observe_corpus_change(change: float, local: bool) -> None:
+    if QUERY_CACHE_ENABLED and get_query_cache().observe_corpus_change(change, bump=not local):
+        log_event("corpus_change_followed", changed_at=change)
+
+
+def start_index_watcher() -> None:
+    """Start this worker's watcher thread; called from the app's lifespan, after the fork."""
+    index_watcher.start()
+
+
+def stop_index_watcher() -> None:
+    index_watcher.stop()
+
+
+def switch_active_index(name: str) -> VectorIndex:
+    """
+    Make a registered index the active one of every instance.
+
+    The switch is recorded in Pinecone first, then in this instance's
+    registry; other instances follow within ACTIVE_INDEX_REFRESH seconds.
+
+    Raises:
+    KeyError: If no index of that name is registered.
+    """
+    registry = get_index_registry()
+    current = registry.get(name)
+    if current is None:
+        raise KeyError(name)
+    write_active_pointer(current)
+    registry.activate(name)
+    index_watcher.set(current)
+    return current
+
+
+def _adopt(shared: VectorIndex) -> None:
+    """Follow a switch made on another instance."""
+    get_index_registry().adopt(shared)
+    # Imported here: the warmer depends on this module
+    from app.cache_warmer import notify_ingestion
+    if QUERY_CACHE_ENABLED:
+        # The query vectors and answers cached here came from the previous index
+        get_query_cache().forget_vectors()
+    # Every instance follows the switch, so it need not be recorded for them
+    notify_ingestion(publish=False)
+    log_event("index_switch_followed", index=shared.name, model=shared.spec.model,
+              dimensions=shared.spec.dimensions)
+
+
+def active_index() -> VectorIndex:
+    """
+    Return the index queries are searched in and documents stored in.
+
+    The active index recorded in Pinecone by the last switch, on any
+    instance, wins over this instance's registry. Before any switch, the
+    first call on an instance registers `YOUR_INDEX_NAME` with the spec
+    recorded in it; an index without a record holds ada-002 vectors and gets
+    one, and a missing index will be created with the configured spec.
+    """
+    registry = get_index_registry()
+    shared = index_watcher.current()
+    if shared is not None:
+        if registry.active() != shared:
+            _adopt(shared)
+        return shared
+    current = registry.active()
+    if current is not None:
+        return current
+    name = os.environ.get('YOUR_INDEX_NAME')
+    if index_exists(name):
+        index = get_pinecone_index(name)
+        spec = read_index_spec(index)
+        if spec is None:
+            spec = EmbeddingSpec(LEGACY_MODEL, int(index.describe_index_stats()["dimension"]))
+            write_index_spec(index, spec)
+    else:
+        spec = configured_spec()
+    current = registry.bootstrap(name, spec)
+    if current.spec != configured_spec():
+        log_event("embedding_config_mismatch", index=current.name, index_model=current.spec.model,
+                  index_dimensions=current.spec.dimensions, configured_model=EMBEDDING_MODEL,
+                  configured_dimensions=configured_spec().dimensions)
+    return current
+
+
+def open_active_index() -> Tuple[VectorIndex, Any]:
+    """Return the active index and its handle, creating the index if it does not exist yet."""
+    current = active_index()
+    if not index_exists(current.name):
+        return current, create_vector_index(current.name, current.spec)
+    return current, get_pinecone_index(current.name)
@@ -0,0 +1,232 @@
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Set, Tuple
+
+from app.cache_warmer import notify_ingestion
+from app.clients import get_openai_client, get_pinecone_index
+from app.dedup import get_dedup_index
+from app.document_summaries import fetch_vectors, store_document_summaries
+from app.embedding_index import (ACTIVE, FAILED, RETIRED, EmbeddingSpec, active_index, configured_spec,
+                                 create_vector_index, get_index_registry, switch_active_index)
+from app.metrics import Counter, background_context, log_event
+from app.pinecone_ops import embed_chunks
+from app.query_cache import QUERY_CACHE_ENABLED, get_query_cache
+from app.retrieval_config import require_score_thresholds
+
+# A migration copies every chunk of the active index into a new index, with
+# the same id and metadata and a vector from the new embedding spec, while the
+# active index keeps serving queries and ingestions. Chunks are enumerated
+# from the dedup index, which records every stored chunk and every document
+# linked to one; chunks stored meanwhile are copied in catch-up passes. Then
+# the new index is activated and, once ingestions that were already writing
+# to the old one have finished, their chunks are copied too.
+
+# Chunks fetched, re-embedded and upserted per step
+REINDEX_BATCH_SIZE = int(os.environ.get('REINDEX_BATCH_SIZE', '100'))
+# Seconds between the switch and the last catch-up pass; longer than an ingestion takes
+REINDEX_SWITCH_GRACE = float(os.environ.get('REINDEX_SWITCH_GRACE', '60'))
+# A migration that recorded no progress for this long is assumed dead
+MIGRATION_STALE_SECONDS = 300
+# Passes before the switch; a corpus still growing after them fails the migration
+MAX_CATCH_UP_PASSES = 10
+
+REINDEXED_CHUNKS = Counter("chatpdf_reindexed_chunks_total", "Chunks re-embedded into a new index by migrations.")
+
+
+class MigrationRunning(Exception):
+    """Another migration is in progress."""
+
+
+class _Copier:
+    """Copies chunks from the source to the target index, remembering how far it got."""
+
+    def __init__(self, source, target, name: str, spec: EmbeddingSpec) -> None:
+        self.source = source
+        self.target = target
+        self.name = name
+        self.spec = spec
+        self.dedup = get_dedup_index()
+        self.chunk_mark = 0
+        self.link_mark = 0
+        self.copied: Set[str] = set()
+
+    def copy_pass(self) -> Tuple[int, Set[str]]:
+        """
+        Copy the chunks indexed since the last pass and update the documents
+        of chunks linked to another document since.
+
+        Returns:
+        Tuple[int, Set[str]]: The number of chunks copied and the documents whose chunks changed.
+        """
+        chunks = self.dedup.chunks_after(self.chunk_mark)
+        links = self.dedup.links_after(self.link_mark)
+        if chunks:
+            self.chunk_mark = chunks[-1][0]
+        if links:
+            self.link_mark = links[-1][0]
+        chunk_ids = [chunk_id for _, chunk_id in chunks]
+        documents: Set[str] = set()
+        for start in range(0, len(chunk_ids), REINDEX_BATCH_SIZE):
+            documents.update(self._copy(chunk_ids[start:start + REINDEX_BATCH_SIZE]))
+            get_index_registry().update(self.name, progress=f"{len(self.copied)} chunks copied")
+        fresh = set(chunk_ids)
+        for _, chunk_id, document in links:
+            documents.add(document)
+            if chunk_id not in fresh and chunk_id in self.copied:
+                self.target.update(id=chunk_id, set_metadata={"documents": self.dedup.documents(chunk_id)})
+        return len(chunk_ids), documents
+
+    def _copy(self, chunk_ids: List[str]) -> Set[str]:
+        records = [record for record in self.source.fetch(ids=chunk_ids)["vectors"].values()
+                   if "text" in (record.get("metadata") or {})]
+        if not records:
+            return set()
+        vectors = embed_chunks(get_openai_client(), [record["metadata"]["text"] for record in records], self.spec,
+                               "reindex_embedding")
+        rows = []
+        documents: Set[str] = set()
+        for record, vector in zip(records, vectors):
+            metadata = dict(record["metadata"])
+            # The dedup index has the links recorded after the source record was read
+            metadata["documents"] = self.dedup.documents(record["id"]) or metadata.get("documents", [])
+            documents.update(metadata["documents"])
+            rows.append((record["id"], vector, metadata))
+        self.target.upsert(vectors=rows)
+        self.copied.update(record["id"] for record in records)
+        REINDEXED_CHUNKS.inc(len(rows))
+        return documents
+
+    def store_summaries(self, documents: Set[str]) -> None:
+        """Rebuild the summary vectors of documents from their chunks in the target index."""
+        for document in sorted(documents):
+            chunk_ids = self.dedup.document_chunks(document)
+            vectors = fetch_vectors(self.target, chunk_ids)
+            store_document_summaries(self.target, document,
+                                     [vectors[chunk_id] for chunk_id in chunk_ids if chunk_id in vectors])
+
+
+def _source_chunks(index) -> int:
+    # Chunks live in the default namespace; summaries and metadata in their own
+    return int(index.describe_index_stats()["namespaces"].get("", {}).get("vector_count", 0))
+
+
+def _migrate(source_name: str, name: str, spec: EmbeddingSpec, force: bool) -> Dict[str, Any]:
+    registry = get_index_registry()
+    started = time.perf_counter()
+    copier = _Copier(get_pinecone_index(source_name), create_vector_index(name, spec), name, spec)
+    documents: Set[str] = set()
+    for _ in range(MAX_CATCH_UP_PASSES):
+        copied, touched = copier.copy_pass()
+        documents |= touched
+        if not copied and not touched:
+            break
+    else:
+        raise RuntimeError(f"The corpus kept growing after {MAX_CATCH_UP_PASSES} passes")
+
+    missing = _source_chunks(copier.source) - len(copier.copied)
+    if missing > 0 and not force:
+        raise RuntimeError(f"{missing} chunks of {source_name} are not in the dedup index "
+                           "(stored with DEDUP_ENABLED=0 or on another instance); migrate with force to drop them")
+    registry.update(name, progress=f"{len(copier.copied)} chunks copied, storing summaries")
+    copier.store_summaries(documents)
+
+    switch_active_index(name)
+    if QUERY_CACHE_ENABLED:
+        # Cached query vectors were computed with the old spec
+        get_query_cache().forget_vectors()
+    notify_ingestion()
+    log_event("index_switched", source=source_name, index=name, model=spec.model, dimensions=spec.dimensions,
+              chunks=len(copier.copied))
+
+    # Ingestions that opened the old index before the switch are still storing chunks in it
+    registry.update(name, progress=f"{len(copier.copied)} chunks copied, active, waiting for the last catch-up")
+    time.sleep(REINDEX_SWITCH_GRACE)
+    copied, touched = copier.copy_pass()
+    if touched:
+        copier.store_summaries(touched)
+        notify_ingestion()
+    registry.update(name, progress=f"{len(copier.copied)} chunks copied, done")
+    return {"source": source_name, "index": name, "model": spec.model, "dimensions": spec.dimensions,
+            "chunks": len(copier.copied), "late_chunks": copied, "dropped_chunks": max(0, missing),
+            "documents": len(documents | touched), "seconds": round(time.perf_counter() - started, 4)}
+
+
+def _run_migration(source_name: str, name: str, spec: EmbeddingSpec, force: bool) -> None:
+    registry = get_index_registry()
+    with background_context("index-migration") as context:
+        try:
+            report = _migrate(source_name, name, spec, force)
+            report["cost_usd"] = round(context.usage.get("cost_usd", 0.0), 6)
+            log_event("index_migration", **report)
+        except Exception as e:
+            logging.error(f"Index migration to {name} failed: {e}")
+            # Once active the new index stays so; only its last catch-up failed
+            if registry.status(name) != ACTIVE:
+                registry.update(name, status=FAILED, error=str(e))
+            else:
+                registry.update(name, error=str(e))
+
+
+def start_migration(spec: EmbeddingSpec, force: bool = False) -> Dict[str, Any]:
+    """
+    Start re-embedding the corpus into a new index in a background thread of this worker.
+
+    Parameters:
+    spec (EmbeddingSpec): The embedding spec of the new index.
+    force (bool): Switch even if some chunks of the active index are not in
+    the dedup index and could not be copied, and migrate to the same spec.
+
+    Returns:
+    Dict[str, Any]: The active index and the name of the new one.
+
+    Raises:
+    MigrationRunning: When another migration is in progress.
+    ValueError: When the active index already holds vectors of `spec`, or no
+    score thresholds are calibrated for its model.
+    """
+    source = active_index()
+    if source.spec == spec and not force:
+        raise ValueError(f"{source.name} already holds {spec.model} vectors of {spec.dimensions} dimensions")
+    # Scores of another model would put nearly every query under min_score once switched
+    require_score_thresholds(spec.model)
+    name = get_index_registry().start_building(spec, os.environ.get('YOUR_INDEX_NAME'), MIGRATION_STALE_SECONDS)
+    if name is None:
+        raise MigrationRunning("An index migration is already in progress")
+    log_event("index_migration_started", source=source.name, index=name, model=spec.model,
+              dimensions=spec.dimensions)
+    threading.Thread(target=_run_migration, args=(source.name, name, spec, force),
+                     name="index-migration", daemon=True).start()
+    return {"status": "started", "source": source.name, "index": name, "model": spec.model,
+            "dimensions": spec.dimensions}
+
+
+def activate_index(name: str) -> Dict[str, Any]:
+    """
+    Switch back to an index a migration replaced, e.g. to undo it.
+
+    Chunks ingested since it was replaced are not in it.
+
+    Raises:
+    KeyError: When no index of that name was replaced.
+    ValueError: When no score thresholds are calibrated for its embedding model.
+    """
+    registry = get_index_registry()
+    if registry.status(name) != RETIRED:
+        raise KeyError(name)
+    require_score_thresholds(next(index["model"] for index in registry.indexes() if index["name"] == name))
+    current = switch_active_index(name)
+    if QUERY_CACHE_ENABLED:
+        get_query_cache().forget_vectors()
+    notify_ingestion()
+    log_event("index_switched", index=name, model=current.spec.model, dimensions=current.spec.dimensions)
+    return {"status": "active", "index": name, "model": current.spec.model, "dimensions": current.spec.dimensions}
+
+
+def index_status() -> Dict[str, Any]:
+    """The active index, the configured embedding spec and every registered index."""
+    current = active_index()
+    return {"active": {"index": current.name, **current.spec._asdict()},
+            "configured": configured_spec()._asdict(),
+            "indexes": get_index_registry().indexes()}
@@ -0,0 +1,346 @@
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from app.clients import get_pinecone_index
+from app.dedup import DEDUP_ENABLED, get_dedup_index, minhash_signature
+from app.document_summaries import FETCH_BATCH_SIZE, SUMMARY_NAMESPACE
+from app.embedding_index import EmbeddingSpec, active_index, create_vector_index, index_exists, read_index_spec
+from app.metrics import log_event
+
+# A snapshot is a folder with the vectors of an index: per namespace, shards
+# of SNAPSHOT_SHARD_SIZE records, each a float32 `.npy` matrix and a gzipped
+# JSON file with the ids and the metadata by column, and a manifest with the
+# index's embedding spec and the checksum of every file. Pinecone cannot
+# list the ids of an index, so chunks are enumerated from the dedup index,
+# as migrations do, and summary ids are derived from the chunks' documents.
+#
+#     python -m app.index_snapshot export snapshots/2024-01-31
+#     python -m app.index_snapshot import snapshots/2024-01-31 --index my-index-restored
+
+SNAPSHOT_FORMAT = 1
+MANIFEST = "manifest.json"
+# Records per shard file
+SNAPSHOT_SHARD_SIZE = int(os.environ.get('SNAPSHOT_SHARD_SIZE', '10000'))
+# Concurrent fetch or upsert requests
+SNAPSHOT_WORKERS = int(os.environ.get('SNAPSHOT_WORKERS', '8'))
+# Records per upsert request, Pinecone's recommended batch
+UPSERT_BATCH_SIZE = 100
+
+# The namespaces copied, by the name of their shard files; the index metadata
+# namespace is not, the manifest records the spec instead
+NAMESPACES = {"chunks": "", "summaries": SUMMARY_NAMESPACE}
+
+
+def _bounded_map(executor: ThreadPoolExecutor, function: Callable[[Any], Any], items: Iterable[Any],
+                 limit: int) -> Iterator[Any]:
+    """Like `executor.map`, in order, but with at most `limit` items in flight."""
+    pending: deque = deque()
+    for item in items:
+        pending.append(executor.submit(function, item))
+        if len(pending) >= limit:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _batches(items: List[Any], size: int) -> Iterator[List[Any]]:
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _namespace_count(index, namespace: str) -> int:
+    return int(index.describe_index_stats()["namespaces"].get(namespace, {}).get("vector_count", 0))
+
+
+class _ShardWriter:
+    """Buffers the records of a namespace and writes them out a shard at a time."""
+
+    def __init__(self, directory: str, label: str, dimensions: int) -> None:
+        self.directory = directory
+        self.label = label
+        self.dimensions = dimensions
+        self.ids: List[str] = []
+        self.vectors: List[List[float]] = []
+        self.metadata: List[Dict[str, Any]] = []
+        self.shards: List[Dict[str, Any]] = []
+
+    def add(self, record: Dict[str, Any]) -> None:
+        self.ids.append(record["id"])
+        self.vectors.append(record["values"])
+        self.metadata.append(record.get("metadata") or {})
+        if len(self.ids) >= SNAPSHOT_SHARD_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if not self.ids:
+            return
+        name = f"{self.label}-{len(self.shards):05d}"
+        vectors_path = os.path.join(self.directory, f"{name}.npy")
+        np.save(vectors_path, np.asarray(self.vectors, dtype=np.float32).reshape(-1, self.dimensions))
+        # Records share their keys, so columns store each key once
+        keys = sorted({key for metadata in self.metadata for key in metadata})
+        columns = {key: [metadata.get(key) for metadata in self.metadata] for key in keys}
+        metadata_path = os.path.join(self.directory, f"{name}.json.gz")
+        with gzip.open(metadata_path, "wt", encoding="utf-8") as f:
+            json.dump({"ids": self.ids, "metadata": columns}, f, ensure_ascii=False)
+        self.shards.append({
+            "vectors": os.path.basename(vectors_path), "vectors_sha256": _sha256(vectors_path),
+            "metadata": os.path.basename(metadata_path), "metadata_sha256": _sha256(metadata_path),
+            "count": len(self.ids),
+        })
+        self.ids, self.vectors, self.metadata = [], [], []
+
+    @property
+    def count(self) -> int:
+        return sum(shard["count"] for shard in self.shards) + len(self.ids)
+
+
+def _export_namespace(executor: ThreadPoolExecutor, index, namespace: str, ids: List[str],
+                      writer: _ShardWriter, workers: int) -> Iterator[Dict[str, Any]]:
+    """Fetch records by id, in order, write them and yield each one."""
+    def fetch(batch: List[str]) -> Dict[str, Any]:
+        return index.fetch(ids=batch, namespace=namespace or None)["vectors"]
+
+    for batch, vectors in zip(_batches(ids, FETCH_BATCH_SIZE),
+                              _bounded_map(executor, fetch, _batches(ids, FETCH_BATCH_SIZE), workers * 2)):
+        for vector_id in batch:
+            record = vectors.get(vector_id)
+            if record is not None:
+                writer.add(record)
+                yield record
+    writer.flush()
+
+
+def _summary_ids(documents: Dict[str, int]) -> List[str]:
+    # Every id summary_records could have given a document of that many chunks,
+    # whatever DOCUMENT_SECTION_CHUNKS was; ids that do not exist are not fetched
+    ids = []
+    for document, chunks in documents.items():
+        key = hashlib.sha1(document.encode()).hexdigest()
+        ids.append(f"{key}-document")
+        ids.extend(f"{key}-section-{section}" for section in range(chunks))
+    return ids
+
+
+def export_snapshot(directory: str, index_name: Optional[str] = None, workers: int = SNAPSHOT_WORKERS,
+                    force: bool = False) -> Dict[str, Any]:
+    """
+    Write the chunks and summary vectors of an index to a snapshot folder.
+
+    Records are fetched in parallel batches and written a shard at a time, so
+    memory does not grow with the index. Chunks stored after the export
+    started may be missing from the snapshot.
+
+    Parameters:
+    directory (str): The snapshot folder; created, and must not hold a snapshot yet.
+    index_name (str): The index to export (default: the active index).
+    workers (int): Concurrent fetch requests.
+    force (bool): Export even if some chunks of the index are not in the dedup index and would be left out.
+
+    Returns:
+    Dict[str, Any]: The manifest written.
+
+    Raises:
+    ValueError: If the index has chunks the dedup index does not know, or the folder holds a snapshot.
+    """
+    started = time.perf_counter()
+    if index_name is None:
+        source = active_index()
+        index_name, spec = source.name, source.spec
+        index = get_pinecone_index(index_name)
+    else:
+        index = get_pinecone_index(index_name)
+        spec = read_index_spec(index)
+        if spec is None:
+            raise ValueError(f"{index_name} records no embedding spec; export it as the active index")
+    if os.path.exists(os.path.join(directory, MANIFEST)):
+        raise ValueError(f"{directory} already holds a snapshot")
+
+    dedup = get_dedup_index()
+    chunk_ids = [chunk_id for _, chunk_id in dedup.chunks_after(0)]
+    missing = _namespace_count(index, "") - len(chunk_ids)
+    if missing > 0 and not force:
+        raise ValueError(f"{missing} chunks of {index_name} are not in the dedup index "
+                         "(stored with DEDUP_ENABLED=0 or on another instance); export with --force to leave them out")
+
+    os.makedirs(directory, exist_ok=True)
+    writers = {label: _ShardWriter(directory, label, spec.dimensions) for label in NAMESPACES}
+    documents: Dict[str, int] = {}
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="snapshot") as executor:
+        for record in _export_namespace(executor, index, NAMESPACES["chunks"], chunk_ids, writers["chunks"], workers):
+            for document in (record.get("metadata") or {}).get("documents", []):
+                documents[document] = documents.get(document, 0) + 1
+        for _ in _export_namespace(executor, index, NAMESPACES["summaries"], _summary_ids(documents),
+                                   writers["summaries"], workers):
+            pass
+
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "index": index_name,
+        "model": spec.model,
+        "dimensions": spec.dimensions,
+        "created_at": time.time(),
+        "namespaces": {label: {"namespace": NAMESPACES[label], "count": writer.count, "shards": writer.shards}
+                       for label, writer in writers.items()},
+    }
+    # Written last: a folder without a manifest is an unfinished export
+    with open(os.path.join(directory, MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    log_event("index_exported", index=index_name, directory=directory, chunks=writers["chunks"].count,
+              summaries=writers["summaries"].count, left_out=max(0, missing),
+              seconds=round(time.perf_counter() - started, 4))
+    return manifest
+
+
+def read_manifest(directory: str) -> Dict[str, Any]:
+    """
+    Read and check the manifest of a snapshot folder.
+
+    Raises:
+    ValueError: If the folder holds no finished snapshot of a known format, or a file of it is corrupt.
+    """
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        raise ValueError(f"{directory} holds no finished snapshot")
+    with open(path) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError(f"Unknown snapshot format {manifest.get('format')}")
+    for entry in manifest["namespaces"].values():
+        for shard in entry["shards"]:
+            for kind in ("vectors", "metadata"):
+                if _sha256(os.path.join(directory, shard[kind])) != shard[f"{kind}_sha256"]:
+                    raise ValueError(f"{shard[kind]} is corrupt: its checksum does not match the manifest")
+    return manifest
+
+
+def _read_shard(directory: str, shard: Dict[str, Any]) -> Iterator[Tuple[str, List[float], Dict[str, Any]]]:
+    vectors = np.load(os.path.join(directory, shard["vectors"]), mmap_mode="r")
+    with gzip.open(os.path.join(directory, shard["metadata"]), "rt", encoding="utf-8") as f:
+        content = json.load(f)
+    columns = content["metadata"]
+    for row, vector_id in enumerate(content["ids"]):
+        metadata = {key: values[row] for key, values in columns.items() if values[row] is not None}
+        yield vector_id, vectors[row].tolist(), metadata
+
+
+def _rebuild_dedup(rows: List[Tuple[str, List[float], Dict[str, Any]]]) -> int:
+    """Index imported chunks the local dedup index does not know, from their text; return how many."""
+    dedup = get_dedup_index()
+    added = 0
+    for vector_id, _, metadata in rows:
+        documents = metadata.get("documents") or [None]
+        if "text" not in metadata or dedup.documents(vector_id):
+            continue
+        dedup.add(vector_id, minhash_signature(metadata["text"]), documents[0])
+        for document in documents[1:]:
+            dedup.link(vector_id, document)
+        added += 1
+    return added
+
+
+def import_snapshot(directory: str, index_name: Optional[str] = None, workers: int = SNAPSHOT_WORKERS,
+                    rebuild_dedup: bool = DEDUP_ENABLED) -> Dict[str, Any]:
+    """
+    Load a snapshot into an index, creating it with the snapshot's embedding spec if needed.
+
+    Records are upserted in parallel batches with their ids, so an
+    interrupted import is resumed by running it again.
+
+    Parameters:
+    directory (str): The snapshot folder.
+    index_name (str): The index to load (default: the exported index, e.g. to restore it).
+    workers (int): Concurrent upsert requests.
+    rebuild_dedup (bool): Also index the chunks in the local dedup index, so
+    new uploads are deduplicated against them and migrations and exports can list them.
+
+    Returns:
+    Dict[str, Any]: The index and the number of records loaded per namespace.
+
+    Raises:
+    ValueError: If the snapshot is unfinished or corrupt, or the index holds vectors of another spec.
+    """
+    started = time.perf_counter()
+    manifest = read_manifest(directory)
+    spec = EmbeddingSpec(manifest["model"], int(manifest["dimensions"]))
+    index_name = index_name or manifest["index"]
+    existing = read_index_spec(get_pinecone_index(index_name)) if index_exists(index_name) else None
+    if existing is not None and existing != spec:
+        raise ValueError(f"{index_name} holds {existing.model} vectors of {existing.dimensions} dimensions, "
+                         f"the snapshot {spec.model} vectors of {spec.dimensions}")
+    index = create_vector_index(index_name, spec)
+
+    loaded: Dict[str, int] = {}
+    indexed = 0
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="snapshot") as executor:
+        for label, entry in manifest["namespaces"].items():
+            namespace = entry["namespace"]
+
+            def upsert(rows: List[Tuple[str, List[float], Dict[str, Any]]]) -> Tuple[int, int]:
+                index.upsert(vectors=rows, namespace=namespace or None)
+                return len(rows), _rebuild_dedup(rows) if rebuild_dedup and label == "chunks" else 0
+
+            batches = (batch for shard in entry["shards"]
+                       for batch in _batches(list(_read_shard(directory, shard)), UPSERT_BATCH_SIZE))
+            loaded[label] = 0
+            for count, added in _bounded_map(executor, upsert, batches, workers * 2):
+                loaded[label] += count
+                indexed += added
+
+    report = {"index": index_name, "model": spec.model, "dimensions": spec.dimensions, **loaded,
+              "dedup_indexed": indexed, "seconds": round(time.perf_counter() - started, 4)}
+    log_event("index_imported", directory=directory, **report)
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m app.index_snapshot",
+                                     description="Export a vector index to a snapshot folder, or import one.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="Write the active index, or --index, to a snapshot folder")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--index", help="The index to export (default: the active index)")
+    export_parser.add_argument("--force", action="store_true",
+                               help="Leave out chunks the dedup index does not know instead of failing")
+    import_parser = commands.add_parser("import", help="Load a snapshot folder into an index")
+    import_parser.add_argument("directory")
+    import_parser.add_argument("--index", help="The index to load (default: the exported one)")
+    import_parser.add_argument("--no-dedup", action="store_true", help="Do not index the chunks for deduplication")
+    for command in (export_parser, import_parser):
+        command.add_argument("--workers", type=int, default=SNAPSHOT_WORKERS, help="Concurrent requests")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    try:
+        if args.command == "export":
+            manifest = export_snapshot(args.directory, args.index, args.workers, args.force)
+            result = {"index": manifest["index"], "directory": args.directory,
+                      **{label: entry["count"] for label, entry in manifest["namespaces"].items()}}
+        else:
+            result = import_snapshot(args.directory, args.index, args.workers, DEDUP_ENABLED and not args.no_dedup)
+    except ValueError as e:
+        sys.exit(f"error: {e}")
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,351 @@
+import json
+import logging
+import threading
+import time
+import uuid
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import anyio
+
+logger = logging.getLogger("chatpdf")
+
+# Histogram buckets in seconds, from fast vector searches up to the 300s worker timeout
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A monotonically increasing value per label set."""
+
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Gauge(_Metric):
+    """A value per label set that can go up and down."""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def value(self, **labels: str) -> float:
+        return self._values.get(self._key(labels), 0.0)
+
+    def _samples(self) -> List[str]:
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}" for key, value in items]
+
+
+class Histogram(_Metric):
+    """Cumulative-bucket histogram per label set, in the Prometheus layout."""
+
+    type_name = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: [count per bucket (+Inf last), sum]
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(key, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def _samples(self) -> List[str]:
+        lines = []
+        with self._lock:
+            items = sorted((key, (list(counts), total[0])) for key, (counts, total) in self._values.items())
+        for key, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                labels = _format_labels(self.labelnames, key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {cumulative}")
+        return lines
+
+
+REGISTRY: List[_Metric] = []
+
+REQUEST_DURATION = Histogram(
+    "chatpdf_request_duration_seconds", "End-to-end HTTP request latency.", ("handler",))
+REQUESTS_TOTAL = Counter(
+    "chatpdf_requests_total", "HTTP requests handled.", ("handler", "status"))
+STAGE_DURATION = Histogram(
+    "chatpdf_stage_duration_seconds", "Latency of individual chat and ingestion stages.", ("stage",))
+STAGE_ERRORS = Counter(
+    "chatpdf_stage_errors_total", "Stages that raised an exception.", ("stage",))
+INGESTED_DOCUMENTS = Counter(
+    "chatpdf_ingested_documents_total", "Documents run through ingestion.", ("file_type", "status"))
+INGESTED_CHUNKS = Counter(
+    "chatpdf_ingested_chunks_total", "Chunks produced at ingestion.", ("status",))
+
+
+def render_metrics() -> str:
+    """Render every registered metric in the Prometheus text exposition format."""
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+class RequestContext:
+    """Per-request state collected while the request is being handled."""
+
+    def __init__(self, request_id: Optional[str] = None, user: Optional[str] = None) -> None:
+        self.request_id = request_id or uuid.uuid4().hex
+        self.user = user
+        self.started = time.perf_counter()
+        # The response status, once the response has started
+        self.status: Optional[int] = None
+        self.timings: List[Tuple[str, float]] = []
+        self.usage: Dict[str, float] = {}
+        # Free-form per-request state for other modules, like `request.state`
+        self.state: Dict[str, Any] = {}
+        self._on_finish: List[Callable[["RequestContext"], None]] = []
+
+    def on_finish(self, callback: Callable[["RequestContext"], None]) -> None:
+        """
+        Register a callback to run once the response has been sent.
+
+        Callbacks of requests run on a worker thread, not the event loop, so
+        they may block, e.g. on a database write.
+        """
+        self._on_finish.append(callback)
+
+    def finish(self) -> None:
+        for callback in self._on_finish:
+            try:
+                callback(self)
+            except Exception as e:
+                logging.error(f"Error in request finish callback: {e}")
+        self._on_finish.clear()
+
+
+_current_request: ContextVar[Optional[RequestContext]] = ContextVar("chatpdf_request", default=None)
+
+
+def current_request() -> Optional[RequestContext]:
+    """Return the context of the request being handled, if any."""
+    return _current_request.get()
+
+
+@contextmanager
+def background_context(user: str) -> Iterator[RequestContext]:
+    """
+    Open a request context for background work, attributed to `user`.
+
+    Usage and timings recorded inside the block are collected like those of a
+    request, and the context's finish callbacks run when the block exits.
+    """
+    context = RequestContext(user=user)
+    token = _current_request.set(context)
+    try:
+        yield context
+    finally:
+        _current_request.reset(token)
+        context.finish()
+
+
+@contextmanager
+def stage_timer(stage: str) -> Iterator[None]:
+    """
+    Time a block as a named stage.
+
+    The duration is observed in the stage histogram and, inside a request,
+    added to the timings reported in the `Server-Timing` header.
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.inc(stage=stage)
+        raise
+    finally:
+        _record_stage(stage, time.perf_counter() - started)
+
+
+def timed_iter(stage: str, items: Iterable[Any]) -> Iterator[Any]:
+    """
+    Yield the items of a lazy iterable, timing the work of producing them as one stage.
+
+    The time the consumer spends between items is not counted; the stage is
+    recorded once the iterable is exhausted or abandoned.
+    """
+    iterator = iter(items)
+    duration = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                duration += time.perf_counter() - started
+                return
+            except BaseException:
+                STAGE_ERRORS.inc(stage=stage)
+                raise
+            duration += time.perf_counter() - started
+            yield item
+    finally:
+        _record_stage(stage, duration)
+
+
+def _record_stage(stage: str, duration: float) -> None:
+    STAGE_DURATION.observe(duration, stage=stage)
+    context = _current_request.get()
+    if context is not None:
+        context.timings.append((stage, duration))
+
+
+def server_timing_header(timings: List[Tuple[str, float]], total: float) -> str:
+    """Aggregate stage timings into a `Server-Timing` header value (durations in ms)."""
+    totals: Dict[str, List[float]] = {}
+    for stage, duration in timings:
+        totals.setdefault(stage, []).append(duration)
+    entries = []
+    for stage, durations in totals.items():
+        entry = f"{stage};dur={sum(durations) * 1000:.1f}"
+        if len(durations) > 1:
+            entry += f';desc="{len(durations)} calls"'
+        entries.append(entry)
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(entries)
+
+
+def log_event(event: str, level: int = logging.INFO, **fields: object) -> None:
+    """
+    Emit a single-line JSON log record.
+
+    Serialisation is skipped entirely when the level is disabled, so callers
+    can log on hot paths without paying for formatting.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    record = {"event": event}
+    context = _current_request.get()
+    if context is not None:
+        record["request_id"] = context.request_id
+    record.update(fields)
+    logger.log(level, json.dumps(record, default=str, ensure_ascii=False))
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware that opens a request context, records request metrics and
+    adds a `Server-Timing` header with the per-stage durations.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_headers = dict(scope.get("headers") or [])
+        user = request_headers.get(b"x-user-id", b"").decode("latin-1").strip() or None
+        context = RequestContext(user=user)
+        token = _current_request.set(context)
+        started = time.perf_counter()
+        status = {"code": 500}
+
+        async def send_with_timing(message) -> None:
+            if message["type"] == "http.response.start":
+                status["code"] = context.status = message["status"]
+                header = server_timing_header(context.timings, time.perf_counter() - started)
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", header.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _current_request.reset(token)
+            # Shielded so a client that disconnected still gets its callbacks run
+            with anyio.CancelScope(shield=True):
+                await anyio.to_thread.run_sync(context.finish)
+            endpoint = scope.get("endpoint")
+            handler = getattr(endpoint, "__name__", "unmatched")
+            REQUEST_DURATION.observe(time.perf_counter() - started, handler=handler)
+            REQUESTS_TOTAL.inc(handler=handler, status=str(status["code"]))
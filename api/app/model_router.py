@@ -0,0 +1,115 @@
+import os
+import re
+from typing import NamedTuple, Optional
+
+from app.metrics import Counter, Histogram, log_event
+
+# Completions go to one of two model tiers. Simple lookups, short questions
+# whose answer sits in a small, closely matching context, are answered by the
+# fast tier; everything else, and every query the features cannot vouch for,
+# by the strong tier. The features are computed locally from the query and
+# its retrieval, so routing costs no extra call.
+
+STRONG_COMPLETION_MODEL = os.environ.get('COMPLETION_MODEL', 'gpt-4-1106-preview')
+FAST_COMPLETION_MODEL = os.environ.get('FAST_COMPLETION_MODEL', 'gpt-3.5-turbo-1106')
+MODEL_ROUTING_ENABLED = os.environ.get('MODEL_ROUTING', '1').lower() not in ("0", "false", "no")
+# Most tokens of an answer from each tier; lookups have short answers
+STRONG_MAX_RESPONSE_TOKENS = int(os.environ.get('COMPLETION_MAX_TOKENS', '800'))
+FAST_MAX_RESPONSE_TOKENS = int(os.environ.get('FAST_COMPLETION_MAX_TOKENS', '400'))
+# A query goes to the fast tier only within all of these; the score is that of
+# ada-002 vectors, other embedding models take theirs from the retrieval config
+ROUTER_FAST_MAX_WORDS = int(os.environ.get('ROUTER_FAST_MAX_WORDS', '20'))
+ROUTER_FAST_MAX_CONTEXT = int(os.environ.get('ROUTER_FAST_MAX_CONTEXT', '6000'))
+ROUTER_FAST_MIN_SCORE = float(os.environ.get('ROUTER_FAST_MIN_SCORE', '0.85'))
+
+FAST, STRONG = "fast", "strong"
+
+# Questions asking for a fact: what, which, when, where, who, how much/many
+_LOOKUP_RE = re.compile(
+    r"^\W*(qu[eé]|cu[aá]l(es)?|cu[aá]ndo|d[oó]nde|qui[eé]n(es)?|cu[aá]nt[oa]s?|"
+    r"what|which|when|where|who|how (much|many|long|old))\b", re.IGNORECASE)
+# Questions asking for reasoning over the context, wherever they appear, in
+# both languages alike; "how" but not the lookups "how much/many/long/old"
+_ANALYTIC_RE = re.compile(
+    r"\b(por ?qu[eé]|c[oó]mo|compar\w*|expl[ií]c\w*|analiz\w*|an[aá]lisis|resum\w*|diferencias?|ventajas?|"
+    r"desventajas?|eval[uú]\w*|relaci[oó]n|relaciones|implica\w*|recomend\w*|recomienda\w*|"
+    r"why|how(?! (much|many|long|old)\b)|explain\w*|analy[sz]\w*|summar\w*|differen\w*|"
+    r"pros|cons|advantages?|disadvantages?|evaluat\w*|relationships?|implicat\w*|recommend\w*)\b",
+    re.IGNORECASE)
+
+MODEL_ROUTES = Counter(
+    "chatpdf_model_routes_total", "Completions routed to each model tier, by the feature that decided it.",
+    ("tier", "reason"))
+COMPLETION_LATENCY = Histogram(
+    "chatpdf_completion_duration_seconds", "Latency of completion calls, by model tier.", ("tier",))
+
+
+class Route(NamedTuple):
+    """The model tier a completion is sent to, and why."""
+
+    tier: str
+    model: str
+    max_tokens: int
+    reason: str
+
+
+def question_type(query: str) -> str:
+    """Classify a query as a `lookup` of a fact, an `analytic` question, or `other`."""
+    if _ANALYTIC_RE.search(query):
+        return "analytic"
+    if _LOOKUP_RE.search(query):
+        return "lookup"
+    return "other"
+
+
+def _route(tier: str, reason: str) -> Route:
+    if tier == FAST:
+        return Route(FAST, FAST_COMPLETION_MODEL, FAST_MAX_RESPONSE_TOKENS, reason)
+    return Route(STRONG, STRONG_COMPLETION_MODEL, STRONG_MAX_RESPONSE_TOKENS, reason)
+
+
+def route_query(query: str, context: str, top_score: Optional[float] = None,
+                fast_min_score: Optional[float] = ROUTER_FAST_MIN_SCORE) -> Route:
+    """
+    Choose the model tier of a completion from cheap features of its query and context.
+
+    Parameters:
+    query (str): The user query.
+    context (str): The retrieved context put in the prompt.
+    top_score (float): The similarity of the best match, or None when unknown (e.g. a cached context).
+    fast_min_score (float): The least `top_score` of a fast lookup, calibrated for the embedding model
+    of the index; None when it was not, which sends every query to the strong tier.
+
+    Returns:
+    Route: The tier, its model and response-token limit, and the feature that decided it.
+    """
+    if not MODEL_ROUTING_ENABLED:
+        route = _route(STRONG, "disabled")
+    else:
+        kind = question_type(query)
+        if kind != "lookup":
+            route = _route(STRONG, kind)
+        elif len(query.split()) > ROUTER_FAST_MAX_WORDS:
+            route = _route(STRONG, "long_query")
+        elif len(context) > ROUTER_FAST_MAX_CONTEXT:
+            route = _route(STRONG, "large_context")
+        elif fast_min_score is None:
+            route = _route(STRONG, "uncalibrated")
+        elif top_score is not None and top_score < fast_min_score:
+            route = _route(STRONG, "weak_match")
+        else:
+            route = _route(FAST, "lookup")
+    MODEL_ROUTES.inc(tier=route.tier, reason=route.reason)
+    log_event("model_route", tier=route.tier, model=route.model, reason=route.reason, query_words=len(query.split()),
+              context_chars=len(context), top_score=None if top_score is None else round(top_score, 4))
+    return route
+
+
+def refiner_route() -> Route:
+    """The tier of query refinement, a short rewrite the fast tier does as well."""
+    return _route(FAST if MODEL_ROUTING_ENABLED else STRONG, "refine")
+
+
+def observe_completion(route: Route, seconds: float) -> None:
+    """Record the latency of a completion against its tier."""
+    COMPLETION_LATENCY.observe(seconds, tier=route.tier)
@@ -0,0 +1,278 @@
+import logging
+import os
+import posixpath
+import zipfile
+from typing import IO, TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+from xml.etree.ElementTree import Element, iterparse
+
+from app.metrics import Counter
+
+# DOCX and PPTX files are zip archives of XML parts. The parts are streamed
+# straight out of the archive into an incremental XML parser and dropped as
+# soon as each paragraph or table has been read, so neither the whole tree nor
+# the Unstructured stack is loaded.
+
+if TYPE_CHECKING:
+    from langchain.schema.document import Document
+
+NATIVE_OOXML = os.environ.get('NATIVE_OOXML', 'true').lower() not in ("0", "false", "no")
+# Larger XML parts are refused (and left to the fallback) to guard against zip bombs
+MAX_PART_BYTES = 256 * 1024 * 1024
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+_P = "{http://schemas.openxmlformats.org/presentationml/2006/main}"
+_R = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+_REL = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+_MC = "{http://schemas.openxmlformats.org/markup-compatibility/2006}"
+_NOTES_SLIDE_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships/notesSlide"
+_TITLE_PLACEHOLDERS = ("title", "ctrTitle")
+# Slide numbers and dates are already metadata or noise
+_SKIPPED_PLACEHOLDERS = ("sldNum", "dt")
+
+OOXML_FALLBACKS = Counter(
+    "chatpdf_ooxml_fallbacks_total", "Documents the native extractor could not read, parsed by Unstructured instead.",
+    ("file_type",))
+
+
+class _TextBlocks:
+    """
+    Turn the parse events of WordprocessingML or DrawingML text into blocks.
+
+    A block is a paragraph outside any table, or a whole table with one line
+    per row and ` | ` between cells. Both vocabularies name their elements
+    alike (p, t, br, tab, tbl, tr, tc), only in different namespaces. A
+    paragraph nested in another one, e.g. in a DOCX text box, is a block of
+    its own, read before the rest of the outer paragraph.
+    """
+
+    def __init__(self, ns: str) -> None:
+        self.p, self.t, self.br, self.tab = ns + "p", ns + "t", ns + "br", ns + "tab"
+        self.cr, self.ppr = ns + "cr", ns + "pPr"
+        self.tbl, self.tr, self.tc = ns + "tbl", ns + "tr", ns + "tc"
+        self.table_depth = 0
+        # The runs of every open paragraph, innermost last
+        self.paragraphs: List[List[str]] = []
+        # Inside paragraph properties, whose tabs are tab stops, not tab characters
+        self.ppr_depth = 0
+        # Inside the fallback copy of content also given as an mc:Choice, e.g. a VML text box
+        self.fallback_depth = 0
+        self.cell: List[str] = []
+        self.cells: List[str] = []
+        self.rows: List[str] = []
+
+    def feed(self, event: str, elem: Element) -> Optional[str]:
+        tag = elem.tag
+        if tag == _MC + "Fallback":
+            self.fallback_depth += 1 if event == "start" else -1
+            return None
+        if self.fallback_depth:
+            if event == "end":
+                elem.clear()
+            return None
+        if tag == self.ppr:
+            self.ppr_depth += 1 if event == "start" else -1
+            return None
+        if event == "start":
+            if tag == self.p:
+                self.paragraphs.append([])
+            elif tag == self.tbl:
+                self.table_depth += 1
+                if self.table_depth == 1:
+                    self.rows = []
+            elif tag == self.tr and self.table_depth == 1:
+                self.cells = []
+            elif tag == self.tc and self.table_depth == 1:
+                self.cell = []
+            return None
+
+        runs = self.paragraphs[-1] if self.paragraphs else []
+        if tag == self.t:
+            runs.append(elem.text or "")
+        elif tag == self.tab:
+            if not self.ppr_depth:
+                runs.append("\t")
+        elif tag in (self.br, self.cr):
+            runs.append("\n")
+        elif tag == self.p:
+            text = "".join(self.paragraphs.pop()).strip()
+            elem.clear()
+            if self.table_depth:
+                # Paragraphs of nested tables end up in the outer cell
+                if text:
+                    self.cell.append(text)
+            elif text:
+                return text
+        elif tag == self.tc and self.table_depth == 1:
+            self.cells.append(" ".join(self.cell))
+        elif tag == self.tr and self.table_depth == 1:
+            if any(self.cells):
+                self.rows.append(" | ".join(self.cells))
+        elif tag == self.tbl:
+            self.table_depth -= 1
+            if self.table_depth == 0:
+                elem.clear()
+                if self.rows:
+                    return "\n".join(self.rows)
+        return None
+
+
+def _open_part(archive: zipfile.ZipFile, name: str) -> IO[bytes]:
+    info = archive.getinfo(name)
+    if info.file_size > MAX_PART_BYTES:
+        raise ValueError(f"{name} is {info.file_size} bytes uncompressed, more than {MAX_PART_BYTES}")
+    return archive.open(info)
+
+
+def _relationships(archive: zipfile.ZipFile, part: str) -> Dict[str, Tuple[str, str]]:
+    """Relationship id -> (type, archive path of the target) for `part`."""
+    folder, name = posixpath.split(part)
+    rels_name = posixpath.join(folder, "_rels", name + ".rels")
+    if rels_name not in archive.NameToInfo:
+        return {}
+    relationships = {}
+    with _open_part(archive, rels_name) as stream:
+        for _, elem in iterparse(stream):
+            if elem.tag == _REL + "Relationship" and elem.get("TargetMode") != "External":
+                target = elem.get("Target", "")
+                path = target.lstrip("/") if target.startswith("/") else posixpath.normpath(posixpath.join(folder, target))
+                relationships[elem.get("Id")] = (elem.get("Type", ""), path)
+    return relationships
+
+
+def iter_docx_blocks(stream: IO[bytes]) -> Iterator[str]:
+    """Yield the paragraphs and tables of a `word/document.xml` part, in document order."""
+    blocks = _TextBlocks(_W)
+    body = None
+    for event, elem in iterparse(stream, events=("start", "end")):
+        if event == "start" and elem.tag == _W + "body":
+            body = elem
+        block = blocks.feed(event, elem)
+        if block is not None:
+            yield block
+        if (event == "end" and body is not None and blocks.table_depth == 0 and not blocks.paragraphs
+                and elem.tag in (blocks.p, blocks.tbl)):
+            # Drop the blocks already read from the partially built tree
+            body.clear()
+
+
+def extract_docx(path: str) -> List['Document']:
+    """
+    Extract the text of a DOCX file as one document, like Unstructured's single mode.
+
+    Paragraphs and tables are separated by blank lines; table rows are lines
+    with ` | ` between cells.
+    """
+    from langchain.schema.document import Document
+    with zipfile.ZipFile(path) as archive, _open_part(archive, "word/document.xml") as stream:
+        text = "\n\n".join(iter_docx_blocks(stream))
+    return [Document(page_content=text, metadata={"source": path})]
+
+
+def _iter_shapes(stream: IO[bytes]) -> Iterator[Tuple[Optional[str], str]]:
+    """Yield (placeholder type, text) for every text shape and table of a slide part, in order."""
+    blocks = _TextBlocks(_A)
+    placeholder: Optional[str] = None
+    shape: List[str] = []
+    shape_depth = 0
+    for event, elem in iterparse(stream, events=("start", "end")):
+        tag = elem.tag
+        if tag == _P + "sp":
+            if event == "start":
+                shape_depth += 1
+                placeholder, shape = None, []
+            else:
+                shape_depth -= 1
+                if shape:
+                    yield placeholder, "\n".join(shape)
+                elem.clear()
+            continue
+        if event == "start" and tag == _P + "ph" and shape_depth:
+            placeholder = elem.get("type", "body")
+        block = blocks.feed(event, elem)
+        if block is not None:
+            if shape_depth:
+                shape.append(block)
+            else:
+                # Tables live in graphic frames, outside any shape
+                yield None, block
+
+
+def _slide_paths(archive: zipfile.ZipFile) -> List[str]:
+    """The slide parts in presentation order."""
+    relationships = _relationships(archive, "ppt/presentation.xml")
+    slides = []
+    with _open_part(archive, "ppt/presentation.xml") as stream:
+        for _, elem in iterparse(stream):
+            if elem.tag == _P + "sldId":
+                relationship = relationships.get(elem.get(_R + "id"))
+                if relationship is not None:
+                    slides.append(relationship[1])
+    return slides
+
+
+def _notes_text(archive: zipfile.ZipFile, slide: str) -> str:
+    """The speaker notes of a slide: the body placeholder of its notes slide."""
+    notes = []
+    for kind, notes_slide in _relationships(archive, slide).values():
+        if kind != _NOTES_SLIDE_REL:
+            continue
+        with _open_part(archive, notes_slide) as stream:
+            notes.extend(text for placeholder, text in _iter_shapes(stream) if placeholder == "body")
+    return "\n".join(notes)
+
+
+def extract_pptx(path: str) -> List['Document']:
+    """
+    Extract the text of a PPTX file as one document per slide.
+
+    Each document holds the slide title first, then the text of its other
+    shapes and tables, then its speaker notes, and carries the slide number
+    (`page_number`) and title in its metadata.
+    """
+    from langchain.schema.document import Document
+    documents = []
+    with zipfile.ZipFile(path) as archive:
+        for number, slide in enumerate(_slide_paths(archive), start=1):
+            title, parts = "", []
+            with _open_part(archive, slide) as stream:
+                for placeholder, text in _iter_shapes(stream):
+                    if placeholder in _SKIPPED_PLACEHOLDERS:
+                        continue
+                    if placeholder in _TITLE_PLACEHOLDERS and not title:
+                        title = text
+                    else:
+                        parts.append(text)
+            notes = _notes_text(archive, slide)
+            if notes:
+                parts.append("Notes: " + notes)
+            if title:
+                parts.insert(0, title)
+            documents.append(Document(page_content="\n\n".join(parts),
+                                      metadata={"source": path, "page_number": number, "title": title}))
+    return documents
+
+
+def load_ooxml(path: str, file_type: str) -> List['Document']:
+    """
+    Extract a DOCX or PPTX file natively, falling back to Unstructured.
+
+    The fallback is used when `NATIVE_OOXML` is off, when the file cannot be
+    read natively (e.g. a damaged or unusual archive) or when no text was found.
+    """
+    if NATIVE_OOXML:
+        try:
+            documents = extract_docx(path) if file_type == "docx" else extract_pptx(path)
+            if any(document.page_content.strip() for document in documents):
+                return documents
+            logging.warning(f"No text found natively in {path}, trying Unstructured")
+        except Exception as e:
+            logging.warning(f"Native {file_type} extraction failed for {path}, trying Unstructured: {e}")
+        OOXML_FALLBACKS.inc(file_type=file_type)
+
+    # Imported on first use: langchain's loaders and unstructured are slow to import
+    if file_type == "docx":
+        from langchain.document_loaders import UnstructuredWordDocumentLoader
+        return UnstructuredWordDocumentLoader(path).load()
+    from langchain.document_loaders import UnstructuredPowerPointLoader
+    return UnstructuredPowerPointLoader(path).load()
@@ -0,0 +1,120 @@
+import logging
+import math
+import mmap
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+from app.metrics import log_event
+
+# Large PDFs are split into page ranges extracted in worker processes. Every
+# process memory-maps the file read-only, so the pages are shared through the
+# page cache instead of being copied into each process, and only the
+# extracted text is sent back.
+
+if TYPE_CHECKING:
+    from langchain.schema.document import Document
+    from pypdf import PdfReader
+
+# Processes per API worker, by default the worker's share of the CPUs among
+# the WEB_CONCURRENCY workers; 0 or 1 extracts every PDF in-process
+PDF_PARSE_PROCESSES = int(os.environ.get(
+    'PDF_PARSE_PROCESSES', str(max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', '1'))))))
+# Smaller PDFs are not worth the round trip to the pool
+PDF_PARALLEL_MIN_PAGES = int(os.environ.get('PDF_PARALLEL_MIN_PAGES', '100'))
+# Ranges are never smaller than this, and there are about two per process so a
+# range of heavy pages does not leave the other processes idle at the end
+MIN_RANGE_PAGES = 25
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _open_pdf(path: str) -> Tuple[mmap.mmap, 'PdfReader']:
+    import pypdf
+    with open(path, "rb") as f:
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return buffer, pypdf.PdfReader(buffer)
+
+
+def extract_page_range(path: str, start: int, end: int) -> List[str]:
+    """Extract the text of pages `start` to `end` (excluded) of a PDF; runs in a worker process."""
+    buffer, reader = _open_pdf(path)
+    try:
+        return [reader.pages[number].extract_text() for number in range(start, end)]
+    finally:
+        buffer.close()
+
+
+def page_ranges(pages: int, processes: int) -> List[Tuple[int, int]]:
+    """Split `pages` into contiguous ranges, about two per process."""
+    size = max(MIN_RANGE_PAGES, math.ceil(pages / (2 * processes)))
+    return [(start, min(start + size, pages)) for start in range(0, pages, size)]
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # forkserver: forking this multi-threaded worker could copy held locks
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            _pool = ProcessPoolExecutor(max_workers=PDF_PARSE_PROCESSES, mp_context=context)
+        return _pool
+
+
+def shutdown_page_pool() -> None:
+    """Stop this worker's extraction processes, if they were started."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def _extract_parallel(path: str, pages: int) -> Optional[List[str]]:
+    ranges = page_ranges(pages, PDF_PARSE_PROCESSES)
+    try:
+        pool = _get_pool()
+        futures = [pool.submit(extract_page_range, path, start, end) for start, end in ranges]
+        # Reassembled in page order, whatever order the ranges finish in
+        texts = [text for future in futures for text in future.result()]
+    except BrokenProcessPool as e:
+        logging.warning(f"PDF extraction processes died, extracting {path} in-process: {e}")
+        shutdown_page_pool()
+        return None
+    log_event("pdf_pages_extracted", pages=pages, ranges=len(ranges), processes=PDF_PARSE_PROCESSES)
+    return texts
+
+
+def load_pdf_pages(path: str) -> List['Document']:
+    """
+    Extract the text of a PDF as one document per page, like langchain's PyPDFLoader.
+
+    PDFs of at least PDF_PARALLEL_MIN_PAGES pages are extracted in parallel
+    by the worker's process pool; smaller ones, and any PDF when the pool is
+    disabled or broken, in the calling thread.
+
+    Parameters:
+    path (str): The path of the PDF file.
+
+    Returns:
+    List[Document]: One document per page, in page order, with the `source`
+    path and the zero-based `page` number as metadata.
+    """
+    from langchain.schema.document import Document
+    buffer, reader = _open_pdf(path)
+    try:
+        pages = len(reader.pages)
+        texts = None
+        if PDF_PARSE_PROCESSES > 1 and pages >= PDF_PARALLEL_MIN_PAGES:
+            texts = _extract_parallel(path, pages)
+        if texts is None:
+            texts = [page.extract_text() for page in reader.pages]
+    finally:
+        buffer.close()
+    return [Document(page_content=text, metadata={"source": path, "page": number})
+            for number, text in enumerate(texts)]
@@ -1,10 +1,13 @@
-import boto3
-from langchain.document_loaders import PyPDFLoader
 import logging
 from dotenv import load_dotenv
 import os
-from botocore.exceptions import ClientError
 import tempfile
+from typing import TYPE_CHECKING
+from app.metrics import stage_timer
+from app.pdf_pages import load_pdf_pages
+
+if TYPE_CHECKING:
+    import boto3
 
 # Load environment variables from the .env file
 load_dotenv()
@@ -13,7 +16,7 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 
-def process_pdf(s3_client: boto3.client, bucket_name: str, file_key: str) -> tuple:
+def process_pdf(s3_client: 'boto3.client', bucket_name: str, file_key: str) -> tuple:
     """
     Download a PDF file from an S3 bucket, process it to extract text, and return the extracted text and temporary file path.
 
@@ -25,12 +28,15 @@ def process_pdf(s3_client: boto3.client, bucket_name: str, file_key: str) -> tup
     Returns:
     tuple: A tuple containing the extracted text data and the temporary file path of the downloaded PDF.
     """
+    from botocore.exceptions import ClientError
+
     try:
         logging.info(f"Downloading PDF from S3: {file_key}")
 
         # Download the PDF from S3
-        s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-        pdf_file_bytes = s3_object['Body'].read()
+        with stage_timer("s3_download"):
+            s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+            pdf_file_bytes = s3_object['Body'].read()
 
         # Create a temporary file to store the PDF
         with tempfile.NamedTemporaryFile(delete=False, suffix='.pdf') as temp_pdf_file:
@@ -40,8 +46,9 @@ def process_pdf(s3_client: boto3.client, bucket_name: str, file_key: str) -> tup
         logging.info(f"Processing PDF: {file_key}")
 
         # Process the PDF
-        loader = PyPDFLoader(temp_pdf_path)
-        data = loader.load()
+        with stage_timer("parse"):
+            # Large PDFs are extracted by page ranges in parallel processes
+            data = load_pdf_pages(temp_pdf_path)
 
         logging.info(f"PDF processed successfully: {file_key}")
 
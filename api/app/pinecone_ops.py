@@ -1,76 +1,171 @@
-import os
-from typing import List
-from langchain.document_loaders import PyPDFLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.vectorstores import Pinecone
-from langchain.embeddings.openai import OpenAIEmbeddings
-import pinecone
+import uuid
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional
 import logging
+from app.metrics import INGESTED_CHUNKS, log_event, stage_timer, timed_iter
+from app.usage import current_document, record_response_usage
+from app.rate_limiter import INGESTION, call_openai, estimate_tokens
+from app.singleflight import SingleFlight
+from app.dedup import DEDUP_ENABLED, get_dedup_index, minhash_signature, strip_repeated_lines
+from app.clients import get_openai_client
+from app.embedding_index import EmbeddingSpec, open_active_index
+from app.retrieval_config import RetrievalConfig, get_retrieval_config
+from app.chunking import iter_chunks
+from app.document_summaries import fetch_vectors, store_document_summaries
 
+if TYPE_CHECKING:
+    from langchain.schema.document import Document
 
-def initialize_pinecone() -> None:
+# Identical chunks embedded concurrently (e.g. the same file uploaded twice)
+# share one OpenAI call
+embedding_flight = SingleFlight("ingest_embedding")
+
+
+def split_pdf_data(data: str, config: Optional[RetrievalConfig] = None) -> Iterator['Document']:
     """
-    Initialize Pinecone using the API key and environment specified in the environment variables.
+    Split the extracted documents into chunks along their structure, with a token budget.
+
+    Parameters:
+    data (str): The documents extracted from the file, e.g. its pages.
+    config (RetrievalConfig): The chunk and overlap tokens, by default the current retrieval config.
+
+    Returns:
+    Iterator[Document]: The chunks, produced as they are consumed.
     """
-    pinecone_api_key = os.environ.get('PINECONE_API_KEY')
-    pinecone_env = os.environ.get('PINECONE_API_ENV')
-    pinecone.init(
-        api_key=pinecone_api_key,
-        environment=pinecone_env
-    )
+    config = config or get_retrieval_config()
+    return iter_chunks(data, config.chunk_tokens, config.chunk_overlap_tokens)
 
 
-def split_pdf_data(data: str) -> List[str]:
+def embed_chunk(client, text: str, spec: EmbeddingSpec) -> List[float]:
     """
-    Split the PDF data into smaller chunks using RecursiveCharacterTextSplitter.
+    Embed one chunk at ingestion priority and record its usage.
 
     Parameters:
-    data (str): The text data extracted from the PDF.
+    client: The OpenAI client.
+    text (str): The chunk text.
+    spec (EmbeddingSpec): The model and vector length of the index the chunk is stored in.
 
     Returns:
-    list: A list of text chunks.
+    List[float]: The embedding of the chunk.
     """
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=2000, chunk_overlap=0
-    )
-    return text_splitter.split_documents(data)
+    with stage_timer("embed"):
+        response = call_openai(
+            client.embeddings, INGESTION, estimate_tokens(text),
+            input=[text], **spec.request_options())
+    record_response_usage("ingest_embedding", spec.model, response, embedding=True)
+    return response.data[0].embedding
 
 
-def generate_and_store_embeddings(data: str, temp_pdf_path: str) -> None:
+def embed_chunks(client, texts: List[str], spec: EmbeddingSpec, operation: str = "ingest_embedding") -> List[List[float]]:
+    """
+    Embed many chunks in one request at ingestion priority and record its usage.
+
+    Parameters:
+    client: The OpenAI client.
+    texts (List[str]): The chunk texts.
+    spec (EmbeddingSpec): The model and vector length of the index the chunks are stored in.
+    operation (str): The operation the usage is recorded under.
+
+    Returns:
+    List[List[float]]: The embeddings, in the order of `texts`.
+    """
+    with stage_timer("embed"):
+        response = call_openai(
+            client.embeddings, INGESTION, sum(estimate_tokens(text) for text in texts),
+            input=texts, **spec.request_options())
+    record_response_usage(operation, spec.model, response, embedding=True)
+    return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+
+
+def generate_and_store_embeddings(data: str, temp_pdf_path: str) -> Dict[str, int]:
     """
     Generate and store embeddings for the text data extracted from a PDF.
 
     Parameters:
     data (str): The text data extracted from the PDF.
     temp_pdf_path (str): The temporary file path where the PDF is stored.
-    """
-    # Initialize Pinecone if necessary
-    initialize_pinecone()
 
-    # Split the PDF data into smaller chunks
-    splitted_data = split_pdf_data(data)
-
-    # Set up OpenAI for embedding generation
-    openai_api_key = os.environ.get('OPENAI_API_KEY')
-    embeddings = OpenAIEmbeddings(openai_api_key=openai_api_key)
+    Returns:
+    dict: The number of chunks produced, stored, skipped, merged and failed.
+    """
+    # Drop headers, footers and disclaimers repeated on every page; the
+    # chunks are then produced one at a time as they are stored
+    with stage_timer("boilerplate"):
+        boilerplate_lines = strip_repeated_lines(data)
 
-    # Your Pinecone index name
-    index_name = os.environ.get('YOUR_INDEX_NAME')
+    client = get_openai_client()
 
-    # Create or update the index in Pinecone
-    if index_name not in pinecone.list_indexes():
-        pinecone.create_index(
-            name=index_name, dimension=embeddings.dimension, metric="cosine"
-        )
+    # The active index, created with the configured embedding spec if it does
+    # not exist yet; chunks are embedded with the spec it records
+    target, index = open_active_index()
 
-    # Generate and store embeddings
-    for i, chunk in enumerate(splitted_data):
-        logging.info(f"Processing chunk {i + 1} of {len(splitted_data)}")
+    # Generate and store embeddings, using the same record layout as
+    # langchain's Pinecone vector store (random id, text in the metadata) plus
+    # the documents containing the chunk. Chunks whose text is already in the
+    # index (within this document or from another one) are not embedded again.
+    document = current_document() or temp_pdf_path
+    dedup_index = get_dedup_index() if DEDUP_ENABLED else None
+    stored = skipped = merged = 0
+    # Chunk ids in document order, and the vectors embedded here, for the summaries
+    chunk_ids: List[str] = []
+    vectors: Dict[str, List[float]] = {}
+    chunks = 0
+    for i, chunk in enumerate(timed_iter("split", split_pdf_data(data))):
+        chunks += 1
         try:
-            docsearch = Pinecone.from_texts(
-                [chunk.page_content], embeddings, index_name=index_name
-            )
+            signature = None
+            if dedup_index is not None:
+                with stage_timer("dedup"):
+                    signature = minhash_signature(chunk.page_content)
+                    duplicate = dedup_index.find(signature)
+                if duplicate is not None:
+                    chunk_id, duplicate_document, _ = duplicate
+                    if duplicate_document == document:
+                        skipped += 1
+                    else:
+                        dedup_index.link(chunk_id, document)
+                        with stage_timer("upsert"):
+                            index.update(id=chunk_id, set_metadata={"documents": dedup_index.documents(chunk_id)})
+                        merged += 1
+                    chunk_ids.append(chunk_id)
+                    continue
+
+            vector = embedding_flight.do(
+                (target.spec, chunk.page_content),
+                lambda: embed_chunk(client, chunk.page_content, target.spec))
+            chunk_id = str(uuid.uuid4())
+            with stage_timer("upsert"):
+                index.upsert(vectors=[
+                    (chunk_id, vector, {"text": chunk.page_content, "documents": [document]})
+                ])
+            if signature is not None:
+                dedup_index.add(chunk_id, signature, document)
+            chunk_ids.append(chunk_id)
+            vectors[chunk_id] = vector
+            stored += 1
         except Exception as e:
             logging.error(f"Error processing chunk {i + 1}: {str(e)}")
 
-    logging.info("All chunks processed successfully")
+    failed = chunks - stored - skipped - merged
+    for status, count in (("stored", stored), ("skipped", skipped), ("merged", merged), ("failed", failed)):
+        if count:
+            INGESTED_CHUNKS.inc(count, status=status)
+    log_event("chunks_stored", chunks=chunks, stored=stored, skipped=skipped, merged=merged,
+              failed=failed, boilerplate_lines=boilerplate_lines)
+    if failed:
+        # Chunks are retried by the rate limiter; whatever still fails must not
+        # be reported as a successful ingestion
+        raise Exception(f"{failed} of {chunks} chunks could not be embedded and stored")
+
+    # Summary vectors for two-stage retrieval; duplicates were not embedded
+    # here, so their vectors are read back from the index. The chunks are
+    # already stored, so a failure here only costs the document its shortlist
+    # entry until it is ingested again, and must not fail the file
+    try:
+        vectors.update(fetch_vectors(index, [chunk_id for chunk_id in chunk_ids if chunk_id not in vectors]))
+        summaries = store_document_summaries(index, document, [vectors[chunk_id] for chunk_id in chunk_ids
+                                                               if chunk_id in vectors])
+        log_event("document_summaries_stored", document=document, summaries=summaries)
+    except Exception as e:
+        log_event("document_summaries_failed", level=logging.WARNING, document=document, error=str(e))
+    return {"chunks": chunks, "stored": stored, "skipped": skipped, "merged": merged,
+            "failed": failed, "boilerplate_lines": boilerplate_lines}
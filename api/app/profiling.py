@@ -0,0 +1,361 @@
+import functools
+import glob
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter as Tally
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional
+from urllib.parse import parse_qs
+
+from fastapi import HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
+
+from app.metrics import current_request, log_event
+from app.utils import check_admin_key
+
+# An admin can profile a single request by sending `X-Profile: 1` (or the
+# `profile=1` query flag) with the admin key. A sampler thread then records the
+# stacks of the threads working for that request, and tracemalloc the memory
+# it allocated. Tracing allocations slows the whole worker several times, so
+# `cpu` or `memory` instead of `1` profiles only one of them. Unprofiled
+# requests only pay for a header check and, where work is handed to a
+# thread, a context variable lookup.
+
+# Where profile artifacts are written; shared by the workers, so any of them serves the downloads
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+# Most recent profiles kept; older ones are deleted
+PROFILE_KEEP = int(os.environ.get('PROFILE_KEEP', '20'))
+# Stack samples per second of the threads of a profiled request
+PROFILE_SAMPLE_HZ = float(os.environ.get('PROFILE_SAMPLE_HZ', '100'))
+# Frames kept per allocation traceback; deeper tracebacks make profiled requests slower
+TRACEMALLOC_FRAMES = int(os.environ.get('PROFILE_TRACEMALLOC_FRAMES', '10'))
+# Functions and allocation sites listed in a profile's summary
+SUMMARY_TOP = 15
+PROFILE_KINDS = {"cpu": "cpu.folded", "memory": "memory.folded"}
+ARTIFACTS = tuple(PROFILE_KINDS.values())
+
+_PROFILE_ID = re.compile(r"^[0-9a-f]{32}$")
+
+
+@functools.lru_cache(maxsize=None)
+def _short_path(path: str) -> str:
+    """The path of a source file relative to the entry of `sys.path` it was imported from."""
+    for root in sorted(sys.path, key=len, reverse=True):
+        if root and path.startswith(root + os.sep):
+            return path[len(root) + 1:]
+    return path
+
+
+def _fold(frame) -> str:
+    """The stack of a frame in the collapsed format of flamegraph.pl: outermost first, `;` separated."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})".replace(";", ","))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class ProfileSession:
+    """The CPU samples and memory snapshot of one profiled request."""
+
+    def __init__(self, profile_id: str, method: str, path: str, kinds: Iterable[str] = PROFILE_KINDS) -> None:
+        self.id = profile_id
+        self.method = method
+        self.path = path
+        self.kinds = [kind for kind in PROFILE_KINDS if kind in kinds]
+        self.samples: Tally = Tally()
+        self._threads: Dict[int, int] = {}
+        self._lock = threading.Lock()
+        self._memory_start: Optional[tracemalloc.Snapshot] = None
+
+    @contextmanager
+    def thread(self) -> Iterator[None]:
+        """Sample the calling thread while inside the block."""
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = self._threads.get(ident, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._threads[ident] -= 1
+                if not self._threads[ident]:
+                    del self._threads[ident]
+
+    def sample(self, frames: Dict[int, Any]) -> None:
+        with self._lock:
+            idents = list(self._threads)
+        for ident in idents:
+            frame = frames.get(ident)
+            if frame is not None:
+                self.samples[_fold(frame)] += 1
+
+
+class _Profiler:
+    """Samples the threads of every active session and shares tracemalloc between them."""
+
+    def __init__(self) -> None:
+        self._sampled: List[ProfileSession] = []
+        self._traced: List[ProfileSession] = []
+        self._lock = threading.Lock()
+        # Set to stop the running sampler thread; a new one gets a new event
+        self._stopped: Optional[threading.Event] = None
+        self._started_tracemalloc = False
+
+    def start(self, session: ProfileSession) -> None:
+        baseline = False
+        with self._lock:
+            if "cpu" in session.kinds:
+                self._sampled.append(session)
+                if self._stopped is None:
+                    self._stopped = threading.Event()
+                    threading.Thread(target=self._run, args=(self._stopped,), name="profiler", daemon=True).start()
+            if "memory" in session.kinds:
+                if not self._traced:
+                    if not tracemalloc.is_tracing():
+                        tracemalloc.start(TRACEMALLOC_FRAMES)
+                        self._started_tracemalloc = True
+                    tracemalloc.reset_peak()
+                # Unless tracing just started, allocations made before the request are traced too
+                baseline = not self._started_tracemalloc or bool(self._traced)
+                self._traced.append(session)
+        if baseline:
+            session._memory_start = tracemalloc.take_snapshot()
+
+    def stop(self, session: ProfileSession) -> Optional[Dict[str, Any]]:
+        """Stop profiling a session and return its memory snapshot, taken before tracemalloc may stop."""
+        memory = None
+        if "memory" in session.kinds:
+            memory = {"snapshot": tracemalloc.take_snapshot(), "peak": tracemalloc.get_traced_memory()[1]}
+        with self._lock:
+            if session in self._sampled:
+                self._sampled.remove(session)
+                if not self._sampled:
+                    self._stopped.set()
+                    self._stopped = None
+            if session in self._traced:
+                self._traced.remove(session)
+                if not self._traced and self._started_tracemalloc:
+                    tracemalloc.stop()
+                    self._started_tracemalloc = False
+        return memory
+
+    def _run(self, stopped: threading.Event) -> None:
+        interval = 1.0 / PROFILE_SAMPLE_HZ
+        me = threading.get_ident()
+        while not stopped.wait(interval):
+            frames = sys._current_frames()
+            frames.pop(me, None)
+            with self._lock:
+                sessions = list(self._sampled)
+            for session in sessions:
+                session.sample(frames)
+
+
+_profiler = _Profiler()
+
+
+def current_profile() -> Optional[ProfileSession]:
+    """Return the profile session of the request being handled, if it is profiled."""
+    context = current_request()
+    return context.state.get("profile") if context is not None else None
+
+
+@contextmanager
+def profile_thread() -> Iterator[None]:
+    """Sample the calling thread while inside the block, if it works for a profiled request."""
+    session = current_profile()
+    if session is None:
+        yield
+        return
+    with session.thread():
+        yield
+
+
+def profiled(func: Callable[..., Any]) -> Callable[..., Any]:
+    """Wrap a function handed to a worker thread so that thread is sampled for a profiled request."""
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        with profile_thread():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _allocations(snapshot: tracemalloc.Snapshot, start: Optional[tracemalloc.Snapshot],
+                 key_type: str) -> List[tracemalloc.StatisticDiff]:
+    """The memory allocated since `start`, or since tracing started, and not freed, largest first."""
+    if start is None:
+        stats = [tracemalloc.StatisticDiff(stat.traceback, stat.size, stat.size, stat.count, stat.count)
+                 for stat in snapshot.statistics(key_type)]
+    else:
+        stats = snapshot.compare_to(start, key_type)
+    return [stat for stat in stats if stat.size_diff > 0]
+
+
+def _memory_folded(allocations: List[tracemalloc.StatisticDiff]) -> List[str]:
+    return [";".join(f"{_short_path(frame.filename)}:{frame.lineno}" for frame in stat.traceback) + f" {stat.size_diff}"
+            for stat in allocations]
+
+
+def _finish_profile(session: ProfileSession, seconds: float, status: int) -> Optional[Dict[str, Any]]:
+    """Stop profiling a request and write its artifacts; return its summary."""
+    memory = _profiler.stop(session)
+    try:
+        return _write_profile(session, seconds, status, memory)
+    except Exception as e:
+        logging.error(f"Could not write profile {session.id}: {e}")
+        return None
+
+
+def _write_profile(session: ProfileSession, seconds: float, status: int,
+                   memory: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {
+        "id": session.id, "method": session.method, "path": session.path, "status": status,
+        "created_at": time.time(), "seconds": round(seconds, 4),
+        "artifacts": [PROFILE_KINDS[kind] for kind in session.kinds],
+    }
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    base = os.path.join(PROFILE_DIR, session.id)
+    if "cpu" in session.kinds:
+        own_time: Tally = Tally()
+        for stack, count in session.samples.items():
+            own_time[stack.rsplit(";", 1)[-1]] += count
+        summary["cpu"] = {
+            "samples": sum(session.samples.values()), "sample_hz": PROFILE_SAMPLE_HZ,
+            "top_functions": [{"function": name, "samples": count} for name, count in own_time.most_common(SUMMARY_TOP)],
+        }
+        with open(f"{base}.cpu.folded", "w") as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in sorted(session.samples.items()))
+    if memory is not None:
+        # Leave out the profiler's own allocations, like the sampled stacks
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__),
+                   tracemalloc.Filter(False, "<frozen importlib._bootstrap*>")]
+        snapshot = memory["snapshot"].filter_traces(filters)
+        start = session._memory_start.filter_traces(filters) if session._memory_start is not None else None
+        allocations = _allocations(snapshot, start, "lineno")
+        summary["memory"] = {
+            "peak_bytes": memory["peak"],
+            "retained_bytes": sum(stat.size_diff for stat in allocations),
+            "top_allocations": [{"line": f"{_short_path(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                                 "bytes": stat.size_diff, "blocks": stat.count_diff}
+                                for stat in allocations[:SUMMARY_TOP]],
+        }
+        with open(f"{base}.memory.folded", "w") as f:
+            f.writelines(line + "\n" for line in _memory_folded(_allocations(snapshot, start, "traceback")))
+    # The summary is written last: a profile is listed once its artifacts exist
+    with open(f"{base}.json", "w") as f:
+        json.dump(summary, f)
+    _prune_profiles()
+    log_event("request_profiled", profile_id=session.id, path=session.path, seconds=summary["seconds"],
+              kinds=session.kinds)
+    return summary
+
+
+def _prune_profiles() -> None:
+    summaries = sorted(glob.glob(os.path.join(PROFILE_DIR, "*.json")), key=os.path.getmtime, reverse=True)
+    for path in summaries[PROFILE_KEEP:]:
+        base = path[:-len(".json")]
+        for artifact in (path, *(f"{base}.{name}" for name in ARTIFACTS)):
+            try:
+                os.remove(artifact)
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles() -> List[Dict[str, Any]]:
+    """The summaries of the kept profiles, most recent first."""
+    profiles = []
+    for path in glob.glob(os.path.join(PROFILE_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                profiles.append(json.load(f))
+        except (OSError, ValueError):
+            continue
+    return sorted(profiles, key=lambda profile: -profile["created_at"])
+
+
+def profile_path(profile_id: str, artifact: str = "json") -> str:
+    """
+    Return the path of a profile's summary or artifact.
+
+    Raises:
+    HTTPException: 404 when the profile or the artifact does not exist.
+    """
+    if not _PROFILE_ID.match(profile_id) or artifact not in ("json",) + ARTIFACTS:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    path = os.path.join(PROFILE_DIR, f"{profile_id}.{artifact}")
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return path
+
+
+def _requested_kinds(scope) -> List[str]:
+    """What the `X-Profile` header or `profile` query flag asks to profile: `1` for everything, or `cpu`, `memory`."""
+    value = dict(scope.get("headers") or []).get(b"x-profile", b"").decode("latin-1")
+    if not value:
+        value = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("profile", [""])[-1]
+    value = value.strip().lower()
+    if value in ("1", "true", "all"):
+        return list(PROFILE_KINDS)
+    return [kind for kind in PROFILE_KINDS if kind in value.split(",")]
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles the requests an admin asks to profile.
+
+    It runs inside `MetricsMiddleware`, whose request context carries the
+    session to the threads working for the request. The profile id, the
+    request id, is returned in the `X-Profile-Id` header, and the artifacts
+    are written before the last body chunk is sent.
+    """
+
+    def __init__(self, app) -> None:
+        self.app = app
+
+    async def __call__(self, scope, receive, send) -> None:
+        kinds = _requested_kinds(scope) if scope["type"] == "http" else []
+        if not kinds:
+            await self.app(scope, receive, send)
+            return
+        try:
+            check_admin_key(dict(scope.get("headers") or []).get(b"x-admin-key", b"").decode("latin-1") or None)
+        except HTTPException as e:
+            await JSONResponse({"detail": e.detail}, status_code=e.status_code)(scope, receive, send)
+            return
+
+        context = current_request()
+        session = ProfileSession(context.request_id, scope["method"], scope["path"], kinds)
+        context.state["profile"] = session
+        _profiler.start(session)
+        started = time.perf_counter()
+        status = {"code": 500, "finished": False}
+
+        async def finish() -> None:
+            if not status["finished"]:
+                status["finished"] = True
+                await run_in_threadpool(_finish_profile, session, time.perf_counter() - started, status["code"])
+
+        async def send_with_profile(message) -> None:
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                message = {**message, "headers": list(message.get("headers", [])) + [
+                    (b"x-profile-id", session.id.encode("latin-1"))]}
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                await finish()
+            await send(message)
+
+        # The handler's own async code runs on the event loop thread, which is
+        # shared with other requests, so only the threads it hands work to are sampled
+        try:
+            await self.app(scope, receive, send_with_profile)
+        finally:
+            await finish()
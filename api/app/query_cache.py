@@ -0,0 +1,233 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from app.metrics import Counter
+
+QUERY_CACHE_ENABLED = os.environ.get('QUERY_CACHE_ENABLED', '1').lower() not in ("0", "false", "no")
+# Seconds a cached retrieval or answer is served, as long as no document was ingested since
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', '86400'))
+# A query asked this many seconds ago counts half as much as one asked now
+QUERY_LOG_HALF_LIFE = float(os.environ.get('QUERY_LOG_HALF_LIFE', '86400'))
+# Least frequent queries beyond this are forgotten
+MAX_LOGGED_QUERIES = 10000
+
+QUERY_CACHE_LOOKUPS = Counter(
+    "chatpdf_query_cache_lookups_total", "Chat queries looked up in the query cache, by what was found.", ("result",))
+
+
+def query_key(query: str) -> str:
+    """The cache key of a query: queries that only differ in whitespace share it."""
+    return " ".join(query.split())
+
+
+class CachedQuery(NamedTuple):
+    """What is cached for a query; `context` and `answer` are None when missing or stale."""
+
+    vector: Optional[List[float]]
+    context: Optional[str]
+    answer: Optional[str]
+
+
+class QueryCache:
+    """
+    SQLite-backed log of recent chat queries and cache of their vectors,
+    retrieved context and answers, shared by the workers of this instance.
+
+    Query vectors only go stale when the index is migrated to another
+    embedding model, which drops them. Contexts and answers are only served
+    while they are younger than QUERY_CACHE_TTL and no document was ingested
+    since they were computed: each ingestion bumps the corpus generation,
+    here right away and on other instances once they read the corpus change
+    recorded in Pinecone.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_log ("
+                " query_key TEXT PRIMARY KEY,"
+                " query TEXT NOT NULL,"
+                " score REAL NOT NULL,"
+                " last_seen REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS query_cache ("
+                " query_key TEXT PRIMARY KEY,"
+                " vector BLOB,"
+                " context TEXT,"
+                " answer TEXT,"
+                " generation INTEGER NOT NULL DEFAULT 0,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache_state ("
+                " name TEXT PRIMARY KEY,"
+                " value REAL NOT NULL)"
+            )
+
+    def _state(self, name: str, default: Optional[float] = 0.0) -> Optional[float]:
+        row = self._conn.execute("SELECT value FROM cache_state WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def generation(self) -> int:
+        """The corpus generation, bumped by every ingestion."""
+        with self._lock:
+            return int(self._state("generation"))
+
+    def bump_generation(self) -> int:
+        """Mark every cached context and answer as stale; return the new generation."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO cache_state (name, value) VALUES ('generation', 1)"
+                " ON CONFLICT (name) DO UPDATE SET value = value + 1")
+            return int(self._state("generation"))
+
+    def observe_corpus_change(self, change: float, bump: bool = True) -> bool:
+        """
+        Note the last corpus change recorded for every instance, bumping the
+        generation if it was not seen yet; return whether it was bumped.
+
+        `bump` is False for a change this instance made, already followed by
+        a bump. Workers share the database, so one change bumps it once.
+        """
+        with self._lock, self._conn:
+            if self._state("corpus_change", None) == change:
+                return False
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache_state (name, value) VALUES ('corpus_change', ?)", (change,))
+            if bump:
+                self._conn.execute(
+                    "INSERT INTO cache_state (name, value) VALUES ('generation', 1)"
+                    " ON CONFLICT (name) DO UPDATE SET value = value + 1")
+            return bump
+
+    def forget_vectors(self) -> None:
+        """Drop every cached query vector, e.g. once the index has switched embedding models."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE query_cache SET vector = NULL")
+
+    def record(self, query: str) -> None:
+        """Count one more occurrence of a query in the frequency log."""
+        key, now = query_key(query), time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT score, last_seen FROM query_log WHERE query_key = ?", (key,)).fetchone()
+            score = 1.0 + (row[0] * 0.5 ** ((now - row[1]) / QUERY_LOG_HALF_LIFE) if row else 0.0)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_log (query_key, query, score, last_seen) VALUES (?, ?, ?, ?)",
+                (key, query, score, now))
+
+    def top_queries(self, limit: Optional[int] = None) -> List[Tuple[str, float]]:
+        """The most frequent recent queries as (query, decayed count), most frequent first."""
+        now = time.time()
+        with self._lock:
+            rows = self._conn.execute("SELECT query, score, last_seen FROM query_log").fetchall()
+        ranked = sorted(((query, score * 0.5 ** ((now - last_seen) / QUERY_LOG_HALF_LIFE))
+                         for query, score, last_seen in rows), key=lambda item: -item[1])
+        return ranked[:limit]
+
+    def prune(self) -> int:
+        """Forget the least frequent queries beyond MAX_LOGGED_QUERIES; return how many were dropped."""
+        dropped = [query_key(query) for query, _ in self.top_queries()[MAX_LOGGED_QUERIES:]]
+        if dropped:
+            with self._lock, self._conn:
+                self._conn.executemany("DELETE FROM query_log WHERE query_key = ?", [(key,) for key in dropped])
+                self._conn.executemany("DELETE FROM query_cache WHERE query_key = ?", [(key,) for key in dropped])
+        return len(dropped)
+
+    def lookup(self, query: str) -> CachedQuery:
+        """Return what is cached for a query, leaving out stale contexts and answers."""
+        with self._lock:
+            generation = int(self._state("generation"))
+            row = self._conn.execute(
+                "SELECT vector, context, answer, generation, updated_at FROM query_cache WHERE query_key = ?",
+                (query_key(query),)).fetchone()
+        if row is None:
+            QUERY_CACHE_LOOKUPS.inc(result="miss")
+            return CachedQuery(None, None, None)
+        vector = np.frombuffer(row[0], dtype=np.float32).tolist() if row[0] else None
+        if row[3] != generation or time.time() - row[4] > QUERY_CACHE_TTL:
+            QUERY_CACHE_LOOKUPS.inc(result="vector" if vector else "miss")
+            return CachedQuery(vector, None, None)
+        QUERY_CACHE_LOOKUPS.inc(result="answer" if row[2] is not None else "context" if row[1] is not None else "vector")
+        return CachedQuery(vector, row[1], row[2])
+
+    def last_known(self, query: str) -> CachedQuery:
+        """Return what is cached for a query however stale; the fallback when there is no time to compute it."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT vector, context, answer FROM query_cache WHERE query_key = ?", (query_key(query),)).fetchone()
+        if row is None:
+            return CachedQuery(None, None, None)
+        return CachedQuery(np.frombuffer(row[0], dtype=np.float32).tolist() if row[0] else None, row[1], row[2])
+
+    def store(self, query: str, vector: List[float], context: Optional[str], answer: Optional[str],
+              generation: int) -> None:
+        """
+        Cache what was computed for a query.
+
+        `generation` must be read before retrieving the context, so an
+        ingestion finishing meanwhile leaves the entry stale.
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO query_cache (query_key, vector, context, answer, generation, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                (query_key(query), np.asarray(vector, dtype=np.float32).tobytes(), context, answer,
+                 generation, time.time()))
+
+    def is_fresh(self, query: str) -> bool:
+        """Whether a current answer is cached for a query."""
+        with self._lock:
+            generation = int(self._state("generation"))
+            row = self._conn.execute(
+                "SELECT generation, updated_at FROM query_cache WHERE query_key = ? AND answer IS NOT NULL",
+                (query_key(query),)).fetchone()
+        return row is not None and row[0] == generation and time.time() - row[1] <= QUERY_CACHE_TTL
+
+    def try_lease(self, name: str, seconds: float) -> bool:
+        """Take a named lease for `seconds` unless another worker holds it; used to run one warm cycle at a time."""
+        now = time.time()
+        with self._lock, self._conn:
+            # One statement, so two workers cannot both see the lease expired
+            cursor = self._conn.execute(
+                "INSERT INTO cache_state (name, value) VALUES (?, ?)"
+                " ON CONFLICT (name) DO UPDATE SET value = excluded.value WHERE value <= ?",
+                (f"lease:{name}", now + seconds, now))
+            return cursor.rowcount == 1
+
+    def release_lease(self, name: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM cache_state WHERE name = ?", (f"lease:{name}",))
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        with self._lock:
+            logged = self._conn.execute("SELECT COUNT(*) FROM query_log").fetchone()[0]
+            generation = int(self._state("generation"))
+            answers = self._conn.execute(
+                "SELECT COUNT(*) FROM query_cache WHERE answer IS NOT NULL AND generation = ? AND updated_at >= ?",
+                (generation, time.time() - QUERY_CACHE_TTL)).fetchone()[0]
+        return {"logged_queries": logged, "fresh_answers": answers, "generation": generation}
+
+
+_cache: Optional[QueryCache] = None
+_cache_lock = threading.Lock()
+
+
+def get_query_cache() -> QueryCache:
+    """Return the process-wide query cache, opening it on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = QueryCache(os.environ.get('QUERY_CACHE_DB_PATH', 'query_cache.db'))
+    return _cache
@@ -0,0 +1,241 @@
+import logging
+import os
+import random
+import re
+import threading
+import time
+from typing import Any, Dict, Mapping, Optional
+
+import openai
+
+from app.deadlines import attempt_abandoned, remaining
+from app.metrics import Counter, Histogram, current_request
+
+# Call priorities: chat requests are user facing, ingestion fills the remaining quota
+CHAT = "chat"
+INGESTION = "ingestion"
+
+# Share of each bucket that ingestion leaves untouched so chat never starts from empty
+CHAT_RESERVE_FRACTION = float(os.environ.get('OPENAI_CHAT_RESERVE', '0.1'))
+# Starting limits per model and worker, until the API reports the real ones in its headers
+DEFAULT_REQUESTS_PER_MINUTE = float(os.environ.get('OPENAI_RPM_LIMIT', '500'))
+DEFAULT_TOKENS_PER_MINUTE = float(os.environ.get('OPENAI_TPM_LIMIT', '150000'))
+MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '5'))
+BACKOFF_BASE_SECONDS = 0.5
+BACKOFF_MAX_SECONDS = 30.0
+
+RATE_LIMITED = Counter(
+    "chatpdf_openai_rate_limited_total", "OpenAI calls rejected with HTTP 429.", ("model", "priority"))
+RETRIES = Counter(
+    "chatpdf_openai_retries_total", "OpenAI calls retried after a transient error.", ("model", "reason"))
+LIMITER_WAIT = Histogram(
+    "chatpdf_rate_limiter_wait_seconds", "Time spent waiting for rate limiter capacity.", ("priority",))
+
+_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """Parse OpenAI reset durations such as `20ms`, `1s` or `6m0s` into seconds."""
+    if not value:
+        return None
+    matches = _DURATION_RE.findall(value)
+    if not matches:
+        try:
+            return float(value)
+        except ValueError:
+            return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in matches)
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~4 characters per token) used to reserve capacity."""
+    return len(text) // 4 + 1
+
+
+class _Bucket:
+    """Token bucket refilled continuously at `capacity` units per minute."""
+
+    def __init__(self, per_minute: float) -> None:
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+    @property
+    def rate(self) -> float:
+        return self.capacity / 60.0
+
+    def refill(self, now: float) -> None:
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, reserve: float) -> float:
+        """Seconds until `amount` can be taken while leaving `reserve` in the bucket."""
+        amount = min(amount, self.capacity * (1 - CHAT_RESERVE_FRACTION))
+        missing = amount + reserve - self.level
+        return missing / self.rate if missing > 0 else 0.0
+
+
+class RateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute limiter for one OpenAI model.
+
+    Chat callers are served before ingestion callers, and ingestion may only
+    use capacity above the chat reserve. Limits and remaining capacity follow
+    the `x-ratelimit-*` headers returned by the API.
+    """
+
+    def __init__(self, requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE,
+                 tokens_per_minute: float = DEFAULT_TOKENS_PER_MINUTE) -> None:
+        self.requests = _Bucket(requests_per_minute)
+        self.tokens = _Bucket(tokens_per_minute)
+        self._paused_until = 0.0
+        self._waiting = {CHAT: 0, INGESTION: 0}
+        self._condition = threading.Condition()
+
+    def acquire(self, tokens: int, priority: str = CHAT) -> float:
+        """Block until one request and `tokens` tokens are available; return the wait in seconds."""
+        started = time.monotonic()
+        with self._condition:
+            self._waiting[priority] += 1
+            try:
+                while True:
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                    if priority == INGESTION:
+                        if self._waiting[CHAT]:
+                            self._condition.wait(timeout=0.05)
+                            continue
+                        reserve = CHAT_RESERVE_FRACTION
+                    else:
+                        reserve = 0.0
+                    delay = max(
+                        self._paused_until - now,
+                        self.requests.delay(1, reserve * self.requests.capacity),
+                        self.tokens.delay(tokens, reserve * self.tokens.capacity),
+                    )
+                    if delay <= 0:
+                        self.requests.level -= 1
+                        self.tokens.level -= tokens
+                        return time.monotonic() - started
+                    self._condition.wait(timeout=min(delay, 1.0))
+            finally:
+                self._waiting[priority] -= 1
+                self._condition.notify_all()
+
+    def settle(self, reserved: int, used: int) -> None:
+        """Correct the token bucket once the real usage of a call is known."""
+        with self._condition:
+            self.tokens.level = min(self.tokens.capacity, self.tokens.level + reserved - used)
+            self._condition.notify_all()
+
+    def pause(self, seconds: float) -> None:
+        """Stop handing out capacity for `seconds`, e.g. after a 429."""
+        with self._condition:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers: Mapping[str, str]) -> None:
+        """Adapt limits and remaining capacity to the API's `x-ratelimit-*` headers."""
+        with self._condition:
+            for bucket, kind in ((self.requests, "requests"), (self.tokens, "tokens")):
+                limit = headers.get(f"x-ratelimit-limit-{kind}")
+                remaining = headers.get(f"x-ratelimit-remaining-{kind}")
+                try:
+                    if limit:
+                        bucket.capacity = max(1.0, float(limit))
+                    if remaining is not None:
+                        bucket.refill(time.monotonic())
+                        bucket.level = min(bucket.level, float(remaining))
+                except ValueError:
+                    continue
+            self._condition.notify_all()
+
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(model: str) -> RateLimiter:
+    """Return the limiter shared by every caller of `model` in this process."""
+    limiter = _limiters.get(model)
+    if limiter is None:
+        with _limiters_lock:
+            limiter = _limiters.setdefault(model, RateLimiter())
+    return limiter
+
+
+def _backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter."""
+    return random.uniform(0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt))
+
+
+def _retry_after(headers: Mapping[str, str]) -> Optional[float]:
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    if headers.get("retry-after"):
+        try:
+            return float(headers["retry-after"])
+        except ValueError:
+            pass
+    resets = [parse_reset_duration(headers.get(f"x-ratelimit-reset-{kind}")) for kind in ("requests", "tokens")]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+
+def call_openai(resource: Any, priority: str, estimated_tokens: int, **kwargs: Any) -> Any:
+    """
+    Call `resource.create(**kwargs)` through the model's rate limiter.
+
+    Rate-limited (429), server and connection errors are retried with jittered
+    exponential backoff, honouring `retry-after` when the API sends it. No
+    retry is made once it could not finish before the request's deadline, or
+    when the call is a hedged attempt that lost.
+
+    Parameters:
+    resource: An OpenAI client resource, e.g. `client.embeddings`.
+    priority (str): `CHAT` or `INGESTION`.
+    estimated_tokens (int): Tokens to reserve (prompt plus `max_tokens`).
+
+    Returns:
+    The parsed OpenAI response.
+    """
+    model = kwargs.get("model", "default")
+    limiter = get_rate_limiter(model)
+    for attempt in range(MAX_RETRIES + 1):
+        waited = limiter.acquire(estimated_tokens, priority)
+        LIMITER_WAIT.observe(waited, priority=priority)
+        context = current_request()
+        if context is not None and waited > 0.001:
+            context.timings.append(("rate_limit_wait", waited))
+        try:
+            raw = resource.with_raw_response.create(**kwargs)
+        except openai.RateLimitError as e:
+            RATE_LIMITED.inc(model=model, priority=priority)
+            headers = e.response.headers
+            limiter.update_from_headers(headers)
+            delay = max(_retry_after(headers) or 0.0, _backoff(attempt))
+            limiter.pause(delay)
+            reason = "rate_limited"
+            error: Exception = e
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            delay = _backoff(attempt)
+            reason = "timeout" if isinstance(e, openai.APITimeoutError) else "server_error"
+            error = e
+        else:
+            limiter.update_from_headers(raw.headers)
+            response = raw.parse()
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                limiter.settle(estimated_tokens, getattr(usage, "total_tokens", estimated_tokens) or 0)
+            return response
+
+        limiter.settle(estimated_tokens, 0)
+        if attempt == MAX_RETRIES or delay >= remaining() or attempt_abandoned():
+            raise error
+        RETRIES.inc(model=model, reason=reason)
+        logging.warning(f"OpenAI call to {model} failed ({reason}), retry {attempt + 1} in {delay:.2f}s")
+        time.sleep(delay)
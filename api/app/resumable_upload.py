@@ -0,0 +1,381 @@
+import base64
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple, Union
+
+from fastapi import HTTPException
+
+from app.metrics import log_event
+from app.s3_operations import (abort_multipart_upload, complete_multipart_upload, copy_object,
+                               create_multipart_upload, delete_object, object_sha256, upload_part)
+
+# S3 requires every part but the last to be at least 5 MiB, and allows 10000 parts
+MIN_CHUNK_SIZE = 5 * 1024 * 1024
+MAX_CHUNK_SIZE = 64 * 1024 * 1024
+MAX_CHUNKS = 10000
+DEFAULT_CHUNK_SIZE = int(os.environ.get('UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+# Unfinished uploads are aborted (and their S3 parts freed) after this many seconds
+UPLOAD_SESSION_TTL = int(os.environ.get('UPLOAD_SESSION_TTL', str(24 * 3600)))
+# Uploads are assembled under a key of their own below this prefix, and only
+# copied to their filename to be processed, so discarding one never deletes a
+# file another upload stored under the same name
+UPLOAD_STAGING_PREFIX = os.environ.get('UPLOAD_STAGING_PREFIX', 'uploads/')
+
+SUPPORTED_EXTENSIONS = ("pdf", "docx", "pptx", "mp3", "m4a")
+
+# An upload is `completing` while it is assembled and processed, and only
+# `completed` once the file was processed; an `assembled` upload whose
+# processing failed is processed again by the next `/complete`
+OPEN = "open"
+COMPLETING = "completing"
+ASSEMBLED = "assembled"
+COMPLETED = "completed"
+
+
+class UploadSessionStore:
+    """
+    SQLite-backed state of the resumable uploads.
+
+    The chunks of one upload may reach different gunicorn workers, so the
+    sessions and their received parts live in a database they all share.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS upload_sessions ("
+                " upload_id TEXT PRIMARY KEY,"
+                " filename TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " chunk_size INTEGER NOT NULL,"
+                " total_chunks INTEGER NOT NULL,"
+                " s3_upload_id TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS upload_chunks ("
+                " upload_id TEXT NOT NULL,"
+                " chunk_index INTEGER NOT NULL,"
+                " etag TEXT NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " sha256 TEXT NOT NULL,"
+                " PRIMARY KEY (upload_id, chunk_index))"
+            )
+
+    def create(self, session: Dict[str, Union[str, int, float]]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO upload_sessions (upload_id, filename, size, chunk_size, total_chunks,"
+                " s3_upload_id, status, created_at) VALUES (:upload_id, :filename, :size, :chunk_size,"
+                " :total_chunks, :s3_upload_id, :status, :created_at)",
+                session,
+            )
+
+    def get(self, upload_id: str) -> Optional[Dict[str, Union[str, int, float]]]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM upload_sessions WHERE upload_id = ?", (upload_id,)).fetchone()
+        return dict(row) if row else None
+
+    def add_chunk(self, upload_id: str, chunk_index: int, etag: str, size: int, sha256: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO upload_chunks (upload_id, chunk_index, etag, size, sha256)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (upload_id, chunk_index, etag, size, sha256),
+            )
+
+    def chunks(self, upload_id: str) -> List[Dict[str, Union[str, int]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chunk_index, etag, size, sha256 FROM upload_chunks"
+                " WHERE upload_id = ? ORDER BY chunk_index", (upload_id,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def transition(self, upload_id: str, from_status: str, to_status: str) -> bool:
+        """Atomically move a session between states; False if it was not in `from_status`."""
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE upload_sessions SET status = ? WHERE upload_id = ? AND status = ?",
+                (to_status, upload_id, from_status))
+        return cursor.rowcount == 1
+
+    def delete(self, upload_id: str) -> None:
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM upload_chunks WHERE upload_id = ?", (upload_id,))
+            self._conn.execute("DELETE FROM upload_sessions WHERE upload_id = ?", (upload_id,))
+
+    def expired(self, before: float) -> List[Dict[str, Union[str, int, float]]]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM upload_sessions WHERE created_at < ?", (before,)).fetchall()
+        return [dict(row) for row in rows]
+
+
+_store: Optional[UploadSessionStore] = None
+_store_lock = threading.Lock()
+
+
+def get_upload_store() -> UploadSessionStore:
+    """Return the process-wide upload session store, opening it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = UploadSessionStore(os.environ.get('UPLOAD_DB_PATH', 'uploads.db'))
+    return _store
+
+
+def _get_session(upload_id: str) -> Dict[str, Union[str, int, float]]:
+    session = get_upload_store().get(upload_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail=f"Unknown upload: {upload_id}")
+    return session
+
+
+def _staging_key(session: Dict[str, Union[str, int, float]]) -> str:
+    return f"{UPLOAD_STAGING_PREFIX}{session['upload_id']}/{session['filename']}"
+
+
+def _discard_upload(session: Dict[str, Union[str, int, float]]) -> None:
+    """Free the S3 storage of an unfinished upload: its parts, or the assembled object."""
+    if session["status"] == ASSEMBLED:
+        delete_object(_staging_key(session))
+    else:
+        abort_multipart_upload(_staging_key(session), session["s3_upload_id"])
+
+
+def _abort_expired_uploads() -> None:
+    from botocore.exceptions import ClientError
+    store = get_upload_store()
+    for session in store.expired(time.time() - UPLOAD_SESSION_TTL):
+        if session["status"] != COMPLETED:
+            try:
+                _discard_upload(session)
+            except ClientError as e:
+                logging.error(f"Error aborting expired upload {session['upload_id']}: {e}")
+            log_event("upload_expired", upload_id=session["upload_id"], filename=session["filename"])
+        store.delete(session["upload_id"])
+
+
+def expected_chunk_size(session: Dict[str, Union[str, int, float]], index: int) -> int:
+    """Size in bytes of chunk `index`: `chunk_size` for every chunk but the last."""
+    if not 0 <= index < session["total_chunks"]:
+        raise HTTPException(
+            status_code=400, detail=f"Chunk index must be between 0 and {session['total_chunks'] - 1}")
+    if index < session["total_chunks"] - 1:
+        return session["chunk_size"]
+    return session["size"] - session["chunk_size"] * (session["total_chunks"] - 1)
+
+
+def _received_ranges(chunks: List[Dict[str, Union[str, int]]], chunk_size: int) -> List[Tuple[int, int]]:
+    ranges: List[Tuple[int, int]] = []
+    for chunk in chunks:
+        start = chunk["chunk_index"] * chunk_size
+        end = start + chunk["size"]
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end)
+        else:
+            ranges.append((start, end))
+    return ranges
+
+
+def create_upload(filename: str, size: int, chunk_size: Optional[int] = None) -> Dict[str, Union[str, int]]:
+    """
+    Start a resumable upload and the S3 multipart upload behind it.
+
+    Parameters:
+    filename (str): The name of the file; it is also the S3 key it is processed under.
+    size (int): The size of the file in bytes.
+    chunk_size (int): The size of every chunk but the last (default `UPLOAD_CHUNK_SIZE`).
+
+    Returns:
+    dict: The upload id, chunk size and number of chunks to send.
+    """
+    extension = filename.split(".")[-1].lower()
+    if extension not in SUPPORTED_EXTENSIONS:
+        raise HTTPException(status_code=400, detail=f"Unsupported file type: {extension}")
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="The file is empty")
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    # Grow the chunks if the file would need more parts than S3 allows
+    chunk_size = max(chunk_size, -(-size // MAX_CHUNKS))
+    if not MIN_CHUNK_SIZE <= chunk_size <= MAX_CHUNK_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"Chunk size must be between {MIN_CHUNK_SIZE} and {MAX_CHUNK_SIZE} bytes")
+
+    _abort_expired_uploads()
+    session = {
+        "upload_id": uuid.uuid4().hex,
+        "filename": filename,
+        "size": size,
+        "chunk_size": chunk_size,
+        "total_chunks": -(-size // chunk_size),
+        "status": OPEN,
+        "created_at": time.time(),
+    }
+    session["s3_upload_id"] = create_multipart_upload(_staging_key(session))
+    get_upload_store().create(session)
+    log_event("upload_created", upload_id=session["upload_id"], filename=filename, size=size,
+              chunks=session["total_chunks"])
+    return {key: session[key] for key in ("upload_id", "filename", "size", "chunk_size", "total_chunks")}
+
+
+def receive_chunk(upload_id: str, index: int, body: bytes, sha256: str) -> Dict[str, Union[str, int]]:
+    """
+    Verify one chunk and store it as part `index + 1` of the S3 multipart upload.
+
+    Sending a chunk again replaces it, so clients can retry freely.
+
+    Parameters:
+    upload_id (str): The upload id.
+    index (int): The chunk number, starting at 0.
+    body (bytes): The content of the chunk.
+    sha256 (str): The hex SHA-256 digest of `body`, as computed by the client.
+
+    Returns:
+    dict: The chunk index and its size.
+    """
+    session = _get_session(upload_id)
+    if session["status"] != OPEN:
+        raise HTTPException(status_code=409, detail=f"Upload {upload_id} is {session['status']}")
+    expected = expected_chunk_size(session, index)
+    if len(body) != expected:
+        raise HTTPException(status_code=400, detail=f"Chunk {index} must be {expected} bytes, got {len(body)}")
+    digest = hashlib.sha256(body).hexdigest()
+    if digest != sha256.lower():
+        raise HTTPException(status_code=422, detail=f"Checksum mismatch for chunk {index}")
+
+    content_md5 = base64.b64encode(hashlib.md5(body).digest()).decode()
+    etag = upload_part(_staging_key(session), session["s3_upload_id"], index + 1, body, content_md5)
+    get_upload_store().add_chunk(upload_id, index, etag, len(body), digest)
+    return {"upload_id": upload_id, "index": index, "size": len(body)}
+
+
+def upload_status(upload_id: str) -> Dict[str, Union[str, int, List[int], List[List[int]]]]:
+    """
+    Report which chunks of an upload were received.
+
+    Returns:
+    dict: The session, the received chunk indexes, the received byte ranges
+    (`[start, end)`) and the chunks still missing.
+    """
+    session = _get_session(upload_id)
+    chunks = get_upload_store().chunks(upload_id)
+    received = [chunk["chunk_index"] for chunk in chunks]
+    received_set = set(received)
+    return {
+        "upload_id": upload_id,
+        "filename": session["filename"],
+        "status": session["status"],
+        "size": session["size"],
+        "chunk_size": session["chunk_size"],
+        "total_chunks": session["total_chunks"],
+        "received_bytes": sum(chunk["size"] for chunk in chunks),
+        "received": received,
+        "received_ranges": [list(r) for r in _received_ranges(chunks, session["chunk_size"])],
+        "missing": [i for i in range(session["total_chunks"]) if i not in received_set],
+    }
+
+
+def complete_upload(upload_id: str) -> Tuple[str, str, int]:
+    """
+    Assemble the chunks of a finished upload into its own S3 object.
+
+    The chunks may have arrived in any order at any worker, so the digest of
+    the whole file is computed by reading the assembled object back. An upload
+    assembled before, whose processing failed, is not assembled again. The
+    caller calls `publish_upload` if the file has to be processed, then
+    `finish_upload`.
+
+    Returns:
+    Tuple[str, str, int]: The S3 key the file is processed under, and the
+    SHA-256 digest and size of its content.
+    """
+    session = _get_session(upload_id)
+    store = get_upload_store()
+    if store.transition(upload_id, ASSEMBLED, COMPLETING):
+        assembled = True
+    elif store.transition(upload_id, OPEN, COMPLETING):
+        assembled = False
+    else:
+        raise HTTPException(status_code=409, detail=f"Upload {upload_id} is {session['status']}")
+    try:
+        if not assembled:
+            chunks = store.chunks(upload_id)
+            missing = session["total_chunks"] - len(chunks)
+            if missing:
+                raise HTTPException(status_code=409, detail=f"{missing} chunks of upload {upload_id} are missing")
+            complete_multipart_upload(
+                _staging_key(session), session["s3_upload_id"],
+                [{"PartNumber": chunk["chunk_index"] + 1, "ETag": chunk["etag"]} for chunk in chunks])
+            assembled = True
+        sha256 = object_sha256(_staging_key(session))
+    except Exception:
+        store.transition(upload_id, COMPLETING, ASSEMBLED if assembled else OPEN)
+        raise
+    log_event("upload_assembled", upload_id=upload_id, filename=session["filename"], size=session["size"],
+              sha256=sha256)
+    return session["filename"], sha256, session["size"]
+
+
+def publish_upload(upload_id: str) -> str:
+    """
+    Copy an assembled upload to the S3 key it is processed under, its filename.
+
+    Returns:
+    str: The S3 key of the copy.
+    """
+    session = _get_session(upload_id)
+    copy_object(_staging_key(session), session["filename"])
+    return session["filename"]
+
+
+def finish_upload(upload_id: str, processed: bool) -> None:
+    """
+    Record the outcome of processing an assembled upload.
+
+    Parameters:
+    upload_id (str): The upload id.
+    processed (bool): Whether the file was processed; if so its assembled object
+    is deleted, if not the upload can be completed again.
+    """
+    from botocore.exceptions import ClientError
+    session = _get_session(upload_id)
+    if processed:
+        try:
+            delete_object(_staging_key(session))
+        except ClientError as e:
+            logging.error(f"Error deleting the assembled object of upload {upload_id}: {e}")
+    get_upload_store().transition(upload_id, COMPLETING, COMPLETED if processed else ASSEMBLED)
+    log_event("upload_completed" if processed else "upload_processing_failed", upload_id=upload_id,
+              filename=session["filename"], size=session["size"])
+
+
+def abort_upload(upload_id: str) -> None:
+    """Abort an unfinished upload and free its S3 parts."""
+    session = _get_session(upload_id)
+    if session["status"] == COMPLETED:
+        raise HTTPException(status_code=409, detail=f"Upload {upload_id} is already completed")
+    _discard_upload(session)
+    get_upload_store().delete(upload_id)
+    log_event("upload_aborted", upload_id=upload_id, filename=session["filename"])
+
+
+def chunk_size_for(upload_id: str, index: int) -> int:
+    """Size in bytes expected for chunk `index` of an open upload."""
+    session = _get_session(upload_id)
+    if session["status"] != OPEN:
+        raise HTTPException(status_code=409, detail=f"Upload {upload_id} is {session['status']}")
+    return expected_chunk_size(session, index)
@@ -0,0 +1,172 @@
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, NamedTuple, Optional
+
+from app.embedding_index import LEGACY_MODEL
+from app.model_router import ROUTER_FAST_MIN_SCORE
+
+# Cosine similarities depend on the embedding model: ada-002 scores nearly
+# every pair above 0.7, the text-embedding-3 models score relevant matches far
+# lower. `min_score` and ROUTER_FAST_MIN_SCORE are calibrated for ada-002;
+# every other model needs its own cutoffs in `score_thresholds`, and an index
+# of a model without them is never activated.
+THRESHOLD_FIELDS = ("min_score", "fast_min_score")
+
+
+class RetrievalConfig(NamedTuple):
+    """Chunking and retrieval parameters, tuned with `python -m benchmarks.sweep`."""
+
+    # Matches fetched from the vector index, and the most kept for the prompt
+    candidate_k: int = 20
+    top_k: int = 10
+    # Documents shortlisted by their summary vectors before their chunks are
+    # searched; 0 searches the chunks of every document at once
+    document_shortlist: int = 0
+    # Matches below this cosine similarity of ada-002 vectors are never used;
+    # if none is left the question is answered without calling the chat model
+    min_score: float = 0.75
+    # Matches scoring this fraction or more below the best match are dropped
+    max_score_gap: float = 0.1
+    # Most tokens per chunk, and most tokens of a chunk repeated at the start
+    # of the next one
+    chunk_tokens: int = 500
+    chunk_overlap_tokens: int = 0
+    # Share of the prompt's token budget given to the retrieved context
+    context_fraction: float = 0.3
+    # Used to turn token budgets into character lengths
+    characters_per_token: float = 4.0
+    # The cutoffs of the other embedding models, by model: `min_score`, and
+    # optionally `fast_min_score`, below which lookups go to the strong tier
+    score_thresholds: Dict[str, Dict[str, float]] = {}
+
+
+class ScoreThresholds(NamedTuple):
+    """The cosine-similarity cutoffs calibrated for one embedding model."""
+
+    min_score: float
+    # None sends every completion to the strong model tier
+    fast_min_score: Optional[float]
+
+
+_config: Optional[RetrievalConfig] = None
+_config_lock = threading.Lock()
+
+
+def parse_retrieval_config(values: Dict[str, Any]) -> RetrievalConfig:
+    """
+    Build a validated config from a dictionary, using defaults for missing fields.
+
+    The output of the sweep tool, which nests the config under `recommended`,
+    is accepted as is.
+
+    Raises:
+    ValueError: If a field is unknown, has the wrong type or is out of range.
+    """
+    values = values.get("recommended", values)
+    if "chunk_size" in values or "chunk_overlap" in values:
+        # Written when chunks were measured in characters
+        values = dict(values)
+        per_token = float(values.get("characters_per_token", RetrievalConfig._field_defaults["characters_per_token"]))
+        for legacy, name in (("chunk_size", "chunk_tokens"), ("chunk_overlap", "chunk_overlap_tokens")):
+            if legacy in values:
+                values.setdefault(name, round(int(values.pop(legacy)) / per_token))
+        logging.warning("chunk_size and chunk_overlap are deprecated; converted to chunk_tokens="
+                        f"{values.get('chunk_tokens')} and chunk_overlap_tokens={values.get('chunk_overlap_tokens')}")
+    unknown = set(values) - set(RetrievalConfig._fields)
+    if unknown:
+        raise ValueError(f"Unknown retrieval config fields: {', '.join(sorted(unknown))}")
+    try:
+        config = RetrievalConfig(**{
+            name: _parse_field(name, values[name]) if name in values else default
+            for name, default in RetrievalConfig._field_defaults.items()
+        })
+    except (AttributeError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid retrieval config: {e}")
+    if not 1 <= config.top_k <= config.candidate_k:
+        raise ValueError("top_k must be at least 1 and at most candidate_k")
+    if config.document_shortlist < 0:
+        raise ValueError("document_shortlist must not be negative")
+    if not 0 <= config.min_score < 1 or not 0 <= config.max_score_gap < 1:
+        raise ValueError("min_score and max_score_gap must be between 0 and 1")
+    for model, thresholds in config.score_thresholds.items():
+        if "min_score" not in thresholds or set(thresholds) - set(THRESHOLD_FIELDS):
+            raise ValueError(f"score_thresholds of {model} need min_score and at most fast_min_score")
+        if not all(0 <= value < 1 for value in thresholds.values()):
+            raise ValueError(f"score_thresholds of {model} must be between 0 and 1")
+    if config.chunk_tokens < 32 or not 0 <= config.chunk_overlap_tokens < config.chunk_tokens:
+        raise ValueError("chunk_tokens must be at least 32 and chunk_overlap_tokens between 0 and chunk_tokens")
+    if not 0 < config.context_fraction < 1:
+        raise ValueError("context_fraction must be between 0 and 1")
+    if config.characters_per_token <= 0:
+        raise ValueError("characters_per_token must be positive")
+    return config
+
+
+def _parse_field(name: str, value: Any) -> Any:
+    if name == "score_thresholds":
+        return {str(model): {key: float(score) for key, score in thresholds.items()}
+                for model, thresholds in value.items()}
+    return RetrievalConfig.__annotations__[name](value)
+
+
+def score_thresholds(model: str, config: Optional[RetrievalConfig] = None) -> Optional[ScoreThresholds]:
+    """
+    Return the score cutoffs calibrated for the vectors of an embedding model.
+
+    Parameters:
+    model (str): The embedding model.
+    config (RetrievalConfig): The config to read them from, by default the current one.
+
+    Returns:
+    ScoreThresholds: The cutoffs, or None if none were calibrated for `model`.
+    """
+    config = config or get_retrieval_config()
+    thresholds = config.score_thresholds.get(model)
+    if thresholds is not None:
+        return ScoreThresholds(thresholds["min_score"], thresholds.get("fast_min_score"))
+    if model == LEGACY_MODEL:
+        return ScoreThresholds(config.min_score, ROUTER_FAST_MIN_SCORE)
+    return None
+
+
+def require_score_thresholds(model: str) -> ScoreThresholds:
+    """
+    Return the score cutoffs of an embedding model an index is about to be built or activated for.
+
+    Raises:
+    ValueError: If none were calibrated for `model`.
+    """
+    thresholds = score_thresholds(model)
+    if thresholds is None:
+        raise ValueError(f"No score thresholds are calibrated for {model}: add them to score_thresholds in "
+                         "the retrieval config (see python -m benchmarks.sweep) before switching to it")
+    return thresholds
+
+
+def load_retrieval_config(path: Optional[str] = None) -> RetrievalConfig:
+    """
+    Load the retrieval config from `RETRIEVAL_CONFIG_PATH` and make it the current one.
+
+    A missing file means the defaults; an invalid file raises, so a bad
+    config stops the worker at startup instead of degrading answers.
+    """
+    global _config
+    path = path or os.environ.get('RETRIEVAL_CONFIG_PATH', 'retrieval_config.json')
+    if os.path.exists(path):
+        with open(path) as f:
+            config = parse_retrieval_config(json.load(f))
+        logging.info(f"Loaded retrieval config from {path}: {config._asdict()}")
+    else:
+        config = RetrievalConfig()
+    with _config_lock:
+        _config = config
+    return config
+
+
+def get_retrieval_config() -> RetrievalConfig:
+    """Return the current retrieval config, loading it on first use."""
+    if _config is None:
+        return load_retrieval_config()
+    return _config
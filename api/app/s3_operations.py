@@ -1,9 +1,12 @@
-import boto3
-from botocore.exceptions import NoCredentialsError, ClientError
 from dotenv import load_dotenv
+import hashlib
 import logging
 import os
-from typing import Dict, Union
+from typing import Dict, List, Union, TYPE_CHECKING
+from app.clients import get_s3_client
+
+if TYPE_CHECKING:
+    import boto3
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -12,13 +15,15 @@ logging.basicConfig(level=logging.INFO)
 load_dotenv()
 
 
-def initialize_s3_client() -> boto3.client:
+def initialize_s3_client() -> 'boto3.client':
     """
     Initialize and return an Amazon S3 client using credentials from environment variables.
 
     **Returns**:
     - An instance of boto3's S3 client.
     """
+    # boto3 takes a while to import; only workers that create the client pay for it
+    import boto3
     return boto3.client(
         's3',
         aws_access_key_id=os.environ.get('AWS_ACCESS_KEY'),
@@ -27,9 +32,6 @@ def initialize_s3_client() -> boto3.client:
     )
 
 
-s3_client = initialize_s3_client()
-
-
 def upload_pdf(file_bytes: bytes, unique_filename: str) -> Dict[str, Union[str, bool]]:
     """
     Upload a PDF file to Amazon S3.
@@ -41,8 +43,9 @@ def upload_pdf(file_bytes: bytes, unique_filename: str) -> Dict[str, Union[str,
     **Returns**:
     - A dictionary containing the status, message, and filename of the uploaded file.
     """
+    from botocore.exceptions import ClientError, NoCredentialsError
     try:
-        s3_client.put_object(Body=file_bytes, Bucket=os.environ.get(
+        get_s3_client().put_object(Body=file_bytes, Bucket=os.environ.get(
             'YOUR_BUCKET_NAME'), Key=unique_filename)
         return {"status": "Success", "message": "File uploaded successfully to S3", "filename": unique_filename}
     except FileNotFoundError:
@@ -64,8 +67,9 @@ def s3_object_exists(bucket_name: str, key: str) -> bool:
     **Returns**:
     - A boolean indicating whether the object exists in the bucket.
     """
+    from botocore.exceptions import ClientError
     try:
-        s3_client.head_object(Bucket=bucket_name, Key=key)
+        get_s3_client().head_object(Bucket=bucket_name, Key=key)
         return True
     except ClientError as e:
         if e.response['Error']['Code'] == '404':
@@ -84,7 +88,7 @@ def check_documents(bucket_name: str) -> bool:
     **Returns**:
     - A boolean indicating whether there are any documents in the bucket.
     """
-    response = s3_client.list_objects(Bucket=bucket_name)
+    response = get_s3_client().list_objects(Bucket=bucket_name)
     return 'Contents' in response
 
 
@@ -100,8 +104,9 @@ def upload_file(file_bytes: bytes, unique_filename: str) -> Dict[str, Union[str,
     **Returns**:
     - A dictionary containing the status, message, and filename of the uploaded file.
     """
+    from botocore.exceptions import ClientError, NoCredentialsError
     try:
-        s3_client.put_object(
+        get_s3_client().put_object(
             Body=file_bytes, Bucket=os.environ.get(
                 'YOUR_BUCKET_NAME'), Key=unique_filename)
         return {"status": "Success", "message": "File uploaded successfully to S3", "filename": unique_filename}
@@ -111,3 +116,103 @@ def upload_file(file_bytes: bytes, unique_filename: str) -> Dict[str, Union[str,
         return {"status": "Failed", "message": "Credentials not available"}
     except ClientError as e:
         return {"status": "Failed", "message": str(e)}
+
+
+def create_multipart_upload(key: str) -> str:
+    """
+    Start an S3 multipart upload.
+
+    **Arguments**:
+    - `key` (str): The key of the object being uploaded.
+
+    **Returns**:
+    - The S3 upload id.
+    """
+    response = get_s3_client().create_multipart_upload(
+        Bucket=os.environ.get('YOUR_BUCKET_NAME'), Key=key)
+    return response['UploadId']
+
+
+def upload_part(key: str, s3_upload_id: str, part_number: int, body: bytes, content_md5: str) -> str:
+    """
+    Upload one part of a multipart upload; S3 rejects it if `content_md5` does not match.
+
+    **Arguments**:
+    - `key` (str): The key of the object being uploaded.
+    - `s3_upload_id` (str): The S3 upload id.
+    - `part_number` (int): The part number, starting at 1.
+    - `body` (bytes): The content of the part.
+    - `content_md5` (str): The base64-encoded MD5 digest of `body`.
+
+    **Returns**:
+    - The ETag of the stored part.
+    """
+    response = get_s3_client().upload_part(
+        Body=body, Bucket=os.environ.get('YOUR_BUCKET_NAME'), Key=key,
+        UploadId=s3_upload_id, PartNumber=part_number, ContentMD5=content_md5)
+    return response['ETag']
+
+
+def complete_multipart_upload(key: str, s3_upload_id: str, parts: List[Dict[str, Union[str, int]]]) -> None:
+    """
+    Assemble the uploaded parts into the final object.
+
+    **Arguments**:
+    - `key` (str): The key of the object being uploaded.
+    - `s3_upload_id` (str): The S3 upload id.
+    - `parts` (list): `{"PartNumber": ..., "ETag": ...}` for every part, in order.
+    """
+    get_s3_client().complete_multipart_upload(
+        Bucket=os.environ.get('YOUR_BUCKET_NAME'), Key=key, UploadId=s3_upload_id,
+        MultipartUpload={"Parts": parts})
+
+
+def abort_multipart_upload(key: str, s3_upload_id: str) -> None:
+    """
+    Abort a multipart upload and free its stored parts.
+
+    **Arguments**:
+    - `key` (str): The key of the object being uploaded.
+    - `s3_upload_id` (str): The S3 upload id.
+    """
+    get_s3_client().abort_multipart_upload(
+        Bucket=os.environ.get('YOUR_BUCKET_NAME'), Key=key, UploadId=s3_upload_id)
+
+
+def object_sha256(key: str) -> str:
+    """
+    Compute the SHA-256 digest of a stored object, streaming it.
+
+    **Arguments**:
+    - `key` (str): The key of the object.
+
+    **Returns**:
+    - The hex digest of the object's content.
+    """
+    body = get_s3_client().get_object(Bucket=os.environ.get('YOUR_BUCKET_NAME'), Key=key)['Body']
+    digest = hashlib.sha256()
+    for block in iter(lambda: body.read(1024 * 1024), b""):
+        digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_object(source_key: str, key: str) -> None:
+    """
+    Copy a stored object to another key; large objects are copied in parts.
+
+    **Arguments**:
+    - `source_key` (str): The key of the object to copy.
+    - `key` (str): The key of the copy.
+    """
+    bucket = os.environ.get('YOUR_BUCKET_NAME')
+    get_s3_client().copy({'Bucket': bucket, 'Key': source_key}, bucket, key)
+
+
+def delete_object(key: str) -> None:
+    """
+    Delete a stored object.
+
+    **Arguments**:
+    - `key` (str): The key of the object.
+    """
+    get_s3_client().delete_object(Bucket=os.environ.get('YOUR_BUCKET_NAME'), Key=key)
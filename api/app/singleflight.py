@@ -0,0 +1,111 @@
+import asyncio
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional
+
+from app.metrics import Counter, current_request
+
+COALESCED = Counter(
+    "chatpdf_coalesced_calls_total", "Calls that joined an identical call already in flight.", ("kind",))
+
+
+class _Call:
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent identical calls made from worker threads.
+
+    The first caller for a key runs the function; callers arriving while it is
+    in flight wait for it and receive the same result or exception. Nothing is
+    kept here once the call completes; answers that should outlive it, such
+    as `/chat/` answers, are stored by the caller in the query cache, which is
+    invalidated when a document is ingested.
+    """
+
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            COALESCED.inc(kind=self.kind)
+            started = time.perf_counter()
+            call.done.wait()
+            context = current_request()
+            if context is not None:
+                context.timings.append((f"coalesced_{self.kind}", time.perf_counter() - started))
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+
+
+class _AsyncCall:
+    def __init__(self, task: "asyncio.Task[Any]") -> None:
+        self.task = task
+        self.waiters = 0
+
+
+class AsyncSingleFlight:
+    """
+    Coalesce concurrent identical coroutines on the event loop.
+
+    Every caller awaits one shared task. A caller that is cancelled only
+    detaches itself; the shared task is cancelled once no caller is left.
+    Exceptions are propagated to every caller.
+    """
+
+    def __init__(self, kind: str) -> None:
+        self.kind = kind
+        self._calls: Dict[Hashable, _AsyncCall] = {}
+
+    async def do(self, key: Hashable, factory: Callable[[], Awaitable[Any]]) -> Any:
+        call = self._calls.get(key)
+        leader = call is None
+        if leader:
+            call = self._calls[key] = _AsyncCall(asyncio.ensure_future(factory()))
+            call.task.add_done_callback(lambda _, key=key, call=call: self._forget(key, call))
+        else:
+            COALESCED.inc(kind=self.kind)
+
+        call.waiters += 1
+        started = time.perf_counter()
+        try:
+            return await asyncio.shield(call.task)
+        except asyncio.CancelledError:
+            if call.task.cancelled():
+                raise
+            call.waiters -= 1
+            if call.waiters == 0:
+                call.task.cancel()
+            raise
+        finally:
+            context = current_request()
+            if not leader and context is not None:
+                context.timings.append((f"coalesced_{self.kind}", time.perf_counter() - started))
+
+    def _forget(self, key: Hashable, call: _AsyncCall) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
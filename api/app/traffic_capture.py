@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from app.metrics import Counter, RequestContext, current_request
+
+# Opt-in record of production traffic, replayed against any deployment with
+# `python -m benchmarks.replay`. Each captured request is one JSON line with
+# what is needed to send it again: the query text of chat requests, and the
+# type, size and SHA-256 of uploaded files, whose content is not kept. Users
+# are only recorded as a digest, so replayed requests keep their grouping.
+
+TRAFFIC_CAPTURE_ENABLED = os.environ.get('TRAFFIC_CAPTURE', '0').lower() in ("1", "true", "yes")
+# Every worker writes its own file in this directory
+TRAFFIC_CAPTURE_DIR = os.environ.get('TRAFFIC_CAPTURE_DIR', 'traffic')
+# Share of requests captured
+TRAFFIC_CAPTURE_SAMPLE = float(os.environ.get('TRAFFIC_CAPTURE_SAMPLE', '1.0'))
+# A worker's file is rotated at this size, and this many rotated files are kept
+TRAFFIC_CAPTURE_MAX_BYTES = int(os.environ.get('TRAFFIC_CAPTURE_MAX_BYTES', str(64 * 1024 * 1024)))
+TRAFFIC_CAPTURE_KEEP = int(os.environ.get('TRAFFIC_CAPTURE_KEEP', '5'))
+
+CAPTURED_REQUESTS = Counter(
+    "chatpdf_captured_requests_total", "Requests written to the traffic capture, by kind.", ("kind",))
+
+_logger: Optional[logging.Logger] = None
+_logger_pid: Optional[int] = None
+_logger_lock = threading.Lock()
+
+
+def _capture_logger() -> logging.Logger:
+    """The logger writing this worker's capture file, opened after the fork."""
+    global _logger, _logger_pid
+    with _logger_lock:
+        if _logger is None or _logger_pid != os.getpid():
+            os.makedirs(TRAFFIC_CAPTURE_DIR, exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(
+                os.path.join(TRAFFIC_CAPTURE_DIR, f"traffic-{os.getpid()}.jsonl"),
+                maxBytes=TRAFFIC_CAPTURE_MAX_BYTES, backupCount=TRAFFIC_CAPTURE_KEEP, encoding="utf-8")
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger = logging.getLogger(f"chatpdf.traffic.{os.getpid()}")
+            logger.handlers = [handler]
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+            _logger, _logger_pid = logger, os.getpid()
+        return _logger
+
+
+def capture_request(kind: str, **fields: Any) -> None:
+    """
+    Capture the current request if capture is on and the request is sampled.
+
+    The record is written once the response has been sent, with its status and
+    duration. Endpoints call this first thing, with what a replay needs to send
+    the request again.
+
+    Parameters:
+    kind (str): What the request does: `chat`, `chat_batch`, `upload` or `resumable_upload`.
+    fields: The request's fields, e.g. the chat query.
+    """
+    if not TRAFFIC_CAPTURE_ENABLED or random.random() >= TRAFFIC_CAPTURE_SAMPLE:
+        return
+    context = current_request()
+    if context is None:
+        return
+    # When the request arrived, which for uploads is before their body was read
+    arrived = time.time() - (time.perf_counter() - context.started)
+    record: Dict[str, Any] = {"ts": round(arrived, 6), "kind": kind, **fields}
+    if context.user:
+        record["user"] = hashlib.sha256(context.user.encode("utf-8")).hexdigest()[:16]
+    context.state["capture"] = record
+    context.on_finish(_write_capture)
+
+
+def capture_file(filename: str, sha256: str, size: int) -> None:
+    """Add an uploaded file to the capture of the current request, if it is captured."""
+    context = current_request()
+    record = context.state.get("capture") if context is not None else None
+    if record is not None:
+        record.setdefault("files", []).append(
+            {"type": filename.rsplit(".", 1)[-1].lower(), "size": size, "sha256": sha256})
+
+
+def capture_file_chunks(sha256: str, chunks: int) -> None:
+    """Record how many chunks a captured file produced, so a replay can send a file of the same weight."""
+    context = current_request()
+    record = context.state.get("capture") if context is not None else None
+    for file in (record or {}).get("files", []):
+        if file["sha256"] == sha256:
+            file["chunks"] = chunks
+
+
+def _write_capture(context: RequestContext) -> None:
+    record = context.state.get("capture")
+    record["status"] = context.status or 500
+    record["seconds"] = round(time.perf_counter() - context.started, 6)
+    _capture_logger().info(json.dumps(record, ensure_ascii=False))
+    CAPTURED_REQUESTS.inc(kind=record["kind"])
@@ -0,0 +1,244 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+from app.metrics import Counter, Histogram, RequestContext, current_request, log_event
+
+# USD per 1K tokens as (prompt, completion); embeddings only use the first value
+DEFAULT_PRICING: Dict[str, Tuple[float, float]] = {
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-4": (0.03, 0.06),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+    "gpt-3.5-turbo": (0.001, 0.002),
+    "text-embedding-ada-002": (0.0001, 0.0),
+    "text-embedding-3-small": (0.00002, 0.0),
+    "text-embedding-3-large": (0.00013, 0.0),
+}
+# USD per minute of transcribed audio
+WHISPER_PRICE_PER_MINUTE = 0.006
+
+USAGE_FIELDS = ("calls", "prompt_tokens", "completion_tokens", "embedding_tokens", "whisper_seconds", "cost_usd")
+
+OPENAI_TOKENS = Counter(
+    "chatpdf_openai_tokens_total", "Tokens consumed by OpenAI calls.", ("model", "kind"))
+WHISPER_SECONDS = Counter(
+    "chatpdf_whisper_audio_seconds_total", "Seconds of audio sent for transcription.", ("model",))
+OPENAI_COST = Counter(
+    "chatpdf_openai_cost_usd_total", "Estimated OpenAI spend in USD.", ("model", "call"))
+PROMPT_TOKENS = Histogram(
+    "chatpdf_prompt_tokens", "Prompt size of each OpenAI call, in tokens.", ("call",),
+    buckets=(50, 100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000))
+
+_current_document: ContextVar[Optional[str]] = ContextVar("chatpdf_document", default=None)
+
+
+def _load_pricing() -> Dict[str, Tuple[float, float]]:
+    """Default prices, overridable with a JSON object in `OPENAI_PRICING`."""
+    pricing = dict(DEFAULT_PRICING)
+    override = os.environ.get('OPENAI_PRICING')
+    if override:
+        try:
+            pricing.update({model: tuple(prices) for model, prices in json.loads(override).items()})
+        except (ValueError, TypeError) as e:
+            logging.error(f"Ignoring invalid OPENAI_PRICING: {e}")
+    return pricing
+
+
+PRICING = _load_pricing()
+
+
+def estimate_cost(model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                  embedding_tokens: int = 0, whisper_seconds: float = 0.0) -> float:
+    """Estimate the USD cost of a call; unknown models are priced at zero."""
+    prompt_price, completion_price = PRICING.get(model, (0.0, 0.0))
+    cost = (prompt_tokens + embedding_tokens) / 1000 * prompt_price
+    cost += completion_tokens / 1000 * completion_price
+    cost += whisper_seconds / 60 * WHISPER_PRICE_PER_MINUTE
+    return cost
+
+
+@contextmanager
+def document_scope(document: str) -> Iterator[None]:
+    """Attribute the OpenAI usage recorded inside the block to `document`."""
+    token = _current_document.set(document)
+    try:
+        yield
+    finally:
+        _current_document.reset(token)
+
+
+def current_document() -> Optional[str]:
+    """Return the document set by the enclosing `document_scope`, if any."""
+    return _current_document.get()
+
+
+class UsageStore:
+    """
+    SQLite-backed aggregate of OpenAI usage per user and per document.
+
+    Each gunicorn worker opens its own connection; SQLite serialises the
+    writers, and totals are accumulated with upserts so no worker overwrites
+    another's counts.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS usage ("
+                " subject_type TEXT NOT NULL,"
+                " subject TEXT NOT NULL,"
+                " calls INTEGER NOT NULL DEFAULT 0,"
+                " prompt_tokens INTEGER NOT NULL DEFAULT 0,"
+                " completion_tokens INTEGER NOT NULL DEFAULT 0,"
+                " embedding_tokens INTEGER NOT NULL DEFAULT 0,"
+                " whisper_seconds REAL NOT NULL DEFAULT 0,"
+                " cost_usd REAL NOT NULL DEFAULT 0,"
+                " updated_at REAL NOT NULL,"
+                " PRIMARY KEY (subject_type, subject))"
+            )
+
+    def add(self, entries: Dict[Tuple[str, str], Dict[str, float]]) -> None:
+        """Add usage totals keyed by (subject_type, subject)."""
+        if not entries:
+            return
+        now = time.time()
+        rows = [
+            (subject_type, subject, *(totals.get(field, 0) for field in USAGE_FIELDS), now)
+            for (subject_type, subject), totals in entries.items()
+        ]
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT INTO usage (subject_type, subject, calls, prompt_tokens, completion_tokens,"
+                " embedding_tokens, whisper_seconds, cost_usd, updated_at)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+                " ON CONFLICT (subject_type, subject) DO UPDATE SET"
+                " calls = calls + excluded.calls,"
+                " prompt_tokens = prompt_tokens + excluded.prompt_tokens,"
+                " completion_tokens = completion_tokens + excluded.completion_tokens,"
+                " embedding_tokens = embedding_tokens + excluded.embedding_tokens,"
+                " whisper_seconds = whisper_seconds + excluded.whisper_seconds,"
+                " cost_usd = cost_usd + excluded.cost_usd,"
+                " updated_at = excluded.updated_at",
+                rows,
+            )
+
+    def top(self, subject_type: str, limit: int = 50) -> List[Dict[str, Union[str, float]]]:
+        """Return the subjects of one type ordered by estimated cost."""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT subject, calls, prompt_tokens, completion_tokens, embedding_tokens,"
+                " whisper_seconds, cost_usd, updated_at FROM usage WHERE subject_type = ?"
+                " ORDER BY cost_usd DESC, subject LIMIT ?",
+                (subject_type, limit),
+            )
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+
+_store: Optional[UsageStore] = None
+_store_lock = threading.Lock()
+
+
+def get_usage_store() -> UsageStore:
+    """Return the process-wide usage store, opening it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = UsageStore(os.environ.get('USAGE_DB_PATH', 'usage.db'))
+    return _store
+
+
+def _subjects(user: Optional[str], document: Optional[str]) -> List[Tuple[str, str]]:
+    subjects = [("user", user or "anonymous")]
+    if document:
+        subjects.append(("document", document))
+    return subjects
+
+
+def _flush_request_usage(context: RequestContext) -> None:
+    pending = context.state.pop("pending_usage", None)
+    if pending:
+        get_usage_store().add(pending)
+        log_event("request_usage", request_id=context.request_id, user=context.user, **context.usage)
+
+
+def record_usage(call: str, model: str, prompt_tokens: int = 0, completion_tokens: int = 0,
+                 embedding_tokens: int = 0, whisper_seconds: float = 0.0) -> float:
+    """
+    Record the usage of a single OpenAI call.
+
+    The usage updates the Prometheus counters immediately, is added to the
+    current request's totals, and is aggregated per user and per document in
+    the usage store once the request finishes.
+
+    Returns:
+    float: The estimated cost of the call in USD.
+    """
+    prompt_tokens = prompt_tokens or 0
+    completion_tokens = completion_tokens or 0
+    embedding_tokens = embedding_tokens or 0
+    whisper_seconds = whisper_seconds or 0.0
+    cost = estimate_cost(model, prompt_tokens, completion_tokens, embedding_tokens, whisper_seconds)
+
+    if prompt_tokens:
+        OPENAI_TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+        PROMPT_TOKENS.observe(prompt_tokens, call=call)
+    if completion_tokens:
+        OPENAI_TOKENS.inc(completion_tokens, model=model, kind="completion")
+    if embedding_tokens:
+        OPENAI_TOKENS.inc(embedding_tokens, model=model, kind="embedding")
+    if whisper_seconds:
+        WHISPER_SECONDS.inc(whisper_seconds, model=model)
+    OPENAI_COST.inc(cost, model=model, call=call)
+
+    totals = {
+        "calls": 1,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "embedding_tokens": embedding_tokens,
+        "whisper_seconds": whisper_seconds,
+        "cost_usd": cost,
+    }
+    context = current_request()
+    subjects = _subjects(context.user if context else None, _current_document.get())
+
+    if context is None:
+        # Outside a request (background work): write through
+        get_usage_store().add({subject: totals for subject in subjects})
+        return cost
+
+    for field, value in totals.items():
+        context.usage[field] = context.usage.get(field, 0) + value
+    pending = context.state.get("pending_usage")
+    if pending is None:
+        pending = context.state["pending_usage"] = {}
+        context.on_finish(_flush_request_usage)
+    for subject in subjects:
+        subject_totals = pending.setdefault(subject, {})
+        for field, value in totals.items():
+            subject_totals[field] = subject_totals.get(field, 0) + value
+    return cost
+
+
+def record_response_usage(call: str, model: str, response: object, embedding: bool = False) -> float:
+    """Record the `usage` block of an OpenAI chat or embeddings response."""
+    usage = getattr(response, "usage", None)
+    if usage is None:
+        return 0.0
+    prompt_tokens = getattr(usage, "prompt_tokens", 0) or 0
+    if embedding:
+        return record_usage(call, model, embedding_tokens=prompt_tokens)
+    return record_usage(call, model, prompt_tokens=prompt_tokens,
+                        completion_tokens=getattr(usage, "completion_tokens", 0) or 0)
@@ -1,12 +1,36 @@
 from openai import OpenAI
+from fastapi import Header, HTTPException
+from typing import Optional
 import os
+import secrets
 
 
 def initialize_openai():
     """
     Initialize the OpenAI client.
 
+    Retries are disabled on the client itself; `app.rate_limiter.call_openai`
+    retries with backoff that is coordinated with the shared rate limiter.
+
     Returns:
     OpenAI: An OpenAI client object.
     """
-    return OpenAI(api_key=os.environ.get('OPENAI_API_KEY'))
+    return OpenAI(api_key=os.environ.get('OPENAI_API_KEY'), max_retries=0)
+
+
+def require_admin(x_admin_key: Optional[str] = Header(None, description="Admin API key")) -> None:
+    """
+    FastAPI dependency that only lets requests with the admin key through.
+
+    Admin endpoints are disabled unless `ADMIN_API_KEY` is set.
+    """
+    check_admin_key(x_admin_key)
+
+
+def check_admin_key(key: Optional[str]) -> None:
+    """Raise the HTTPException `require_admin` rejects a request with, unless `key` is the admin key."""
+    admin_key = os.environ.get('ADMIN_API_KEY')
+    if not admin_key:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled")
+    if not key or not secrets.compare_digest(key, admin_key):
+        raise HTTPException(status_code=401, detail="Invalid admin key")
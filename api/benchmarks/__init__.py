@@ -0,0 +1,6 @@
+"""
+End-to-end benchmarks for the FastAPI backend.
+
+The suite drives the real `main.app` in-process and replaces S3, OpenAI and
+Pinecone with local stand-ins, so it can run without credentials or spend.
+"""
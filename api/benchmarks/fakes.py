@@ -0,0 +1,733 @@
+"""
+Local stand-ins for the external services used by the API.
+
+- `FakeS3Client` mimics the subset of the boto3 S3 client the app calls.
+- `FakeOpenAIServer` is a real HTTP server speaking the OpenAI REST API for
+  embeddings, chat completions and audio transcriptions, with injected latency.
+- `FakePinecone` replaces the module-level functions of the `pinecone` client
+  and serves queries from an in-memory cosine index.
+"""
+import base64
+import hashlib
+import io
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import zipfile
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+from xml.sax.saxutils import escape
+
+import numpy as np
+import pinecone
+from botocore.exceptions import ClientError
+
+EMBEDDING_DIMENSION = 1536
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def fake_embedding(text: str, dimension: int = EMBEDDING_DIMENSION) -> List[float]:
+    """
+    Return a deterministic, normalised bag-of-words embedding for `text`.
+
+    Texts sharing words get a high cosine similarity, which keeps retrieval
+    results meaningful without a real model.
+    """
+    vector = np.zeros(dimension, dtype=np.float32)
+    for word in _WORD_RE.findall(text.lower()):
+        digest = hashlib.blake2b(word.encode("utf-8"), digest_size=8).digest()
+        bucket = int.from_bytes(digest[:4], "little") % dimension
+        sign = 1.0 if digest[4] & 1 else -1.0
+        vector[bucket] += sign
+    norm = float(np.linalg.norm(vector))
+    if norm == 0.0:
+        vector[0] = 1.0
+        norm = 1.0
+    return (vector / norm).tolist()
+
+
+def _decode_tokens(tokens: List[int]) -> str:
+    """Decode the token ids langchain sends so both embedding paths agree."""
+    import tiktoken
+    return tiktoken.get_encoding("cl100k_base").decode(tokens)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token estimate used for the fake `usage` blocks."""
+    return max(1, len(text) // 4)
+
+
+class FakeS3Client:
+    """In-memory replacement for the boto3 S3 client."""
+
+    def __init__(self) -> None:
+        self._objects: Dict[str, Dict[str, bytes]] = {}
+        self._multipart: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        self.calls: Counter = Counter()
+
+    def put_object(self, Body: bytes, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        with self._lock:
+            self.calls["put_object"] += 1
+            self._objects.setdefault(Bucket, {})[Key] = bytes(Body)
+        return {"ETag": hashlib.md5(Body).hexdigest()}
+
+    def get_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["get_object"] += 1
+            body = self._objects.get(Bucket, {}).get(Key)
+        if body is None:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": Key}}, "GetObject")
+        return {"Body": io.BytesIO(body), "ContentLength": len(body)}
+
+    def head_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["head_object"] += 1
+            body = self._objects.get(Bucket, {}).get(Key)
+        if body is None:
+            raise ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, "HeadObject")
+        return {"ContentLength": len(body)}
+
+    def copy(self, CopySource: Dict[str, str], Bucket: str, Key: str, **kwargs: Any) -> None:
+        with self._lock:
+            self.calls["copy"] += 1
+            body = self._objects.get(CopySource["Bucket"], {}).get(CopySource["Key"])
+            if body is None:
+                raise ClientError({"Error": {"Code": "NoSuchKey", "Message": CopySource["Key"]}}, "CopyObject")
+            self._objects.setdefault(Bucket, {})[Key] = body
+
+    def delete_object(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["delete_object"] += 1
+            self._objects.get(Bucket, {}).pop(Key, None)
+        return {}
+
+    def list_objects(self, Bucket: str, **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["list_objects"] += 1
+            keys = sorted(self._objects.get(Bucket, {}))
+        response: Dict[str, Any] = {"Name": Bucket}
+        if keys:
+            response["Contents"] = [{"Key": key} for key in keys]
+        return response
+
+    def create_multipart_upload(self, Bucket: str, Key: str, **kwargs: Any) -> Dict[str, Any]:
+        upload_id = uuid.uuid4().hex
+        with self._lock:
+            self.calls["create_multipart_upload"] += 1
+            self._multipart[upload_id] = {"Bucket": Bucket, "Key": Key, "parts": {}}
+        return {"Bucket": Bucket, "Key": Key, "UploadId": upload_id}
+
+    def _multipart_upload(self, upload_id: str, operation: str) -> Dict[str, Any]:
+        upload = self._multipart.get(upload_id)
+        if upload is None:
+            raise ClientError({"Error": {"Code": "NoSuchUpload", "Message": upload_id}}, operation)
+        return upload
+
+    def upload_part(self, Body: bytes, Bucket: str, Key: str, UploadId: str, PartNumber: int,
+                    ContentMD5: Optional[str] = None, **kwargs: Any) -> Dict[str, Any]:
+        if hasattr(Body, "read"):
+            Body = Body.read()
+        Body = bytes(Body)
+        digest = hashlib.md5(Body)
+        if ContentMD5 is not None and base64.b64encode(digest.digest()).decode() != ContentMD5:
+            raise ClientError({"Error": {"Code": "BadDigest", "Message": "Content-MD5 mismatch"}}, "UploadPart")
+        etag = f'"{digest.hexdigest()}"'
+        with self._lock:
+            self.calls["upload_part"] += 1
+            self._multipart_upload(UploadId, "UploadPart")["parts"][PartNumber] = (etag, Body)
+        return {"ETag": etag}
+
+    def complete_multipart_upload(self, Bucket: str, Key: str, UploadId: str,
+                                  MultipartUpload: Dict[str, Any], **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["complete_multipart_upload"] += 1
+            upload = self._multipart_upload(UploadId, "CompleteMultipartUpload")
+            body = b""
+            for part in MultipartUpload["Parts"]:
+                etag, data = upload["parts"].get(part["PartNumber"], (None, b""))
+                if etag != part["ETag"]:
+                    raise ClientError({"Error": {"Code": "InvalidPart", "Message": str(part["PartNumber"])}},
+                                      "CompleteMultipartUpload")
+                body += data
+            del self._multipart[UploadId]
+            self._objects.setdefault(Bucket, {})[Key] = body
+        return {"Bucket": Bucket, "Key": Key}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str, **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["abort_multipart_upload"] += 1
+            self._multipart_upload(UploadId, "AbortMultipartUpload")
+            del self._multipart[UploadId]
+        return {}
+
+
+class FakeOpenAIServer:
+    """
+    Threaded HTTP server implementing the OpenAI endpoints used by the app.
+
+    Latencies are given in milliseconds per endpoint; `jitter` adds a uniform
+    random fraction of that latency to every call. With `rpm_limit` set, each
+    endpoint enforces a sliding one-minute request limit, answering HTTP 429
+    and sending the `x-ratelimit-*` headers the real API uses.
+    """
+
+    def __init__(self, embedding_latency_ms: float = 0.0, chat_latency_ms: float = 0.0,
+                 transcription_latency_ms: float = 0.0, jitter: float = 0.0,
+                 dimension: int = EMBEDDING_DIMENSION, rpm_limit: int = 0) -> None:
+        self.latency_ms = {
+            "embeddings": embedding_latency_ms,
+            "chat": chat_latency_ms,
+            "transcriptions": transcription_latency_ms,
+        }
+        self.jitter = jitter
+        self.dimension = dimension
+        self.rpm_limit = rpm_limit
+        self.calls: Counter = Counter()
+        self._windows: Dict[str, List[float]] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "FakeOpenAIServer":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def _sleep(self, endpoint: str) -> None:
+        latency = self.latency_ms[endpoint] / 1000.0
+        if self.jitter:
+            latency += random.uniform(0, self.jitter * latency)
+        if latency > 0:
+            time.sleep(latency)
+
+    def _count(self, endpoint: str) -> None:
+        with self._lock:
+            self.calls[endpoint] += 1
+
+    def _admit(self, endpoint: str) -> Dict[str, str]:
+        """Apply the simulated request limit; return the rate-limit headers, with `status` 429 if rejected."""
+        if not self.rpm_limit:
+            return {}
+        now = time.monotonic()
+        with self._lock:
+            window = [t for t in self._windows.get(endpoint, []) if now - t < 60.0]
+            rejected = len(window) >= self.rpm_limit
+            if not rejected:
+                window.append(now)
+            self._windows[endpoint] = window
+            reset = 60.0 - (now - window[0]) if window else 0.0
+            if rejected:
+                self.calls[f"{endpoint}_rate_limited"] += 1
+        headers = {
+            "x-ratelimit-limit-requests": str(self.rpm_limit),
+            "x-ratelimit-remaining-requests": str(max(0, self.rpm_limit - len(window))),
+            "x-ratelimit-reset-requests": f"{reset:.3f}s",
+        }
+        if rejected:
+            headers["status"] = "429"
+            headers["retry-after-ms"] = str(int(reset * 1000))
+        return headers
+
+    def _embeddings(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        inputs = body.get("input", [])
+        if isinstance(inputs, str):
+            inputs = [inputs]
+        data, tokens = [], 0
+        for i, item in enumerate(inputs):
+            # langchain sends pre-tokenised inputs as lists of token ids
+            text = _decode_tokens(item) if isinstance(item, list) else item
+            tokens += len(item) if isinstance(item, list) else estimate_tokens(text)
+            data.append({"object": "embedding", "index": i,
+                         "embedding": fake_embedding(text, body.get("dimensions") or self.dimension)})
+        return {
+            "object": "list",
+            "data": data,
+            "model": body.get("model", "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    def _chat(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        prompt = " ".join(m.get("content") or "" for m in body.get("messages", []))
+        answer = "Respuesta simulada basada en el contexto proporcionado."
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(answer)
+        return {
+            "id": f"chatcmpl-{self.calls['chat']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model", "gpt-4"),
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": answer},
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+            },
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format: str, *args: Any) -> None:
+                pass
+
+            def _send(self, status: int, payload: Any, content_type: str = "application/json",
+                      headers: Optional[Dict[str, str]] = None) -> None:
+                raw = payload.encode("utf-8") if isinstance(payload, str) else json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(raw)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(raw)
+
+            def do_POST(self) -> None:
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length)
+                path = self.path.split("?")[0]
+                endpoint = next((name for suffix, name in (("/embeddings", "embeddings"),
+                                                            ("/chat/completions", "chat"),
+                                                            ("/audio/transcriptions", "transcriptions"))
+                                 if path.endswith(suffix)), None)
+                limit_headers = server._admit(endpoint) if endpoint else {}
+                if limit_headers.pop("status", None):
+                    self._send(429, {"error": {"message": "Rate limit reached", "type": "requests",
+                                               "code": "rate_limit_exceeded"}}, headers=limit_headers)
+                    return
+                if path.endswith("/embeddings"):
+                    server._count("embeddings")
+                    server._sleep("embeddings")
+                    self._send(200, server._embeddings(json.loads(raw)), headers=limit_headers)
+                elif path.endswith("/chat/completions"):
+                    server._count("chat")
+                    server._sleep("chat")
+                    self._send(200, server._chat(json.loads(raw)), headers=limit_headers)
+                elif path.endswith("/audio/transcriptions"):
+                    server._count("transcriptions")
+                    server._sleep("transcriptions")
+                    text = sample_text(f"audio-{len(raw)}", 400)
+                    if b"verbose_json" in raw:
+                        # Assume a 128 kbit/s recording for the reported duration
+                        self._send(200, {"task": "transcribe", "language": "spanish",
+                                         "duration": len(raw) / 16000, "text": text, "segments": []},
+                                   headers=limit_headers)
+                    else:
+                        self._send(200, text, "text/plain", headers=limit_headers)
+                else:
+                    self._send(404, {"error": {"message": f"Unknown path {path}"}})
+
+        return Handler
+
+
+def _matches_filter(metadata: Dict[str, Any], filter: Optional[Dict[str, Any]]) -> bool:
+    """Evaluate the subset of the Pinecone metadata filter language we rely on."""
+    if not filter:
+        return True
+    for key, condition in filter.items():
+        if key == "$and":
+            if not all(_matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        if key == "$or":
+            if not any(_matches_filter(metadata, sub) for sub in condition):
+                return False
+            continue
+        value = metadata.get(key)
+        # A list of strings matches if any of its items does
+        values = value if isinstance(value, list) else [value]
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for op, expected in condition.items():
+            if op == "$eq" and expected not in values:
+                return False
+            if op == "$ne" and expected in values:
+                return False
+            if op == "$in" and not any(item in expected for item in values):
+                return False
+            if op == "$nin" and any(item in expected for item in values):
+                return False
+    return True
+
+
+class _CompletedRequest:
+    """Stand-in for the `ApplyResult` returned by asynchronous Pinecone calls."""
+
+    def __init__(self, value: Any) -> None:
+        self._value = value
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        return self._value
+
+
+class FakePineconeIndex(pinecone.index.Index):
+    """In-memory cosine-similarity index with the `pinecone.Index` interface, including namespaces."""
+
+    def __init__(self, name: str, dimension: int = EMBEDDING_DIMENSION, query_latency_ms: float = 0.0) -> None:
+        # The real constructor opens an API client; only the type is needed
+        # for langchain's isinstance check.
+        self.name = name
+        self.dimension = dimension
+        self.query_latency_ms = query_latency_ms
+        self._ids: List[str] = []
+        self._namespaces: List[str] = []
+        self._positions: Dict[Tuple[str, str], int] = {}
+        self._vectors = np.zeros((0, dimension), dtype=np.float32)
+        self._metadata: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+        self.calls: Counter = Counter()
+
+    def __len__(self) -> int:
+        # Records of the default namespace, i.e. the chunks
+        return self._namespaces.count("")
+
+    def upsert(self, vectors: List[Any], namespace: Optional[str] = None, **kwargs: Any) -> Dict[str, int]:
+        rows = []
+        for item in vectors:
+            if isinstance(item, dict):
+                rows.append((item["id"], item["values"], item.get("metadata") or {}))
+            else:
+                vector_id, values, *rest = item
+                rows.append((vector_id, values, rest[0] if rest else {}))
+        with self._lock:
+            self.calls["upsert"] += 1
+            new_rows = []
+            for vector_id, values, metadata in rows:
+                array = np.asarray(values, dtype=np.float32)
+                key = (namespace or "", vector_id)
+                if key in self._positions:
+                    position = self._positions[key]
+                    if position >= len(self._vectors):
+                        new_rows[position - len(self._vectors)] = array
+                    else:
+                        self._vectors[position] = array
+                    self._metadata[position] = dict(metadata)
+                else:
+                    self._positions[key] = len(self._ids)
+                    new_rows.append(array)
+                    self._ids.append(vector_id)
+                    self._namespaces.append(namespace or "")
+                    self._metadata.append(dict(metadata))
+            if new_rows:
+                self._vectors = np.vstack([self._vectors, np.stack(new_rows)])
+        response = {"upserted_count": len(rows)}
+        # langchain upserts with async_req=True and then calls .get() on the result
+        return _CompletedRequest(response) if kwargs.get("async_req") else response
+
+    def query(self, vector: Optional[List[float]] = None, top_k: int = 10, namespace: Optional[str] = None,
+              filter: Optional[Dict[str, Any]] = None, include_values: bool = False,
+              include_metadata: bool = False, **kwargs: Any) -> Dict[str, Any]:
+        if self.query_latency_ms:
+            time.sleep(self.query_latency_ms / 1000.0)
+        with self._lock:
+            self.calls["query"] += 1
+            if not self._ids:
+                return {"matches": [], "namespace": namespace or ""}
+            query = np.asarray(vector, dtype=np.float32)
+            norms = np.linalg.norm(self._vectors, axis=1) * (np.linalg.norm(query) or 1.0)
+            scores = self._vectors @ query / np.where(norms == 0, 1.0, norms)
+            order = np.argsort(-scores)
+            matches = []
+            for position in order:
+                metadata = self._metadata[position]
+                if self._namespaces[position] != (namespace or "") or not _matches_filter(metadata, filter):
+                    continue
+                match: Dict[str, Any] = {"id": self._ids[position], "score": float(scores[position])}
+                if include_metadata:
+                    match["metadata"] = dict(metadata)
+                if include_values:
+                    match["values"] = self._vectors[position].tolist()
+                matches.append(match)
+                if len(matches) >= top_k:
+                    break
+        return {"matches": matches, "namespace": namespace or ""}
+
+    def fetch(self, ids: List[str], namespace: Optional[str] = None, **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["fetch"] += 1
+            positions = {vector_id: self._positions.get((namespace or "", vector_id)) for vector_id in ids}
+            vectors = {
+                vector_id: {
+                    "id": vector_id,
+                    "values": self._vectors[position].tolist(),
+                    "metadata": dict(self._metadata[position]),
+                }
+                for vector_id, position in positions.items() if position is not None
+            }
+        return {"vectors": vectors, "namespace": namespace or ""}
+
+    def update(self, id: str, values: Optional[List[float]] = None, set_metadata: Optional[Dict[str, Any]] = None,
+               namespace: Optional[str] = None, **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            self.calls["update"] += 1
+            position = self._positions.get((namespace or "", id))
+            if position is not None:
+                if values is not None:
+                    self._vectors[position] = np.asarray(values, dtype=np.float32)
+                self._metadata[position].update(set_metadata or {})
+        return {}
+
+    def delete(self, ids: Optional[List[str]] = None, delete_all: Optional[bool] = None,
+               namespace: Optional[str] = None, filter: Optional[Dict[str, Any]] = None,
+               **kwargs: Any) -> Dict[str, Any]:
+        namespace = namespace or ""
+        with self._lock:
+            drop = set(ids or [])
+            keep = [
+                i for i, vector_id in enumerate(self._ids)
+                if self._namespaces[i] != namespace
+                or not (delete_all or vector_id in drop or (filter and _matches_filter(self._metadata[i], filter)))
+            ]
+            self._ids = [self._ids[i] for i in keep]
+            self._namespaces = [self._namespaces[i] for i in keep]
+            self._metadata = [self._metadata[i] for i in keep]
+            self._vectors = self._vectors[keep] if keep else np.zeros((0, self.dimension), dtype=np.float32)
+            self._positions = {key: i for i, key in enumerate(zip(self._namespaces, self._ids))}
+        return {}
+
+    def describe_index_stats(self, **kwargs: Any) -> Dict[str, Any]:
+        with self._lock:
+            counts = Counter(self._namespaces)
+        return {
+            "dimension": self.dimension,
+            "index_fullness": 0.0,
+            "namespaces": {namespace: {"vector_count": count} for namespace, count in counts.items()},
+            "total_vector_count": sum(counts.values()),
+        }
+
+
+class FakePinecone:
+    """Registry of fake indexes that patches the `pinecone` module functions."""
+
+    def __init__(self, query_latency_ms: float = 0.0) -> None:
+        self.query_latency_ms = query_latency_ms
+        self.indexes: Dict[str, FakePineconeIndex] = {}
+        self._saved: Dict[str, Any] = {}
+
+    def init(self, api_key: Optional[str] = None, environment: Optional[str] = None, **kwargs: Any) -> None:
+        pass
+
+    def list_indexes(self) -> List[str]:
+        return list(self.indexes)
+
+    def create_index(self, name: str, dimension: int, metric: str = "cosine", **kwargs: Any) -> None:
+        self.indexes[name] = FakePineconeIndex(name, dimension, self.query_latency_ms)
+
+    def delete_index(self, name: str, **kwargs: Any) -> None:
+        self.indexes.pop(name, None)
+
+    def Index(self, index_name: str, pool_threads: int = 1) -> FakePineconeIndex:
+        if index_name not in self.indexes:
+            self.create_index(index_name, EMBEDDING_DIMENSION)
+        return self.indexes[index_name]
+
+    def install(self) -> "FakePinecone":
+        for name in ("init", "list_indexes", "create_index", "delete_index", "Index"):
+            self._saved[name] = getattr(pinecone, name)
+            setattr(pinecone, name, getattr(self, name))
+        return self
+
+    def uninstall(self) -> None:
+        for name, original in self._saved.items():
+            setattr(pinecone, name, original)
+        self._saved.clear()
+
+
+_VOCABULARY = (
+    "contrato cliente proveedor factura pago plazo garantía servicio soporte "
+    "política seguridad acceso datos respaldo auditoría riesgo cumplimiento "
+    "empleado vacaciones licencia beneficio salario evaluación capacitación "
+    "proyecto entrega hito presupuesto costo recurso calendario informe "
+    "producto versión módulo instalación configuración error incidente "
+    "reunión acuerdo responsable revisión aprobación firma documento anexo"
+).split()
+
+
+def sample_text(seed: str, words: int) -> str:
+    """Generate deterministic pseudo-Spanish prose for synthetic documents."""
+    rng = random.Random(seed)
+    sentences, current = [], []
+    for _ in range(words):
+        current.append(rng.choice(_VOCABULARY))
+        if len(current) >= rng.randint(8, 16):
+            sentences.append(" ".join(current).capitalize() + ".")
+            current = []
+    if current:
+        sentences.append(" ".join(current).capitalize() + ".")
+    return " ".join(sentences)
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def make_pdf(pages: List[str], line_width: int = 90) -> bytes:
+    """Build a minimal, valid PDF with one page of plain text per entry in `pages`."""
+    objects: List[bytes] = []
+    page_ids = [3 + 2 * i for i in range(len(pages))]
+    font_id = 3 + 2 * len(pages)
+    objects.append(b"<< /Type /Catalog /Pages 2 0 R >>")
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {len(pages)} >>".encode())
+    for page_id, text in zip(page_ids, pages):
+        lines = []
+        # Explicit newlines start a new line, e.g. for headers and footers
+        for paragraph in text.split("\n"):
+            line = ""
+            for word in paragraph.split():
+                if len(line) + len(word) + 1 > line_width:
+                    lines.append(line)
+                    line = word
+                else:
+                    line = f"{line} {word}".strip()
+            if line:
+                lines.append(line)
+        stream = "BT /F1 10 Tf 12 TL 40 800 Td " + " ".join(
+            f"({_pdf_escape(item)}) Tj T*" for item in lines) + " ET"
+        raw = stream.encode("latin-1", "replace")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 842] "
+            f"/Resources << /Font << /F1 {font_id} 0 R >> >> /Contents {page_id + 1} 0 R >>".encode())
+        objects.append(b"<< /Length %d >>\nstream\n" % len(raw) + raw + b"\nendstream")
+    objects.append(b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>")
+
+    out = io.BytesIO()
+    out.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(out.tell())
+        out.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+    xref = out.tell()
+    out.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        out.write(b"%010d 00000 n \n" % offset)
+    out.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return out.getvalue()
+
+
+_CONTENT_TYPES = "http://schemas.openxmlformats.org/package/2006/content-types"
+_RELATIONSHIPS = "http://schemas.openxmlformats.org/package/2006/relationships"
+_OFFICE_REL = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+_WORD_NS = "http://schemas.openxmlformats.org/wordprocessingml/2006/main"
+_DRAWING_NS = "http://schemas.openxmlformats.org/drawingml/2006/main"
+_PRESENTATION_NS = "http://schemas.openxmlformats.org/presentationml/2006/main"
+
+
+def _content_types(overrides: Dict[str, str]) -> str:
+    parts = "".join(f'<Override PartName="/{name}" ContentType="{kind}"/>' for name, kind in overrides.items())
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Types xmlns="{_CONTENT_TYPES}">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            f'<Default Extension="xml" ContentType="application/xml"/>{parts}</Types>')
+
+
+def _rels(targets: Sequence[Tuple[str, str, str]]) -> str:
+    items = "".join(f'<Relationship Id="{rid}" Type="{_OFFICE_REL}/{kind}" Target="{target}"/>'
+                    for rid, kind, target in targets)
+    return f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><Relationships xmlns="{_RELATIONSHIPS}">{items}</Relationships>'
+
+
+def _zip(parts: Dict[str, str]) -> bytes:
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as archive:
+        for name, text in parts.items():
+            archive.writestr(name, text)
+    return out.getvalue()
+
+
+def make_docx(paragraphs: List[str], tables: Sequence[List[List[str]]] = ()) -> bytes:
+    """Build a minimal, valid DOCX with `paragraphs` followed by `tables` (lists of rows of cells)."""
+    def paragraph(text: str) -> str:
+        return f'<w:p><w:r><w:t xml:space="preserve">{escape(text)}</w:t></w:r></w:p>'
+
+    body = [paragraph(text) for text in paragraphs]
+    for table in tables:
+        rows = "".join("<w:tr>" + "".join(f"<w:tc>{paragraph(cell)}</w:tc>" for cell in row) + "</w:tr>"
+                       for row in table)
+        body.append(f"<w:tbl>{rows}</w:tbl>")
+    document = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?><w:document xmlns:w="{_WORD_NS}">'
+                f'<w:body>{"".join(body)}<w:sectPr/></w:body></w:document>')
+    return _zip({
+        "[Content_Types].xml": _content_types({
+            "word/document.xml":
+                "application/vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"}),
+        "_rels/.rels": _rels([("rId1", "officeDocument", "word/document.xml")]),
+        "word/document.xml": document,
+    })
+
+
+def _slide_shape(shape_id: int, placeholder: Optional[str], text: str) -> str:
+    ph = f'<p:ph type="{placeholder}"/>' if placeholder else ""
+    paragraphs = "".join(f"<a:p><a:r><a:t>{escape(line)}</a:t></a:r></a:p>" for line in text.split("\n"))
+    return (f'<p:sp><p:nvSpPr><p:cNvPr id="{shape_id}" name="Shape {shape_id}"/><p:cNvSpPr/>'
+            f'<p:nvPr>{ph}</p:nvPr></p:nvSpPr><p:spPr/><p:txBody><a:bodyPr/>{paragraphs}</p:txBody></p:sp>')
+
+
+def _slide_part(root: str, shapes: str) -> str:
+    return (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+            f'<p:{root} xmlns:a="{_DRAWING_NS}" xmlns:p="{_PRESENTATION_NS}" xmlns:r="{_OFFICE_REL}">'
+            f'<p:cSld><p:spTree><p:nvGrpSpPr><p:cNvPr id="1" name=""/><p:cNvGrpSpPr/><p:nvPr/></p:nvGrpSpPr>'
+            f'<p:grpSpPr/>{shapes}</p:spTree></p:cSld></p:{root}>')
+
+
+def make_pptx(slides: List[Tuple[str, str, str]]) -> bytes:
+    """Build a minimal, valid PPTX with one slide per (title, body, speaker notes) entry."""
+    slide_type = "application/vnd.openxmlformats-officedocument.presentationml.slide+xml"
+    notes_type = "application/vnd.openxmlformats-officedocument.presentationml.notesSlide+xml"
+    overrides = {"ppt/presentation.xml":
+                 "application/vnd.openxmlformats-officedocument.presentationml.presentation.main+xml"}
+    parts: Dict[str, str] = {}
+    slide_ids = []
+    for number, (title, body, notes) in enumerate(slides, start=1):
+        slide = f"ppt/slides/slide{number}.xml"
+        overrides[slide] = slide_type
+        slide_ids.append(f'<p:sldId id="{255 + number}" r:id="rId{number}"/>')
+        parts[slide] = _slide_part("sld", _slide_shape(2, "title", title) + _slide_shape(3, None, body)
+                                   + _slide_shape(4, "sldNum", str(number)))
+        if notes:
+            notes_slide = f"ppt/notesSlides/notesSlide{number}.xml"
+            overrides[notes_slide] = notes_type
+            parts[notes_slide] = _slide_part("notes", _slide_shape(2, "sldImg", "")
+                                             + _slide_shape(3, "body", notes))
+            parts[f"ppt/slides/_rels/slide{number}.xml.rels"] = _rels(
+                [("rId1", "notesSlide", f"../notesSlides/notesSlide{number}.xml")])
+            parts[f"ppt/notesSlides/_rels/notesSlide{number}.xml.rels"] = _rels(
+                [("rId1", "slide", f"../slides/slide{number}.xml")])
+    presentation = (f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                    f'<p:presentation xmlns:a="{_DRAWING_NS}" xmlns:p="{_PRESENTATION_NS}" xmlns:r="{_OFFICE_REL}">'
+                    f'<p:sldIdLst>{"".join(slide_ids)}</p:sldIdLst>'
+                    f'<p:sldSz cx="9144000" cy="6858000"/><p:notesSz cx="6858000" cy="9144000"/></p:presentation>')
+    return _zip({
+        "[Content_Types].xml": _content_types(overrides),
+        "_rels/.rels": _rels([("rId1", "officeDocument", "ppt/presentation.xml")]),
+        "ppt/presentation.xml": presentation,
+        "ppt/_rels/presentation.xml.rels": _rels(
+            [(f"rId{number}", "slide", f"slides/slide{number}.xml") for number in range(1, len(slides) + 1)]),
+        **parts,
+    })
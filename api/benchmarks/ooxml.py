@@ -0,0 +1,147 @@
+"""
+Compare DOCX and PPTX text extraction: the native OOXML extractor against
+the Unstructured loaders it replaces.
+
+Each extractor runs in a fresh interpreter, so its import time and peak RSS
+are its own. Per document it reports the extraction time and the peak
+memory allocated while extracting (tracemalloc, on a separate pass so it
+does not slow the timed runs).
+
+Usage (from the `api/` folder):
+
+    python -m benchmarks.ooxml --documents 20 --paragraphs 2000 --slides 60
+    python -m benchmarks.ooxml --files ~/samples --runs 5 --output ooxml.json
+
+Without `--files`, synthetic documents are generated with `benchmarks.fakes`.
+The Unstructured side is reported as skipped when `unstructured` (and
+python-docx / python-pptx) are not installed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from typing import Any, Dict, List, Optional
+
+from benchmarks.fakes import make_docx, make_pptx, sample_text
+
+# Runs in the child interpreter with the extractor name and the files as arguments
+CHILD = r"""
+import json, os, resource, sys, time, tracemalloc
+
+extractor, runs, paths = sys.argv[1], int(sys.argv[2]), sys.argv[3:]
+started = time.perf_counter()
+if extractor == "native":
+    import langchain.schema.document  # imported lazily by the extractor
+    from app.ooxml import extract_docx, extract_pptx
+    load = {"docx": extract_docx, "pptx": extract_pptx}
+else:
+    from langchain.document_loaders import UnstructuredPowerPointLoader, UnstructuredWordDocumentLoader
+    load = {"docx": lambda path: UnstructuredWordDocumentLoader(path).load(),
+            "pptx": lambda path: UnstructuredPowerPointLoader(path).load()}
+imported = time.perf_counter() - started
+
+documents = []
+for path in paths:
+    extract = load[path.rsplit(".", 1)[-1]]
+    seconds = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = extract(path)
+        seconds.append(time.perf_counter() - started)
+    tracemalloc.start()
+    extract(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    documents.append({"path": path, "bytes": os.path.getsize(path), "seconds": seconds, "peak_bytes": peak,
+                      "characters": sum(len(document.page_content) for document in result)})
+print(json.dumps({"import_seconds": imported, "documents": documents,
+                  "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}))
+"""
+
+
+def synthetic_documents(folder: str, documents: int, paragraphs: int, slides: int) -> List[str]:
+    """Write `documents` DOCX and as many PPTX files with tables and speaker notes."""
+    paths = []
+    for i in range(documents):
+        table = [[f"Fila {row}", sample_text(f"cell-{i}-{row}", 6), str(row * 17)] for row in range(20)]
+        path = os.path.join(folder, f"document-{i}.docx")
+        with open(path, "wb") as f:
+            f.write(make_docx([sample_text(f"docx-{i}-{p}", 60) for p in range(paragraphs)], [table] * 3))
+        paths.append(path)
+
+        path = os.path.join(folder, f"slides-{i}.pptx")
+        with open(path, "wb") as f:
+            f.write(make_pptx([(f"Diapositiva {s + 1}",
+                                "\n".join(sample_text(f"pptx-{i}-{s}-{b}", 12) for b in range(5)),
+                                sample_text(f"notes-{i}-{s}", 40)) for s in range(slides)]))
+        paths.append(path)
+    return paths
+
+
+def run_child(extractor: str, paths: List[str], runs: int) -> Dict[str, Any]:
+    result = subprocess.run([sys.executable, "-c", CHILD, extractor, str(runs), *paths],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"skipped": (result.stderr.strip().splitlines() or ["failed"])[-1]}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def summarise(measured: Dict[str, Any]) -> Dict[str, Any]:
+    if "skipped" in measured:
+        return measured
+    summary: Dict[str, Any] = {"import_seconds": round(measured["import_seconds"], 4),
+                               "rss_mb": round(measured["rss_mb"], 1)}
+    for file_type in ("docx", "pptx"):
+        documents = [d for d in measured["documents"] if d["path"].endswith(file_type)]
+        if not documents:
+            continue
+        # Median over runs, per document
+        seconds = [statistics.median(d["seconds"]) for d in documents]
+        total_seconds = sum(seconds)
+        summary[file_type] = {
+            "documents": len(documents),
+            "docs_per_second": round(len(documents) / total_seconds, 2),
+            "mb_per_second": round(sum(d["bytes"] for d in documents) / total_seconds / 2 ** 20, 2),
+            "seconds_per_document": {"median": round(statistics.median(seconds), 4), "max": round(max(seconds), 4)},
+            "peak_traced_mb": {"median": round(statistics.median(d["peak_bytes"] for d in documents) / 2 ** 20, 2),
+                               "max": round(max(d["peak_bytes"] for d in documents) / 2 ** 20, 2)},
+            "characters": sum(d["characters"] for d in documents),
+        }
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", help="Folder with real .docx and .pptx files to use instead of synthetic ones")
+    parser.add_argument("--documents", type=int, default=10, help="Synthetic documents of each type")
+    parser.add_argument("--paragraphs", type=int, default=1000, help="Paragraphs per synthetic DOCX")
+    parser.add_argument("--slides", type=int, default=40, help="Slides per synthetic PPTX")
+    parser.add_argument("--runs", type=int, default=3, help="Timed extractions per document")
+    parser.add_argument("--extractors", default="native,unstructured")
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as folder:
+        if args.files:
+            paths = sorted(os.path.join(args.files, name) for name in os.listdir(args.files)
+                           if name.lower().endswith((".docx", ".pptx")))
+        else:
+            paths = synthetic_documents(folder, args.documents, args.paragraphs, args.slides)
+        report: Dict[str, Any] = {"benchmark": "chatpdfgio-api-ooxml", "files": len(paths),
+                                  "megabytes": round(sum(os.path.getsize(p) for p in paths) / 2 ** 20, 2)}
+        for extractor in args.extractors.split(","):
+            report[extractor] = summarise(run_child(extractor, paths, args.runs))
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
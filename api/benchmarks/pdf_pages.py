@@ -0,0 +1,77 @@
+"""
+Measure single-document PDF extraction latency against the number of
+extraction processes (`PDF_PARSE_PROCESSES`).
+
+Usage (from the `api/` folder):
+
+    python -m benchmarks.pdf_pages --pages 2000 --processes 1,2,4,8
+    python -m benchmarks.pdf_pages --file big.pdf --runs 5 --output pdf_pages.json
+
+Each process count is timed after one warm-up extraction, so starting the
+pool is not counted. Every run is checked to return the same pages as the
+in-process extraction.
+"""
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from app import pdf_pages
+from benchmarks.fakes import make_pdf, sample_text
+
+
+def measure(path: str, processes: int, runs: int, expected: Optional[List[str]]) -> Dict[str, Any]:
+    pdf_pages.shutdown_page_pool()
+    pdf_pages.PDF_PARSE_PROCESSES = processes
+    pdf_pages.load_pdf_pages(path)
+    seconds = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        documents = pdf_pages.load_pdf_pages(path)
+        seconds.append(time.perf_counter() - started)
+        if expected is not None and [document.page_content for document in documents] != expected:
+            raise AssertionError(f"Pages extracted with {processes} processes differ from the in-process ones")
+    pdf_pages.shutdown_page_pool()
+    median = statistics.median(seconds)
+    return {"processes": processes, "seconds": {"median": round(median, 4), "min": round(min(seconds), 4)},
+            "pages_per_second": round(len(documents) / median, 1)}
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="A PDF to extract instead of a synthetic one")
+    parser.add_argument("--pages", type=int, default=1000, help="Pages of the synthetic PDF")
+    parser.add_argument("--processes", default=f"1,{os.cpu_count() or 1}", help="Comma-separated process counts")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    args = parser.parse_args(argv)
+
+    pdf_pages.PDF_PARALLEL_MIN_PAGES = 1
+    with tempfile.TemporaryDirectory() as folder:
+        path = args.file
+        if path is None:
+            path = os.path.join(folder, "bench.pdf")
+            with open(path, "wb") as f:
+                f.write(make_pdf([sample_text(f"page-{i}", 300) for i in range(args.pages)]))
+        pdf_pages.PDF_PARSE_PROCESSES = 1
+        expected = [document.page_content for document in pdf_pages.load_pdf_pages(path)]
+        results = [measure(path, int(processes), args.runs, expected) for processes in args.processes.split(",")]
+
+    baseline = results[0]["seconds"]["median"]
+    for result in results:
+        result["speedup"] = round(baseline / result["seconds"]["median"], 2)
+    report = {"benchmark": "chatpdfgio-api-pdf-pages", "pages": len(expected), "cpus": os.cpu_count(),
+              "results": results}
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+"""
+Replay captured production traffic against a deployment.
+
+Usage (from the `api/` folder):
+
+    python -m benchmarks.replay traffic/ --url http://staging:8000 --speed 4 \
+        --concurrency 32 --output replay.json
+
+Reads the request logs written with `TRAFFIC_CAPTURE=1` (a directory or
+files, rotated files included), sends the requests in their captured order
+and pace, `--speed` times faster (0: as fast as `--concurrency` allows), and
+reports the latency of each kind of request next to the one it was captured
+with. Uploaded files are not captured: each is replaced by a synthetic file
+of the same type and weight, the same one for every upload of the same
+content, unless `--files-dir` holds the original, found by its SHA-256.
+Audio cannot be synthesized into speech the deployment would transcribe like
+the original, so requests uploading audio are only replayed from
+`--files-dir`; the others are counted as skipped, per kind, and not sent.
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import time
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.fakes import make_docx, make_pdf, make_pptx, sample_text
+from benchmarks.run import latency_summary
+
+AUDIO_TYPES = ("mp3", "m4a")
+CONTENT_TYPES = {
+    "pdf": "application/pdf",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "mp3": "audio/mpeg",
+    "m4a": "audio/mp4",
+}
+# Words of synthetic text per chunk the original file produced, a page that
+# fits in one chunk; and bytes of the original per chunk when the chunk count
+# was not captured (a deduplicated or failed upload)
+WORDS_PER_CHUNK = 250
+BYTES_PER_CHUNK = 8 * 1024
+
+
+def capture_paths(paths: List[str]) -> List[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(os.path.join(path, "traffic-*.jsonl*"))))
+        else:
+            files.append(path)
+    return files
+
+
+def read_capture(paths: List[str], kinds: Optional[List[str]] = None) -> List[Dict[str, Any]]:
+    """The captured requests of every file, in arrival order."""
+    records = []
+    for path in capture_paths(paths):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    if not kinds or record["kind"] in kinds:
+                        records.append(record)
+    records.sort(key=lambda record: record["ts"])
+    return records
+
+
+class MissingOriginal(Exception):
+    """A captured file that has no original in `--files-dir` and cannot be synthesized."""
+
+
+def synthetic_file(file: Dict[str, Any]) -> bytes:
+    """A document of the captured type and weight, derived from the captured digest."""
+    seed = file["sha256"]
+    chunks = file.get("chunks") or max(1, file["size"] // BYTES_PER_CHUNK)
+    if file["type"] == "pdf":
+        return make_pdf([sample_text(f"{seed}-{page}", WORDS_PER_CHUNK) for page in range(chunks)])
+    if file["type"] == "docx":
+        return make_docx([sample_text(f"{seed}-{part}", WORDS_PER_CHUNK) for part in range(chunks)])
+    if file["type"] == "pptx":
+        return make_pptx([(f"Slide {slide + 1}", sample_text(f"{seed}-{slide}", WORDS_PER_CHUNK), "")
+                          for slide in range(chunks)])
+    raise MissingOriginal(f"cannot synthesize a .{file['type']} file")
+
+
+class FileSource:
+    """The content replayed for each captured file, built once per digest."""
+
+    def __init__(self, files_dir: Optional[str]) -> None:
+        self.originals: Dict[str, str] = {}
+        self.contents: Dict[str, bytes] = {}
+        if files_dir:
+            for path in glob.glob(os.path.join(files_dir, "**", "*"), recursive=True):
+                if os.path.isfile(path):
+                    with open(path, "rb") as f:
+                        self.originals[hashlib.sha256(f.read()).hexdigest()] = path
+
+    def get(self, file: Dict[str, Any]) -> Tuple[str, bytes, str]:
+        digest = file["sha256"]
+        if digest not in self.contents:
+            if digest in self.originals:
+                with open(self.originals[digest], "rb") as f:
+                    self.contents[digest] = f.read()
+            elif file["type"] in AUDIO_TYPES:
+                # Noise would only measure the provider rejecting it
+                raise MissingOriginal(f"no original for audio file {digest}")
+            else:
+                self.contents[digest] = synthetic_file(file)
+        return f"replay-{digest[:12]}.{file['type']}", self.contents[digest], CONTENT_TYPES.get(
+            file["type"], "application/octet-stream")
+
+
+class Replayer:
+    """Sends captured requests and records the replayed latency of each."""
+
+    def __init__(self, client: httpx.AsyncClient, files: FileSource) -> None:
+        self.client = client
+        self.files = files
+        self.latencies: Dict[str, List[float]] = {}
+        self.captured: Dict[str, List[float]] = {}
+        self.statuses: Dict[str, Counter] = {}
+        self.errors: Counter = Counter()
+        self.skipped: Counter = Counter()
+        self.lag: List[float] = []
+
+    async def send(self, record: Dict[str, Any]) -> None:
+        kind = record["kind"]
+        headers = {"X-User-Id": f"replay-{record['user']}"} if record.get("user") else {}
+        try:
+            status, seconds = await getattr(self, f"_{kind}")(record, headers)
+        except MissingOriginal:
+            self.skipped[kind] += 1
+            return
+        except (httpx.HTTPError, KeyError) as e:
+            self.errors[f"{kind}: {type(e).__name__}"] += 1
+            return
+        self.latencies.setdefault(kind, []).append(seconds)
+        self.captured.setdefault(kind, []).append(record["seconds"])
+        self.statuses.setdefault(kind, Counter())[str(status)] += 1
+
+    async def _timed(self, method: str, url: str, **kwargs: Any) -> Tuple[httpx.Response, float]:
+        started = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        return response, time.perf_counter() - started
+
+    async def _chat(self, record: Dict[str, Any], headers: Dict[str, str]) -> Tuple[int, float]:
+        response, seconds = await self._timed("POST", "/chat/", params={"query": record["query"]}, headers=headers)
+        return response.status_code, seconds
+
+    async def _chat_batch(self, record: Dict[str, Any], headers: Dict[str, str]) -> Tuple[int, float]:
+        started = time.perf_counter()
+        # A streamed batch takes until its last result
+        async with self.client.stream("POST", "/chat/batch/", json={"queries": record["queries"]},
+                                      params={"stream": record.get("stream", False)}, headers=headers) as response:
+            await response.aread()
+        return response.status_code, time.perf_counter() - started
+
+    async def _upload(self, record: Dict[str, Any], headers: Dict[str, str]) -> Tuple[int, float]:
+        files = [("file", self.files.get(file)) for file in record.get("files", [])[:1]]
+        response, seconds = await self._timed("POST", "/upload/", files=files, headers=headers)
+        return response.status_code, seconds
+
+    async def _multiple_upload(self, record: Dict[str, Any], headers: Dict[str, str]) -> Tuple[int, float]:
+        files = [("files", self.files.get(file)) for file in record.get("files", [])]
+        response, seconds = await self._timed("POST", "/multipleupload/", files=files, headers=headers)
+        return response.status_code, seconds
+
+    async def _resumable_upload(self, record: Dict[str, Any], headers: Dict[str, str]) -> Tuple[int, float]:
+        # Only the completion was captured; the chunks are sent first, untimed
+        filename, content, _ = self.files.get(record["files"][0])
+        response = await self.client.post("/uploads/", json={"filename": filename, "size": len(content)},
+                                          headers=headers)
+        if response.status_code != 200:
+            return response.status_code, 0.0
+        upload = response.json()
+        for index, start in enumerate(range(0, len(content), upload["chunk_size"])):
+            chunk = content[start:start + upload["chunk_size"]]
+            await self.client.put(f"/uploads/{upload['upload_id']}/chunks/{index}", content=chunk,
+                                  headers={**headers, "X-Chunk-SHA256": hashlib.sha256(chunk).hexdigest()})
+        response, seconds = await self._timed("POST", f"/uploads/{upload['upload_id']}/complete", headers=headers)
+        return response.status_code, seconds
+
+
+def schedule(records: List[Dict[str, Any]], speed: float) -> Iterator[Tuple[float, Dict[str, Any]]]:
+    """Each record with the offset it is sent at, in seconds from the start of the replay."""
+    first = records[0]["ts"] if records else 0.0
+    for record in records:
+        yield ((record["ts"] - first) / speed if speed > 0 else 0.0), record
+
+
+async def replay(client: httpx.AsyncClient, records: List[Dict[str, Any]], args: argparse.Namespace) -> Dict[str, Any]:
+    replayer = Replayer(client, FileSource(args.files_dir))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    started = time.perf_counter()
+
+    async def one(offset: float, record: Dict[str, Any]) -> None:
+        await asyncio.sleep(max(0.0, offset - (time.perf_counter() - started)))
+        async with semaphore:
+            # How far behind the captured pace the request was sent
+            replayer.lag.append(max(0.0, time.perf_counter() - started - offset))
+            await replayer.send(record)
+
+    await asyncio.gather(*(one(offset, record) for offset, record in schedule(records, args.speed)))
+    elapsed = time.perf_counter() - started
+
+    captured_span = records[-1]["ts"] - records[0]["ts"] if records else 0.0
+    return {
+        "requests": len(records),
+        "seconds": round(elapsed, 4),
+        "captured_seconds": round(captured_span, 4),
+        "requests_per_sec": round(len(records) / elapsed, 3) if elapsed else 0.0,
+        "errors": dict(replayer.errors),
+        "skipped": dict(replayer.skipped),
+        "send_lag": latency_summary(replayer.lag),
+        "kinds": {
+            kind: {
+                "replayed": latency_summary(latencies),
+                "captured": latency_summary(replayer.captured[kind]),
+                "statuses": dict(replayer.statuses[kind]),
+            }
+            for kind, latencies in sorted(replayer.latencies.items())
+        },
+    }
+
+
+def parse_headers(values: List[str]) -> Dict[str, str]:
+    headers = {}
+    for value in values:
+        name, _, content = value.partition(":")
+        headers[name.strip()] = content.strip()
+    return headers
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", help="Capture files, or directories holding them")
+    parser.add_argument("--url", default="http://localhost:8000", help="Base URL of the deployment")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="Pace relative to the captured one, e.g. 4 for four times faster (0: no pacing)")
+    parser.add_argument("--concurrency", type=int, default=64, help="Most requests in flight at once")
+    parser.add_argument("--kinds", nargs="*", help="Replay only these kinds of request, e.g. chat upload")
+    parser.add_argument("--limit", type=int, default=0, help="Replay only the first N requests (0: all)")
+    parser.add_argument("--files-dir", help="Folder with the original files, matched to uploads by SHA-256")
+    parser.add_argument("--header", action="append", default=[], help="Extra header sent with every request, 'Name: value'")
+    parser.add_argument("--timeout", type=float, default=300.0, help="Seconds before a request is given up")
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    records = read_capture(args.captures, args.kinds)
+    if args.limit:
+        records = records[:args.limit]
+
+    async def run() -> Dict[str, Any]:
+        async with httpx.AsyncClient(base_url=args.url, headers=parse_headers(args.header), timeout=args.timeout,
+                                     limits=httpx.Limits(max_connections=args.concurrency)) as client:
+            return await replay(client, records, args)
+
+    report = {
+        "benchmark": "chatpdfgio-replay",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "url": args.url,
+        "config": {key: getattr(args, key) for key in ("captures", "speed", "concurrency", "kinds", "limit")},
+        **asyncio.run(run()),
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,322 @@
+"""
+Run the end-to-end benchmark suite against local fakes.
+
+Usage (from the `api/` folder):
+
+    python -m benchmarks.run --documents 5 --pages 20 --chat-requests 100 \
+        --concurrency 8 --chat-latency-ms 400 --output bench.json
+
+Compare against a previous run with `--baseline previous.json`.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import logging
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+
+from benchmarks.fakes import FakeOpenAIServer, FakePinecone, FakeS3Client, make_pdf, sample_text
+
+BUCKET_NAME = "bench-bucket"
+INDEX_NAME = "bench-index"
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of `values` (0 when empty)."""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, int(round(pct / 100.0 * len(ordered) + 0.5)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(latencies: List[float]) -> Dict[str, float]:
+    """Summarise a list of latencies in seconds as milliseconds."""
+    return {
+        "count": len(latencies),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 3),
+        "max_ms": round(max(latencies) * 1000, 3) if latencies else 0.0,
+    }
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MiB."""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in KiB on Linux
+    divisor = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(usage / divisor, 2)
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class BenchEnvironment:
+    """Start the fakes, point the app at them and import `main`."""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.openai = FakeOpenAIServer(
+            embedding_latency_ms=args.embedding_latency_ms,
+            chat_latency_ms=args.chat_latency_ms,
+            transcription_latency_ms=args.transcription_latency_ms,
+            jitter=args.jitter,
+            rpm_limit=args.openai_rpm_limit,
+        )
+        self.pinecone = FakePinecone(query_latency_ms=args.search_latency_ms)
+        self.s3 = FakeS3Client()
+        self.main: Any = None
+        self.import_seconds = 0.0
+        self.workdir = tempfile.TemporaryDirectory(prefix="chatpdf-bench-")
+
+    def __enter__(self) -> "BenchEnvironment":
+        self.openai.start()
+        os.environ.update({
+            "OPENAI_API_KEY": "bench",
+            "OPENAI_BASE_URL": self.openai.base_url,
+            "OPENAI_API_BASE": self.openai.base_url,
+            "PINECONE_API_KEY": "bench",
+            "PINECONE_API_ENV": "bench",
+            "YOUR_INDEX_NAME": INDEX_NAME,
+            "YOUR_BUCKET_NAME": BUCKET_NAME,
+            "AWS_ACCESS_KEY": "bench",
+            "AWS_SECRET_ACCESS_KEY": "bench",
+            "AWS_REGION": "us-east-1",
+            "USAGE_DB_PATH": os.path.join(self.workdir.name, "usage.db"),
+            "UPLOAD_DB_PATH": os.path.join(self.workdir.name, "uploads.db"),
+            "DEDUP_DB_PATH": os.path.join(self.workdir.name, "dedup.db"),
+            "QUERY_CACHE_DB_PATH": os.path.join(self.workdir.name, "query_cache.db"),
+            "INDEX_DB_PATH": os.path.join(self.workdir.name, "indexes.db"),
+            "PROFILE_DIR": os.path.join(self.workdir.name, "profiles"),
+            "RETRIEVAL_CONFIG_PATH": os.path.join(self.workdir.name, "retrieval_config.json"),
+        })
+        # The fake bag-of-words embeddings score lower than OpenAI's, so the
+        # score threshold is set to the fakes' range
+        with open(os.environ["RETRIEVAL_CONFIG_PATH"], "w") as f:
+            json.dump({"min_score": self.args.min_score, "document_shortlist": self.args.document_shortlist}, f)
+        self.pinecone.install()
+        self.pinecone.create_index(INDEX_NAME, dimension=self.openai.dimension)
+
+        started = time.perf_counter()
+        self.main = importlib.import_module("main")
+        self.import_seconds = time.perf_counter() - started
+        self._install_s3()
+        return self
+
+    def _install_s3(self) -> None:
+        # The app creates its clients in its lifespan; give it the fake instead
+        from app.clients import register_client
+        register_client("s3", self.s3)
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.pinecone.uninstall()
+        self.openai.stop()
+        self.workdir.cleanup()
+
+    @property
+    def index(self):
+        return self.pinecone.indexes[INDEX_NAME]
+
+
+# Repeated on every page of every document when --boilerplate is set
+HEADER = "ACME Corporation - Confidential - Internal use only - Page {page} of {pages}"
+FOOTER = ("This document contains proprietary information of ACME Corporation. Any reproduction, "
+          "distribution or disclosure without prior written consent is strictly prohibited.")
+
+
+def build_documents(documents: int, pages: int, words_per_page: int, audio_files: int,
+                    boilerplate: bool = False) -> List[Tuple[str, bytes, str]]:
+    files = []
+    for d in range(documents):
+        body = [sample_text(f"doc{d}-page{p}", words_per_page) for p in range(pages)]
+        if boilerplate:
+            body = [f"{HEADER.format(page=p + 1, pages=pages)}\n{text}\n{FOOTER}" for p, text in enumerate(body)]
+        files.append((f"bench-{d}.pdf", make_pdf(body), "application/pdf"))
+    for a in range(audio_files):
+        files.append((f"bench-{a}.mp3", os.urandom(64 * 1024), "audio/mpeg"))
+    return files
+
+
+async def run_ingestion(client: httpx.AsyncClient, env: BenchEnvironment, args: argparse.Namespace) -> Dict[str, Any]:
+    files = build_documents(args.documents, args.pages, args.words_per_page, args.audio_files, args.boilerplate)
+    chunks_before = len(env.index)
+    latencies, failures = [], 0
+
+    started = time.perf_counter()
+    for filename, content, content_type in files:
+        request_started = time.perf_counter()
+        response = await client.post("/multipleupload/", files=[("files", (filename, content, content_type))])
+        latencies.append(time.perf_counter() - request_started)
+        results = response.json().get("results", []) if response.status_code == 200 else []
+        failures += sum(1 for result in results if result.get("status") != "Success") or int(not results)
+    elapsed = time.perf_counter() - started
+
+    chunks = len(env.index) - chunks_before
+    return {
+        "files": len(files),
+        "failed_files": failures,
+        "pages": args.documents * args.pages,
+        "bytes": sum(len(content) for _, content, _ in files),
+        "chunks": chunks,
+        "seconds": round(elapsed, 4),
+        "chunks_per_sec": round(chunks / elapsed, 3) if elapsed else 0.0,
+        "file_latency": latency_summary(latencies),
+    }
+
+
+async def run_chat(client: httpx.AsyncClient, args: argparse.Namespace) -> Dict[str, Any]:
+    queries = [sample_text(f"query-{i % args.distinct_queries}", 10) + "?" for i in range(args.chat_requests)]
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    errors = 0
+
+    async def one(query: str) -> None:
+        nonlocal errors
+        async with semaphore:
+            request_started = time.perf_counter()
+            response = await client.post("/chat/", params={"query": query})
+            latencies.append(time.perf_counter() - request_started)
+            if response.status_code != 200:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(query) for query in queries))
+    elapsed = time.perf_counter() - started
+
+    summary = latency_summary(latencies)
+    summary.update({
+        "concurrency": args.concurrency,
+        "errors": errors,
+        "seconds": round(elapsed, 4),
+        "requests_per_sec": round(len(queries) / elapsed, 3) if elapsed else 0.0,
+    })
+    return summary
+
+
+async def run_scenarios(env: BenchEnvironment, args: argparse.Namespace) -> Dict[str, Any]:
+    app = env.main.app
+    transport = httpx.ASGITransport(app=app)
+    async with app.router.lifespan_context(app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            ingestion = await run_ingestion(client, env, args)
+            rss_after_ingestion = peak_rss_mb()
+            chat = await run_chat(client, args)
+    report = env.main.startup_report
+    return {
+        "startup": {key: report[key] for key in ("lifespan_seconds", "clients_seconds") if key in report},
+        "ingestion": ingestion,
+        "chat": chat,
+        "memory": {"peak_rss_mb_after_ingestion": rss_after_ingestion, "peak_rss_mb": peak_rss_mb()},
+    }
+
+
+def flatten(report: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    flat = {}
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, f"{name}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> List[str]:
+    """Return one line per metric present in both reports with its relative change."""
+    lines = []
+    old = flatten({k: baseline.get(k, {}) for k in ("startup", "ingestion", "chat", "memory")})
+    new = flatten({k: current.get(k, {}) for k in ("startup", "ingestion", "chat", "memory")})
+    for name in sorted(set(old) & set(new)):
+        before, after = old[name], new[name]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else "n/a"
+        lines.append(f"{name:<45} {before:>12} -> {after:<12} {change}")
+    return lines
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=3, help="Synthetic PDFs to ingest")
+    parser.add_argument("--pages", type=int, default=10, help="Pages per synthetic PDF")
+    parser.add_argument("--words-per-page", type=int, default=350)
+    parser.add_argument("--boilerplate", action="store_true",
+                        help="Add a header and a legal footer to every page of every document")
+    parser.add_argument("--audio-files", type=int, default=1, help="Synthetic MP3 uploads (transcribed by the fake)")
+    parser.add_argument("--chat-requests", type=int, default=50)
+    parser.add_argument("--distinct-queries", type=int, default=20, help="Number of distinct chat questions")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--embedding-latency-ms", type=float, default=20.0)
+    parser.add_argument("--chat-latency-ms", type=float, default=300.0)
+    parser.add_argument("--transcription-latency-ms", type=float, default=500.0)
+    parser.add_argument("--search-latency-ms", type=float, default=10.0)
+    parser.add_argument("--min-score", type=float, default=0.05,
+                        help="Retrieval score threshold; chat questions below it skip the completion")
+    parser.add_argument("--document-shortlist", type=int, default=0,
+                        help="Documents shortlisted by summary vector before searching chunks (0: flat search)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random extra latency as a fraction of the base")
+    parser.add_argument("--openai-rpm-limit", type=int, default=0,
+                        help="Simulate an OpenAI requests-per-minute limit per endpoint (0 disables)")
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    parser.add_argument("--baseline", help="Previous JSON report to compare against")
+    parser.add_argument("--verbose", action="store_true", help="Keep the application's INFO logging")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    # Configure logging before the app does, so its basicConfig is a no-op
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    with BenchEnvironment(args) as env:
+        results = asyncio.run(run_scenarios(env, args))
+        upstream_calls = {
+            "openai": dict(env.openai.calls),
+            "pinecone": dict(env.index.calls),
+            "s3": dict(env.s3.calls),
+        }
+
+    report = {
+        "benchmark": "chatpdfgio-api",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "verbose")},
+        "startup": {"import_seconds": round(env.import_seconds, 4), **results.pop("startup")},
+        **results,
+        "upstream_calls": upstream_calls,
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print("\nChange against baseline:")
+        for line in compare(report, baseline):
+            print(line)
+    return report
+
+
+if __name__ == "__main__":
+    main()
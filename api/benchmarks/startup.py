@@ -0,0 +1,108 @@
+"""
+Measure worker cold start: importing `main` and running its lifespan in a
+fresh interpreter, against the local fakes.
+
+Usage (from the `api/` folder):
+
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --runs 5 --preload --output startup.json
+
+`--preload` sets `PRELOAD_APP=1`, which is what the gunicorn master does once
+before forking, so its import time is paid once rather than per worker.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+from typing import Any, Dict, List, Optional
+
+# Runs in the child interpreter. Only `main` and the lifespan are timed; the
+# fakes are started first and Pinecone is imported by them, so the child times
+# what a worker pays beyond that.
+CHILD = r"""
+import asyncio, json, os, resource, sys, time
+from benchmarks.fakes import FakeOpenAIServer, FakePinecone, FakeS3Client
+
+openai = FakeOpenAIServer(embedding_latency_ms=0, chat_latency_ms=0, transcription_latency_ms=0)
+openai.start()
+os.environ.update({"OPENAI_API_KEY": "bench", "OPENAI_BASE_URL": openai.base_url,
+                   "YOUR_INDEX_NAME": "bench-index", "YOUR_BUCKET_NAME": "bench-bucket"})
+pinecone = FakePinecone()
+pinecone.install()
+modules_before = set(sys.modules)
+
+started = time.perf_counter()
+import main
+imported = time.perf_counter() - started
+
+from app.clients import register_client
+register_client("s3", FakeS3Client())
+
+
+async def lifespan():
+    async with main.app.router.lifespan_context(main.app):
+        pass
+
+started = time.perf_counter()
+asyncio.run(lifespan())
+lifespan_seconds = time.perf_counter() - started
+
+heavy = ("langchain", "unstructured", "pypdf", "docx", "pptx")
+print(json.dumps({
+    "import_seconds": imported,
+    "lifespan_seconds": lifespan_seconds,
+    "modules_loaded": len(set(sys.modules) - modules_before),
+    "heavy_modules_loaded": sorted({m.split(".")[0] for m in set(sys.modules) - modules_before if m.split(".")[0] in heavy}),
+    "rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+}))
+openai.stop()
+"""
+
+
+def run_child(preload: bool) -> Dict[str, Any]:
+    env = dict(os.environ)
+    env.pop("PRELOAD_APP", None)
+    if preload:
+        env["PRELOAD_APP"] = "1"
+    output = subprocess.check_output([sys.executable, "-c", CHILD], env=env, text=True,
+                                     stderr=subprocess.DEVNULL)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarise(runs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    summary: Dict[str, Any] = {"runs": len(runs)}
+    for key in ("import_seconds", "lifespan_seconds", "rss_mb"):
+        values = [run[key] for run in runs]
+        summary[key] = {
+            "min": round(min(values), 4),
+            "median": round(statistics.median(values), 4),
+            "max": round(max(values), 4),
+        }
+    summary["modules_loaded"] = runs[-1]["modules_loaded"]
+    summary["heavy_modules_loaded"] = runs[-1]["heavy_modules_loaded"]
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--preload", action="store_true", help="Also measure with PRELOAD_APP=1")
+    parser.add_argument("--output", help="Write the JSON report to this path")
+    args = parser.parse_args(argv)
+
+    report = {"benchmark": "chatpdfgio-api-startup", "lazy": summarise([run_child(False) for _ in range(args.runs)])}
+    if args.preload:
+        report["preload"] = summarise([run_child(True) for _ in range(args.runs)])
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    print(text)
+    return report
+
+
+if __name__ == "__main__":
+    main()
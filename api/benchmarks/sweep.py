@@ -0,0 +1,354 @@
+"""
+Sweep the retrieval parameters against a labelled question set and recommend
+a config for the service.
+
+Usage (from the `api/` folder):
+
+    python -m benchmarks.sweep --dataset questions.jsonl --documents docs/ --output retrieval_config.json
+    python -m benchmarks.sweep --dataset questions.jsonl --documents docs/ --embeddings fake \\
+        --top-k 3,6,10 --chunk-tokens 128,256,512 --chunk-overlap-tokens 0,50 --context-fraction 0.2,0.3
+
+The dataset has one labelled question per line:
+
+    {"question": "...", "sources": ["contract.pdf"], "answer": "optional passage that answers it"}
+
+A retrieved chunk is relevant when it comes from one of the `sources` files
+and, if `answer` is given, contains it (ignoring case and whitespace).
+
+The documents are parsed and split the way the service does, embedded once
+per chunk budget and overlap and searched in a local in-memory index, so the
+sweep never touches Pinecone. Every combination of the grids is measured on:
+
+- `recall_at_k`: share of questions with a relevant chunk among the matches
+  kept after the score threshold and gap cutoffs (at most top_k)
+- `context_recall`: the same, among the matches that fit in the prompt
+- `no_context_rate`: share of questions left without context, which the
+  service answers without calling the chat model
+- `prompt_tokens`: mean tokens of the completion prompt (0 without context)
+- `latency_ms`: p50/p95 of query embedding, search and prompt assembly, plus
+  the completion itself with `--completions` (which calls the chat model for
+  every question and combination)
+
+The Pareto frontier over (context recall, prompt tokens, p50 latency) is
+printed, and the recommended config is the frontier point with the fewest
+prompt tokens among those within `--recall-tolerance` of the best recall.
+The output file can be used as is as the service's `RETRIEVAL_CONFIG_PATH`.
+Chunks and questions are embedded with `EMBEDDING_MODEL`. For a model other
+than ada-002, the recommended `min_score` is written under `score_thresholds`,
+which a migration to that model requires; its `fast_min_score` is set by hand.
+Note that a new chunk budget or overlap only applies to documents ingested
+after the service loads it.
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from app.chat import (CONTEXT_SEPARATOR, build_completion_prompt, fitting_contexts, get_completion,
+                      select_matches, vectorize_texts)
+from app.chunking import token_counter
+from app.dedup import strip_repeated_lines
+from app.embedding_index import LEGACY_MODEL, configured_spec
+from app.ooxml import load_ooxml
+from app.pdf_pages import load_pdf_pages
+from app.pinecone_ops import split_pdf_data
+from app.retrieval_config import RetrievalConfig, ScoreThresholds
+from benchmarks.run import percentile
+
+# Default --min-score grids: ada-002 scores nearly everything above 0.7, the
+# text-embedding-3 models score relevant matches far lower
+LEGACY_MIN_SCORES = [0.7, 0.75, 0.8]
+MIN_SCORES = [0.2, 0.3, 0.4]
+
+# The service's extractors, so the sweep chunks the same text ingestion does
+LOADERS: Dict[str, Callable[[str], List[Any]]] = {
+    "pdf": load_pdf_pages,
+    "docx": lambda path: load_ooxml(path, "docx"),
+    "pptx": lambda path: load_ooxml(path, "pptx"),
+}
+
+_SPACE_RE = re.compile(r"\s+")
+
+
+def _normalize(text: str) -> str:
+    return _SPACE_RE.sub(" ", text).strip().lower()
+
+
+def _grid(value: str, kind: Callable[[str], Any]) -> List[Any]:
+    return [kind(item) for item in value.split(",") if item.strip()]
+
+
+def load_dataset(path: str) -> List[Dict[str, Any]]:
+    """Read the labelled questions, one JSON object per line."""
+    questions = []
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            if not item.get("question") or not item.get("sources"):
+                raise ValueError(f"{path}:{line_number}: every item needs a question and its sources")
+            questions.append({
+                "question": item["question"],
+                "sources": {os.path.basename(source) for source in item["sources"]},
+                "answer": _normalize(item["answer"]) if item.get("answer") else None,
+            })
+    return questions
+
+
+def load_documents(directory: str) -> List[Any]:
+    """Parse the supported files of `directory` into pages, with the file name as their source."""
+    pages = []
+    for name in sorted(os.listdir(directory)):
+        loader = LOADERS.get(name.rsplit(".", 1)[-1].lower())
+        if loader is None:
+            continue
+        document = loader(os.path.join(directory, name))
+        # Boilerplate is stripped per document, as at ingestion
+        strip_repeated_lines(document)
+        for page in document:
+            page.metadata["source"] = name
+        pages.extend(document)
+        logging.info(f"Loaded {name}: {len(document)} pages")
+    if not pages:
+        raise ValueError(f"No {', '.join(LOADERS)} files in {directory}")
+    return pages
+
+
+class Embedder:
+    """
+    Embed texts once, with the configured embedding model, the one the
+    service builds new indexes with, or the benchmark's bag-of-words stand-in,
+    scored like ada-002.
+    """
+
+    def __init__(self, kind: str, batch_size: int = 256) -> None:
+        self.kind = kind
+        self.batch_size = batch_size
+        self.cache: Dict[str, np.ndarray] = {}
+        self.spec = configured_spec() if kind == "openai" else None
+        self.model = self.spec.model if self.spec is not None else LEGACY_MODEL
+
+    def _embed(self, texts: List[str]) -> List[List[float]]:
+        if self.kind == "fake":
+            from benchmarks.fakes import fake_embedding
+            return [fake_embedding(text) for text in texts]
+        return vectorize_texts(texts, spec=self.spec)
+
+    def embed(self, texts: Iterable[str]) -> np.ndarray:
+        texts = list(texts)
+        missing = list(dict.fromkeys(text for text in texts if text not in self.cache))
+        for start in range(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            for text, vector in zip(batch, self._embed(batch)):
+                vector = np.asarray(vector, dtype=np.float32)
+                self.cache[text] = vector / (np.linalg.norm(vector) or 1.0)
+        return np.stack([self.cache[text] for text in texts])
+
+    def embed_timed(self, text: str) -> Tuple[np.ndarray, float]:
+        started = time.perf_counter()
+        vector = self.embed([text])[0]
+        return vector, time.perf_counter() - started
+
+
+class LocalIndex:
+    """Exact cosine search over the chunks of one chunk size and overlap."""
+
+    def __init__(self, chunks: List[Any], embedder: Embedder) -> None:
+        self.texts = [chunk.page_content for chunk in chunks]
+        self.sources = [chunk.metadata.get("source") for chunk in chunks]
+        self.vectors = embedder.embed(self.texts)
+
+    def search(self, vector: np.ndarray, top_k: int) -> List[Dict[str, Any]]:
+        """The best `top_k` matches as `{"position", "score"}`, in the layout of Pinecone's matches."""
+        scores = self.vectors @ vector
+        top = np.argpartition(-scores, min(top_k, len(scores)) - 1)[:top_k]
+        return [{"position": int(i), "score": float(scores[i])} for i in top[np.argsort(-scores[top])]]
+
+
+def _relevant(index: LocalIndex, position: int, question: Dict[str, Any]) -> bool:
+    if index.sources[position] not in question["sources"]:
+        return False
+    return question["answer"] is None or question["answer"] in _normalize(index.texts[position])
+
+
+def evaluate(config: RetrievalConfig, index: LocalIndex, questions: List[Dict[str, Any]],
+             query_vectors: List[Tuple[np.ndarray, float]], count_tokens: Callable[[str], int],
+             completions: bool) -> Dict[str, Any]:
+    """Measure one config on every question."""
+    hits = context_hits = no_context = 0
+    prompt_tokens, latencies = [], []
+    for question, (vector, embedding_seconds) in zip(questions, query_vectors):
+        started = time.perf_counter()
+        matches = [x["position"] for x in select_matches(index.search(vector, config.candidate_k), config,
+                                                         ScoreThresholds(config.min_score, None))]
+        in_context = fitting_contexts([index.texts[i] for i in matches], config)
+        context = CONTEXT_SEPARATOR.join(in_context)
+        system_prompt, prompt = build_completion_prompt(question["question"], context, "")
+        if completions and context:
+            get_completion(question["question"], context, "")
+        latencies.append(embedding_seconds + time.perf_counter() - started)
+
+        hits += any(_relevant(index, i, question) for i in matches)
+        context_hits += any(_relevant(index, i, question) for i in matches[:len(in_context)])
+        # Without context the service answers without a prompt
+        no_context += not context
+        prompt_tokens.append(count_tokens(system_prompt + prompt) if context else 0)
+
+    total = len(questions)
+    return {
+        "config": config._asdict(),
+        "chunks": len(index.texts),
+        "recall_at_k": round(hits / total, 4),
+        "context_recall": round(context_hits / total, 4),
+        "no_context_rate": round(no_context / total, 4),
+        "prompt_tokens": round(statistics.mean(prompt_tokens), 1),
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+        },
+    }
+
+
+def _dominates(a: Dict[str, Any], b: Dict[str, Any]) -> bool:
+    better_or_equal = (a["context_recall"] >= b["context_recall"]
+                       and a["prompt_tokens"] <= b["prompt_tokens"]
+                       and a["latency_ms"]["p50"] <= b["latency_ms"]["p50"])
+    strictly_better = (a["context_recall"] > b["context_recall"]
+                       or a["prompt_tokens"] < b["prompt_tokens"]
+                       or a["latency_ms"]["p50"] < b["latency_ms"]["p50"])
+    return better_or_equal and strictly_better
+
+
+def pareto_frontier(results: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """The results no other result beats on recall, prompt tokens and latency at once."""
+    frontier = [r for r in results if not any(_dominates(other, r) for other in results)]
+    return sorted(frontier, key=lambda r: (-r["context_recall"], r["prompt_tokens"]))
+
+
+def recommend(frontier: List[Dict[str, Any]], recall_tolerance: float) -> Dict[str, Any]:
+    """The cheapest frontier point whose recall is within `recall_tolerance` of the best."""
+    best_recall = max(r["context_recall"] for r in frontier)
+    candidates = [r for r in frontier if r["context_recall"] >= best_recall - recall_tolerance]
+    return min(candidates, key=lambda r: (r["prompt_tokens"], r["latency_ms"]["p50"]))
+
+
+def service_config(config: Dict[str, Any], model: str) -> Dict[str, Any]:
+    """The retrieval config of the service for a swept config, whose `min_score` is calibrated for `model`."""
+    if model == LEGACY_MODEL:
+        return config
+    # The top-level min_score is that of ada-002
+    return {**config, "min_score": RetrievalConfig().min_score,
+            "score_thresholds": {model: {"min_score": config["min_score"]}}}
+
+
+def sweep(args: argparse.Namespace) -> Dict[str, Any]:
+    questions = load_dataset(args.dataset)
+    pages = load_documents(args.documents)
+    embedder = Embedder(args.embeddings)
+    count_tokens = token_counter()
+
+    characters_per_token = args.characters_per_token
+    if characters_per_token is None:
+        # Measured on the corpus, so the context budget in characters matches the model's tokens
+        text = "\n".join(page.page_content for page in pages)
+        characters_per_token = round(len(text) / max(1, count_tokens(text)), 2)
+
+    query_vectors = [embedder.embed_timed(question["question"]) for question in questions]
+    min_scores = args.min_score or (LEGACY_MIN_SCORES if embedder.model == LEGACY_MODEL else MIN_SCORES)
+    results = []
+    for chunk_tokens, chunk_overlap_tokens in itertools.product(args.chunk_tokens, args.chunk_overlap_tokens):
+        if chunk_overlap_tokens >= chunk_tokens:
+            continue
+        split_config = RetrievalConfig(chunk_tokens=chunk_tokens, chunk_overlap_tokens=chunk_overlap_tokens)
+        chunks = [chunk for chunk in split_pdf_data(pages, split_config) if chunk.page_content.strip()]
+        index = LocalIndex(chunks, embedder)
+        for top_k, min_score, max_score_gap, context_fraction in itertools.product(
+                args.top_k, min_scores, args.max_score_gap, args.context_fraction):
+            config = RetrievalConfig(candidate_k=max(args.candidate_k, top_k), top_k=top_k,
+                                     min_score=min_score, max_score_gap=max_score_gap,
+                                     chunk_tokens=chunk_tokens, chunk_overlap_tokens=chunk_overlap_tokens,
+                                     context_fraction=context_fraction,
+                                     characters_per_token=characters_per_token)
+            result = evaluate(config, index, questions, query_vectors, count_tokens, args.completions)
+            results.append(result)
+            logging.info(json.dumps(result))
+
+    frontier = pareto_frontier(results)
+    recommended = recommend(frontier, args.recall_tolerance)
+    return {
+        "recommended": service_config(recommended["config"], embedder.model),
+        "recommended_metrics": {key: value for key, value in recommended.items() if key != "config"},
+        "frontier": frontier,
+        "results": results,
+        "questions": len(questions),
+        "embeddings": args.embeddings,
+        "embedding_model": embedder.model,
+        "completions": args.completions,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+
+
+def print_frontier(report: Dict[str, Any]) -> None:
+    header = (f"{'top_k':>5} {'min':>5} {'gap':>5} {'chunk':>6} {'overlap':>7} {'context':>7} "
+              f"{'recall@k':>8} {'ctx_recall':>10} {'no_ctx':>6} {'tokens':>8} {'p50_ms':>8}")
+    print(header)
+    for r in report["frontier"]:
+        c = r["config"]
+        marker = "  <- recommended" if service_config(c, report["embedding_model"]) == report["recommended"] else ""
+        print(f"{c['top_k']:>5} {c['min_score']:>5} {c['max_score_gap']:>5} {c['chunk_tokens']:>6} "
+              f"{c['chunk_overlap_tokens']:>7} {c['context_fraction']:>7} {r['recall_at_k']:>8} "
+              f"{r['context_recall']:>10} {r['no_context_rate']:>6} {r['prompt_tokens']:>8} "
+              f"{r['latency_ms']['p50']:>8}{marker}")
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dataset", required=True, help="Labelled questions, one JSON object per line")
+    parser.add_argument("--documents", required=True, help="Folder with the PDF, DOCX and PPTX files the questions refer to")
+    parser.add_argument("--candidate-k", type=int, default=RetrievalConfig().candidate_k,
+                        help="Matches fetched before the score cutoffs")
+    parser.add_argument("--top-k", type=lambda v: _grid(v, int), default=[3, 6, 10],
+                        help="Most matches kept after the score cutoffs")
+    parser.add_argument("--min-score", type=lambda v: _grid(v, float),
+                        help="Score cutoffs to try (default: 0.7,0.75,0.8 for ada-002, 0.2,0.3,0.4 for other models)")
+    parser.add_argument("--max-score-gap", type=lambda v: _grid(v, float), default=[0.05, 0.1, 0.2])
+    parser.add_argument("--chunk-tokens", type=lambda v: _grid(v, int), default=[128, 256, 512])
+    parser.add_argument("--chunk-overlap-tokens", type=lambda v: _grid(v, int), default=[0, 50])
+    parser.add_argument("--context-fraction", type=lambda v: _grid(v, float), default=[0.2, 0.3, 0.4])
+    parser.add_argument("--characters-per-token", type=float,
+                        help="Characters per token for the context budget (default: measured on the documents)")
+    parser.add_argument("--embeddings", choices=("openai", "fake"), default="openai",
+                        help="Embed with the configured OpenAI model (EMBEDDING_MODEL), or offline with a "
+                             "bag-of-words stand-in")
+    parser.add_argument("--completions", action="store_true",
+                        help="Also call the chat model, to include completion latency (costly)")
+    parser.add_argument("--recall-tolerance", type=float, default=0.02,
+                        help="Recall the recommendation may give up for fewer prompt tokens")
+    parser.add_argument("--output", help="Write the report and recommended config to this path")
+    parser.add_argument("--verbose", action="store_true")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None) -> Dict[str, Any]:
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    report = sweep(args)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2) + "\n")
+    print_frontier(report)
+    print(json.dumps({"recommended": report["recommended"], **report["recommended_metrics"]}, indent=2))
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
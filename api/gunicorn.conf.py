@@ -0,0 +1,23 @@
+# Read by gunicorn from the working directory; the command-line flags in the
+# Dockerfile still take precedence.
+import gc
+import os
+
+# Worker processes. Each one starts its own pool of PDF_PARSE_PROCESSES
+# processes for large PDFs, by default an equal share of the CPUs; the count
+# is exported so the workers can compute that share.
+workers = int(os.environ.get('WEB_CONCURRENCY', '4'))
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# PRELOAD_APP=1 imports the app (and, through it, the heavy parser and SDK
+# modules) once in the master before forking, so workers start immediately and
+# share those pages copy-on-write. Clients are still created per worker in the
+# app's lifespan, after the fork.
+preload_app = os.environ.get('PRELOAD_APP', '').lower() in ("1", "true", "yes")
+
+
+def when_ready(server):
+    if preload_app:
+        # Move everything loaded so far out of the collector's reach, so
+        # collections in the workers do not write to (and un-share) those pages
+        gc.freeze()
@@ -1,32 +1,84 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Body
-from fastapi.responses import RedirectResponse
+import time
+startup_started = time.perf_counter()
+
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Body, Depends, Header, Request
+from fastapi.responses import FileResponse, RedirectResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from app.s3_operations import upload_pdf, check_documents, initialize_s3_client, s3_object_exists, upload_file
+from fastapi.concurrency import run_in_threadpool
+from app.s3_operations import check_documents, s3_object_exists, upload_file
 from app.pdf_processing import process_pdf
+from app.pdf_pages import shutdown_page_pool
+from app.deadlines import CHAT_DEADLINE_SECONDS, DeadlineExceeded, deadline_scope, shutdown_hedge_executor
+from app.cache_warmer import (CACHE_WARM_BUDGET_USD, CACHE_WARM_TOP_N, notify_ingestion, start_cache_warmer,
+                               stop_cache_warmer, warm_cache)
+from app.query_cache import get_query_cache
 from app.pinecone_ops import generate_and_store_embeddings
-from app.chat import process_user_query, initialize_pinecone
+from app.embedding_index import (EMBEDDING_MODEL, configured_spec, parse_embedding_spec, start_index_watcher,
+                                 stop_index_watcher)
+from app.index_migration import MigrationRunning, activate_index, index_status, start_migration
+from app.chat import process_user_query
+from app.batch_chat import MAX_BATCH_QUERIES, answer_batch, collect_batch, prepare_batch
 from app.docx_processing import process_docx
 from app.pptx_processing import process_pptx
 from app.audio_processing import process_audio
-from app.utils import initialize_openai
-from typing import List, Dict, Union
+from app.utils import require_admin
+from app.dedup import link_known_file, record_ingested_file, get_file_index
+from app.profiling import ProfilingMiddleware, list_profiles, profile_path, profiled
+from app.traffic_capture import capture_file, capture_file_chunks, capture_request
+from app.metrics import MetricsMiddleware, INGESTED_DOCUMENTS, current_request, render_metrics, log_event, stage_timer
+from app.usage import document_scope, get_usage_store
+from app.singleflight import AsyncSingleFlight
+from app.clients import (close_clients, get_openai_client, get_s3_client, initialize_clients,
+                         preload_enabled, preload_modules, report_startup, startup_report)
+from app.retrieval_config import load_retrieval_config, score_thresholds
+from app.admission import (CHAT_POOL, INGESTION_POOL, AdmittedStreamingResponse, admission_report, admit_files,
+                           pool_for_file)
+from app.resumable_upload import (abort_upload, chunk_size_for, complete_upload, create_upload,
+                                  finish_upload, publish_upload, receive_chunk, upload_status)
+from contextlib import AsyncExitStack, asynccontextmanager
+from pydantic import BaseModel, Field
+from typing import List, Dict, Optional, Union
 import os
+import json
 import uuid
+import hashlib
 import logging
 import traceback
 
 
-# Initialize Pinecone
-initialize_pinecone()
-
-client = initialize_openai()
-if not client:
-    logging.error("Failed to initialize OpenAI client.")
-
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
-app = FastAPI()
+# With PRELOAD_APP (and gunicorn's preload), heavy modules are imported once in
+# the master and shared copy-on-write by the workers; otherwise on first use
+if preload_enabled():
+    preload_modules()
+startup_report["import_seconds"] = round(time.perf_counter() - startup_started, 4)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Load the retrieval config, create the OpenAI, S3 and Pinecone clients once per worker and close them on shutdown."""
+    started = time.perf_counter()
+    retrieval_config = load_retrieval_config()
+    if score_thresholds(EMBEDDING_MODEL, retrieval_config) is None:
+        # Migrating to the configured model will be refused until they are added
+        log_event("uncalibrated_scores", model=EMBEDDING_MODEL)
+    await run_in_threadpool(initialize_clients)
+    report_startup(retrieval_config=retrieval_config._asdict(),
+                   lifespan_seconds=round(time.perf_counter() - started, 4),
+                   ready_seconds=round(time.perf_counter() - startup_started, 4))
+    start_index_watcher()
+    start_cache_warmer()
+    yield
+    stop_cache_warmer()
+    stop_index_watcher()
+    close_clients()
+    shutdown_page_pool()
+    shutdown_hedge_executor()
+
+
+app = FastAPI(lifespan=lifespan)
 # Configuración de CORS
 
 origins = [
@@ -48,14 +100,15 @@ app.add_middleware(
     allow_headers=["*"],
 
 )
+# Added before MetricsMiddleware so it runs inside its request context
+app.add_middleware(ProfilingMiddleware)
+app.add_middleware(MetricsMiddleware)
+# Identical questions asked concurrently on this worker share one answer
+chat_flight = AsyncSingleFlight("chat")
+
 # Fetch bucket name from environment variables
 your_bucket_name = os.environ.get('YOUR_BUCKET_NAME')
 
-# Initialize the S3 client once
-s3 = initialize_s3_client()
-if not s3:
-    logging.error("Failed to initialize S3 client.")
-
 
 @app.get("/", tags=["Root"])
 def read_root() -> RedirectResponse:
@@ -70,78 +123,236 @@ async def check_docs() -> Dict[str, Union[str, bool]]:
     return {"status": "Success", "message": "Documents loaded." if current_status else "No documents loaded."}
 
 
-@app.post("/upload/", tags=["Documents"])
-async def upload_pdf_route(file: UploadFile = File(..., description="A PDF file to be uploaded", example="example.pdf")) -> Dict[str, Union[str, bool]]:
+@app.get("/metrics", tags=["Monitoring"], response_class=PlainTextResponse)
+def metrics() -> PlainTextResponse:
+    """Expose request, stage and ingestion metrics in the Prometheus text format."""
+    return PlainTextResponse(render_metrics(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/usage/", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def usage_report(group_by: str = Query("user", description="Aggregate per `user` or per `document`", pattern="^(user|document)$"),
+                 limit: int = Query(50, ge=1, le=1000)) -> Dict[str, Union[str, List[Dict[str, Union[str, int, float]]]]]:
     """
-    Upload a single PDF file, process it, and store its embeddings.
+    Report OpenAI token usage and estimated cost, aggregated per user or per document.
+
+    Requires the `X-Admin-Key` header to match `ADMIN_API_KEY`.
+    """
+    return {"group_by": group_by, "usage": get_usage_store().top(group_by, limit)}
+
+
+@app.get("/admin/admission/", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+async def admission_state() -> Dict[str, Dict[str, Union[int, float]]]:
+    """
+    Report the admission pools of the worker that serves the request.
+
+    **Returns**:
+    - Per pool (chat, ingestion, transcription): the concurrency limit, the
+      requests running and queued, and the current `Retry-After` estimate.
+    """
+    return admission_report()
+
+
+@app.get("/admin/cache/", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def cache_report(limit: int = Query(20, ge=1, le=1000)) -> Dict[str, object]:
+    """
+    Report the query cache and the most frequent recent queries.
+
+    Requires the `X-Admin-Key` header to match `ADMIN_API_KEY`.
+    """
+    cache = get_query_cache()
+    return {**cache.stats(),
+            "top_queries": [{"query": query, "frequency": round(frequency, 3), "cached": cache.is_fresh(query)}
+                            for query, frequency in cache.top_queries(limit)]}
+
+
+@app.post("/admin/cache/warm", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+async def warm_cache_route(top_n: int = Query(CACHE_WARM_TOP_N, ge=1, le=1000),
+                           budget_usd: float = Query(CACHE_WARM_BUDGET_USD, ge=0)) -> Dict[str, object]:
+    """
+    Run a cache warm cycle now: answer the most frequent recent queries that have no current cached answer.
 
     **Arguments**:
-    - `file`: A PDF file to be uploaded.
+    - `top_n`: The number of most frequent queries considered.
+    - `budget_usd`: The most estimated OpenAI spend of the cycle.
 
     **Returns**:
-    - A dictionary with the status, message, and filename.
+    - What the cycle did: queries warmed, already fresh, failed and left for lack of budget, and the spend.
+    """
+    return await INGESTION_POOL.run_sync(warm_cache, top_n, budget_usd)
+
+
+@app.get("/admin/index/", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def index_report() -> Dict[str, object]:
+    """
+    Report the active vector index and the embedding spec of its vectors, the
+    configured spec, and the indexes built or replaced by migrations with their progress.
+
+    Requires the `X-Admin-Key` header to match `ADMIN_API_KEY`.
+    """
+    return index_status()
+
+
+@app.post("/admin/index/migrate", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def migrate_index_route(model: Optional[str] = Query(None, description="The embedding model, by default EMBEDDING_MODEL"),
+                        dimensions: int = Query(0, ge=0, description="The vector length; 0 is the model's own"),
+                        force: bool = Query(False, description="Switch even if some chunks cannot be copied")) -> Dict[str, object]:
+    """
+    Start re-embedding the corpus into a new index, which replaces the active
+    one once it has every chunk. The active index serves meanwhile.
+
+    **Arguments**:
+    - `model`, `dimensions`: The embedding spec of the new index, by default the configured one.
+    - `force`: Also switch when chunks of the active index are missing from the dedup index.
+
+    **Returns**:
+    - The active index and the name of the new one; follow it in `GET /admin/index/`.
+    """
+    try:
+        spec = parse_embedding_spec(model or EMBEDDING_MODEL, dimensions) if model or dimensions else configured_spec()
+        return start_migration(spec, force)
+    except MigrationRunning as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+@app.post("/admin/index/activate/{name}", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def activate_index_route(name: str) -> Dict[str, object]:
+    """
+    Switch back to an index that a migration replaced. Chunks ingested since are not in it.
     """
-    logging.info("Starting upload process...")
-    unique_filename = file.filename
-    file_bytes = file.file.read()
     try:
-        # Use upload_pdf function instead of s3.put_object directly
-        upload_response = upload_pdf(file_bytes, unique_filename)
-        if upload_response['status'] != "Success":
-            return upload_response  # Return the error response directly if upload fails
+        return activate_index(name)
+    except KeyError:
+        raise HTTPException(status_code=404, detail=f"No replaced index {name}")
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
 
-        # Call process_pdf with all necessary arguments and capture the returned tuple
-        data, temp_pdf_path = process_pdf(
-            s3, your_bucket_name, unique_filename)
 
-        # For debugging
-        logging.info(f"Data type from process_pdf: {type(data)}, Data: {data}")
-        logging.info(f"Temp PDF path: {temp_pdf_path}")
+@app.get("/admin/startup/", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def startup_timings() -> Dict[str, object]:
+    """
+    Report how long this worker took to import the app, preload modules and create its clients.
+
+    Requires the `X-Admin-Key` header to match `ADMIN_API_KEY`.
+    """
+    return startup_report
+
+
+@app.get("/admin/profiles/", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def profiles_report() -> List[Dict[str, object]]:
+    """
+    List the summaries of the most recent request profiles.
+
+    A request is profiled when it is sent with the `X-Profile: 1` header (or
+    the `profile=1` query parameter) and the admin key; its profile id is
+    returned in the `X-Profile-Id` response header.
+
+    Requires the `X-Admin-Key` header to match `ADMIN_API_KEY`.
+    """
+    return list_profiles()
+
+
+@app.get("/admin/profiles/{profile_id}", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def profile_summary(profile_id: str) -> FileResponse:
+    """
+    Return the summary of a request profile: its duration, CPU samples, the
+    functions most often on CPU and the lines that allocated the most memory.
+
+    Requires the `X-Admin-Key` header to match `ADMIN_API_KEY`.
+    """
+    return FileResponse(profile_path(profile_id), media_type="application/json")
+
+
+@app.get("/admin/profiles/{profile_id}/{artifact}", tags=["Monitoring"], dependencies=[Depends(require_admin)])
+def profile_artifact(profile_id: str, artifact: str) -> FileResponse:
+    """
+    Download an artifact of a request profile, in the collapsed stack format
+    read by flamegraph.pl, inferno and speedscope.
+
+    **Arguments**:
+    - `artifact`: `cpu.folded` for the sampled stacks of the threads working
+      for the request, or `memory.folded` for the bytes it allocated and still
+      held at its end, by allocation traceback.
+
+    Requires the `X-Admin-Key` header to match `ADMIN_API_KEY`.
+    """
+    return FileResponse(profile_path(profile_id, artifact), media_type="text/plain",
+                        filename=f"{profile_id}.{artifact}")
+
+
+def ingest_file(file_bytes: bytes, unique_filename: str) -> Dict[str, Union[str, bool, int]]:
+    """
+    Upload a file to S3, extract its text and store its embeddings.
+
+    This is blocking work and is run in the threadpool by the upload routes.
 
-        # Call generate_and_store_embeddings instead of generate_embeddings and store_embeddings
-        generate_and_store_embeddings(data, temp_pdf_path)
+    **Arguments**:
+    - `file_bytes`: The content of the file.
+    - `unique_filename`: The S3 key of the file; its extension selects the parser.
 
+    **Returns**:
+    - A result dictionary with the filename, status and message.
+    """
+    sha256 = hashlib.sha256(file_bytes).hexdigest()
+    capture_file(unique_filename, sha256, len(file_bytes))
+    known = known_file_result(unique_filename, sha256, len(file_bytes))
+    if known is not None:
+        return known
+    file_extension = unique_filename.split(".")[-1].lower()
+    # Upload the file to S3
+    with stage_timer("s3_upload"):
+        upload_response = upload_file(
+            file_bytes, unique_filename)
+    if upload_response['status'] != "Success":
+        INGESTED_DOCUMENTS.inc(file_type=file_extension, status="failed")
         return {
-            "status": "Success",
-            "message": "File uploaded, processed, and embeddings stored successfully",
-            "filename": unique_filename
+            "filename": unique_filename,
+            "status": "Failed",
+            "message": upload_response['message'],
         }
-    except Exception as e:
-        # Added for debugging
-        logging.error(f"Error type: {type(e)}, Error: {e}")
-        return {"status": "Failed", "message": str(e)}
+    return process_stored_file(unique_filename, sha256, len(file_bytes))
 
 
-@app.post("/multipleupload/", tags=["Documents"])
-async def multiple_upload_route(files: List[UploadFile] = File(..., description="A list of files to be uploaded", examples=[{"filename": "example1.pdf"}, {"filename": "example2.docx"}])) -> Dict[str, List[Dict[str, Union[str, bool]]]]:
+def known_file_result(filename: str, sha256: str, size: int) -> Optional[Dict[str, Union[str, bool]]]:
     """
-    Upload multiple files, process them, and store their embeddings.
+    Return the result of a file whose content was already ingested, after
+    linking its document to the requesting user; None for new content.
+    """
+    context = current_request()
+    document = link_known_file(sha256, size, context.user if context is not None else None)
+    if document is None:
+        return None
+    log_event("upload_deduplicated", filename=filename, document=document, size=size)
+    return {
+        "filename": filename,
+        "status": "Success",
+        "message": f"The same content was already ingested as {document}",
+        "document": document,
+        "deduplicated": True,
+    }
+
+
+def process_stored_file(unique_filename: str, sha256: Optional[str] = None,
+                        size: Optional[int] = None) -> Dict[str, Union[str, bool, int]]:
+    """
+    Extract the text of a file already stored in S3 and store its embeddings.
 
     **Arguments**:
-    - `files`: A list of files to be uploaded. The supported file types are PDF, DOCX, PPTX, MP3, M4A.
+    - `unique_filename`: The S3 key of the file; its extension selects the parser.
+    - `sha256`, `size`: The digest and size of the file's content, recorded so
+      later uploads of the same content are not processed again.
 
     **Returns**:
-    - A dictionary with a list of result dictionaries, each containing the status, message, and filename.
+    - A result dictionary with the filename, status, message and the number of chunks stored,
+      skipped (duplicates within the document) and merged (duplicates of other documents).
     """
-    results = []
-    for file in files:
-        unique_filename = file.filename
-        file_bytes = file.file.read()
-        file_extension = unique_filename.split(".")[-1].lower()
-
-        try:
-            # Upload the file to S3
-            upload_response = upload_file(
-                file_bytes, unique_filename)
-            if upload_response['status'] != "Success":
-                results.append({
-                    "filename": unique_filename,
-                    "status": "Failed",
-                    "message": upload_response['message'],
-                })
-                continue  # Skip to the next file if the upload fails
-
-            # Process the file depending on its extension
+    file_extension = unique_filename.split(".")[-1].lower()
+    try:
+        # Process the file depending on its extension; OpenAI usage is
+        # attributed to the document
+        s3 = get_s3_client()
+        with document_scope(unique_filename):
             if file_extension == "pdf":
                 data, temp_path = process_pdf(
                     s3, your_bucket_name, unique_filename)
@@ -154,32 +365,224 @@ async def multiple_upload_route(files: List[UploadFile] = File(..., description=
             elif file_extension in ["mp3", "m4a"]:
                 # Assuming process_audio function exists and is imported
                 data, temp_path = process_audio(
-                    s3, your_bucket_name, unique_filename, client)
+                    s3, your_bucket_name, unique_filename, get_openai_client())
             else:
                 raise HTTPException(
                     status_code=400, detail=f"Unsupported file type: {file_extension}")
 
+            log_event("document_parsed", filename=unique_filename, parts=len(data),
+                      characters=sum(len(part.page_content) for part in data))
+
             # Generate and store embeddings
-            generate_and_store_embeddings(data, temp_path)
-
-            results.append({
-                "filename": unique_filename,
-                "status": "Success",
-                "message": "File uploaded, processed, and embeddings stored successfully",
-            })
-        except HTTPException as http_exception:
-            raise http_exception
-        except Exception as e:
-            logging.error(f"Error processing file {unique_filename}: {e}")
-            results.append({
-                "filename": unique_filename,
-                "status": "Failed",
-                "message": str(e),
-            })
+            stats = generate_and_store_embeddings(data, temp_path)
+        INGESTED_DOCUMENTS.inc(file_type=file_extension, status="success")
+        if sha256:
+            capture_file_chunks(sha256, stats["chunks"])
+        context = current_request()
+        record_ingested_file(unique_filename, sha256, size, context.user if context is not None else None)
+        notify_ingestion()
+
+        return {
+            "filename": unique_filename,
+            "status": "Success",
+            "message": "File uploaded, processed, and embeddings stored successfully",
+            "chunks_stored": stats["stored"],
+            "chunks_skipped": stats["skipped"],
+            "chunks_merged": stats["merged"],
+            "boilerplate_lines_removed": stats["boilerplate_lines"],
+        }
+    except HTTPException as http_exception:
+        raise http_exception
+    except Exception as e:
+        INGESTED_DOCUMENTS.inc(file_type=file_extension, status="failed")
+        logging.error(f"Error processing file {unique_filename}: {e}")
+        return {
+            "filename": unique_filename,
+            "status": "Failed",
+            "message": str(e),
+        }
+
+
+@app.post("/upload/", tags=["Documents"])
+async def upload_pdf_route(file: UploadFile = File(..., description="A PDF file to be uploaded", example="example.pdf")) -> Dict[str, Union[str, bool]]:
+    """
+    Upload a single PDF file, process it, and store its embeddings.
+
+    The file goes through the same pipeline as `/multipleupload/`; the
+    response keeps this endpoint's keys.
+
+    **Arguments**:
+    - `file`: A PDF file to be uploaded.
+
+    **Returns**:
+    - A dictionary with the status, message, and filename.
+    """
+    capture_request("upload")
+    async with admit_files([file.filename]):
+        file_bytes = await file.read()
+        log_event("upload_started", filename=file.filename, size=len(file_bytes))
+        result = await pool_for_file(file.filename).run_sync(ingest_file, file_bytes, file.filename)
+    if result.get("deduplicated"):
+        return result
+    return {key: result[key] for key in ("status", "message", "filename")}
+
+
+@app.post("/multipleupload/", tags=["Documents"])
+async def multiple_upload_route(files: List[UploadFile] = File(..., description="A list of files to be uploaded", examples=[{"filename": "example1.pdf"}, {"filename": "example2.docx"}])) -> Dict[str, List[Dict[str, Union[str, bool, int]]]]:
+    """
+    Upload multiple files, process them, and store their embeddings.
+
+    **Arguments**:
+    - `files`: A list of files to be uploaded. The supported file types are PDF, DOCX, PPTX, MP3, M4A.
+
+    **Returns**:
+    - A dictionary with a list of result dictionaries, each containing the status, message, and filename.
+    """
+    capture_request("multiple_upload")
+    results = []
+    async with admit_files(file.filename for file in files):
+        for file in files:
+            file_bytes = await file.read()
+            # Parsing and embedding block, so they run off the event loop, on
+            # threads of their own pool, to keep chat requests on this worker responsive
+            results.append(await pool_for_file(file.filename).run_sync(ingest_file, file_bytes, file.filename))
 
     return {"results": results}
 
 
+class FileDigest(BaseModel):
+    filename: str = Field(..., description="The name of the file")
+    sha256: str = Field(..., description="Hex SHA-256 digest of the file", pattern="^[0-9a-fA-F]{64}$")
+    size: int = Field(..., description="The size of the file in bytes", gt=0)
+
+
+@app.post("/uploads/check", tags=["Documents"])
+async def check_uploads_route(files: List[FileDigest] = Body(..., embed=True, description="The files about to be uploaded")) -> Dict[str, List[Dict[str, Union[str, int, bool, None]]]]:
+    """
+    Check files by content before uploading them.
+
+    Files whose content was already ingested, under any name, are linked to
+    the user in `X-User-Id` right away and need not be uploaded; only the
+    files reported as unknown have to be sent.
+
+    **Arguments**:
+    - `files`: The name, hex SHA-256 digest and size of every file.
+
+    **Returns**:
+    - A dictionary with the results in file order, each with the `filename`,
+      whether the file is `known` and, if it is, the `document` it was ingested as.
+    """
+    context = current_request()
+    user = context.user if context is not None else None
+
+    def check() -> List[Dict[str, Union[str, int, bool, None]]]:
+        results = []
+        for file in files:
+            document = link_known_file(file.sha256, file.size, user)
+            results.append({"filename": file.filename, "sha256": file.sha256.lower(), "size": file.size,
+                            "known": document is not None, "document": document})
+        return results
+
+    return {"results": await run_in_threadpool(check)}
+
+
+@app.get("/documents/", tags=["Documents"])
+async def user_documents_route(x_user_id: str = Header(..., description="The user whose documents are listed")) -> Dict[str, List[Dict[str, Union[str, float]]]]:
+    """
+    List the documents linked to a user: the ones they ingested and the
+    already ingested ones their uploads were matched to.
+
+    **Returns**:
+    - A dictionary with the documents and when they were linked, oldest first.
+    """
+    return {"documents": await run_in_threadpool(get_file_index().user_documents, x_user_id.strip())}
+
+
+@app.post("/uploads/", tags=["Documents"])
+async def create_upload_route(filename: str = Body(..., description="The name of the file"),
+                              size: int = Body(..., description="The size of the file in bytes", gt=0),
+                              chunk_size: Optional[int] = Body(None, description="Bytes per chunk (at least 5 MiB)")) -> Dict[str, Union[str, int]]:
+    """
+    Start a resumable upload.
+
+    Send the chunks with `PUT /uploads/{upload_id}/chunks/{index}`, check what
+    arrived with `GET /uploads/{upload_id}` and process the file with
+    `POST /uploads/{upload_id}/complete`.
+
+    **Returns**:
+    - The upload id, chunk size and number of chunks to send.
+    """
+    return await run_in_threadpool(create_upload, filename, size, chunk_size)
+
+
+@app.put("/uploads/{upload_id}/chunks/{index}", tags=["Documents"])
+async def upload_chunk_route(upload_id: str, index: int, request: Request,
+                             x_chunk_sha256: str = Header(..., description="Hex SHA-256 of the chunk")) -> Dict[str, Union[str, int]]:
+    """
+    Upload chunk `index` (starting at 0) of a resumable upload as the raw request body.
+
+    The chunk is checked against `X-Chunk-SHA256` and stored as a part of the
+    S3 multipart upload. Sending a chunk again replaces it.
+
+    **Returns**:
+    - The chunk index and size.
+    """
+    expected = await run_in_threadpool(chunk_size_for, upload_id, index)
+    body = bytearray()
+    async for data in request.stream():
+        body += data
+        if len(body) > expected:
+            raise HTTPException(status_code=413, detail=f"Chunk {index} must be {expected} bytes")
+    return await run_in_threadpool(receive_chunk, upload_id, index, bytes(body), x_chunk_sha256)
+
+
+@app.get("/uploads/{upload_id}", tags=["Documents"])
+async def upload_status_route(upload_id: str) -> Dict[str, Union[str, int, List[int], List[List[int]]]]:
+    """
+    Report the received chunks and byte ranges of a resumable upload, and the chunks still missing.
+    """
+    return await run_in_threadpool(upload_status, upload_id)
+
+
+@app.post("/uploads/{upload_id}/complete", tags=["Documents"])
+async def complete_upload_route(upload_id: str) -> Dict[str, Union[str, bool, int]]:
+    """
+    Assemble a resumable upload once every chunk arrived, then process the file and store its embeddings.
+
+    **Returns**:
+    - A result dictionary with the filename, status and message.
+    """
+    capture_request("resumable_upload")
+    filename = (await run_in_threadpool(upload_status, upload_id))["filename"]
+    async with admit_files([filename]):
+        unique_filename, sha256, size = await run_in_threadpool(complete_upload, upload_id)
+        capture_file(unique_filename, sha256, size)
+        result = None
+        try:
+            # A client that skipped `POST /uploads/check` still saves the processing
+            known = await run_in_threadpool(known_file_result, unique_filename, sha256, size)
+            if known is not None:
+                # The assembled object is deleted by finish_upload, and the
+                # document is already stored
+                result = known
+            else:
+                await run_in_threadpool(publish_upload, upload_id)
+                result = await pool_for_file(unique_filename).run_sync(
+                    process_stored_file, unique_filename, sha256, size)
+            return result
+        finally:
+            # A failed upload stays assembled, so completing it again retries the processing
+            await run_in_threadpool(finish_upload, upload_id,
+                                    result is not None and result.get("status") == "Success")
+
+
+@app.delete("/uploads/{upload_id}", tags=["Documents"])
+async def abort_upload_route(upload_id: str) -> Dict[str, str]:
+    """Abort an unfinished resumable upload."""
+    await run_in_threadpool(abort_upload, upload_id)
+    return {"status": "Success", "message": f"Upload {upload_id} aborted"}
+
+
 @app.post("/chat/", tags=["Chat"])
 async def chat_endpoint(query: str = Query(..., description="The user's text query", examples="What is a PDF file?")) -> Dict[str, str]:
     """
@@ -191,9 +594,63 @@ async def chat_endpoint(query: str = Query(..., description="The user's text que
     **Returns**:
     - A dictionary with a response string.
     """
+    capture_request("chat", query=query)
     try:
-        response = process_user_query(query)
+        # Requests that overlap an in-flight identical query share its result
+        # (or its error); answers are also cached until the next ingestion.
+        # Every stage is bounded by what is left of the request's deadline
+        with deadline_scope(CHAT_DEADLINE_SECONDS):
+            async with CHAT_POOL.admit():
+                response = await chat_flight.do(
+                    " ".join(query.split()), lambda: run_in_threadpool(profiled(process_user_query), query))
         return {"response": response}
+    except HTTPException:
+        raise
+    except DeadlineExceeded as e:
+        logging.error(f"Chat request timed out: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
+    except Exception as e:
+        logging.error(traceback.format_exc())  # Log the full traceback
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/chat/batch/", tags=["Chat"])
+async def chat_batch_endpoint(queries: List[str] = Body(..., embed=True, description="The user's text queries"),
+                              stream: bool = Query(False, description="Stream results as they complete")):
+    """
+    Answer many queries in one request.
+
+    The queries are embedded in batched requests, then searched and answered
+    concurrently with bounded concurrency. Identical queries are answered once.
+    A failed query is reported in its result without failing the batch.
+
+    **Arguments**:
+    - `queries`: The user's text queries, at most `CHAT_BATCH_MAX_QUERIES`.
+    - `stream`: Return newline-delimited JSON results as they complete instead of one list.
+
+    **Returns**:
+    - A dictionary with the results in query order, each with the `query` and
+      either a `response` or an `error`. Streamed results also carry the `index`
+      of their query.
+    """
+    capture_request("chat_batch", queries=queries, stream=stream)
+    if len(queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=422, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+    # Batches are background work: they share the ingestion pool, not chat's
+    admission = AsyncExitStack()
+    await admission.enter_async_context(INGESTION_POOL.admit())
+    try:
+        batch = await run_in_threadpool(prepare_batch, queries)
     except Exception as e:
-        print(traceback.format_exc())  # Print the full traceback
+        await admission.aclose()
+        logging.error(traceback.format_exc())  # Log the full traceback
         raise HTTPException(status_code=500, detail=str(e))
+
+    if stream:
+        # The slot is held until the last result is streamed
+        async def lines():
+            async for position, result in answer_batch(batch):
+                yield json.dumps(dict(result, index=position)) + "\n"
+        return AdmittedStreamingResponse(lines(), admission, media_type="application/x-ndjson")
+    async with admission:
+        return {"results": await collect_batch(batch)}
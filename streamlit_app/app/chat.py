@@ -1,30 +1,46 @@
 import logging
-import requests
 from typing import Optional
 import streamlit as st
+from app.utils import cache_answer, get_cached_answer, get_http_session
 
 # Initialize logging
 logging.basicConfig(level=logging.INFO)
 
 
-def chat_widget(api_url: str, user_input: Optional[str]) -> None:
+def chat_widget(api_url: str, user_input: Optional[str], user_id: Optional[str] = None) -> None:
     """
     A Streamlit widget for chatting through a specified API.
 
     Parameters:
     - api_url: str, The URL of the API endpoint where the chat request will be sent.
     - user_input: Optional[str], The user's question to the chatbot.
+    - user_id: Optional[str], The logged-in user, sent so the API can attribute usage.
+
+    Recent answers are reused for the rest of the browser session instead of
+    asking the API again.
 
     Raises:
     - Exception: Any exception raised during the chat request will be caught and logged.
     """
     try:
+        chat_response = get_cached_answer(user_input)
+        if chat_response is not None:
+            st.write(f"📘 **Respuesta**: {chat_response}")
+            return
+
         payload = {'query': user_input}
-        response = requests.post(f"{api_url}/chat/", params=payload)
+        headers = {'X-User-Id': user_id} if user_id else None
+        response = get_http_session().post(
+            f"{api_url}/chat/", params=payload, headers=headers)
 
         if response.status_code == 200:
             chat_response = response.json()['response']
+            cache_answer(user_input, chat_response)
             st.write(f"📘 **Respuesta**: {chat_response}")
+        elif response.status_code == 503:
+            # The API is at capacity and says when to come back
+            retry_after = response.headers.get('Retry-After', 'unos')
+            st.warning(f"El servidor está ocupado. Inténtelo de nuevo en {retry_after} segundos.")
         else:
             logging.error(
                 f"Failed to get chat response. Status code: {response.status_code}")
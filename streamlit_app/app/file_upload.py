@@ -1,33 +1,233 @@
+import hashlib
+import os
+import time
 import requests
 import logging
-from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+from app.utils import get_http_session
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+CONTENT_TYPES = {
+    "pdf": "application/pdf",
+    "docx": "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+    "pptx": "application/vnd.openxmlformats-officedocument.presentationml.presentation",
+    "mp3": "audio/mpeg",
+    "m4a": "audio/mpeg",
+}
 
-def send_files_to_api(files: List[Tuple[str, bytes, str]], api_url: str) -> int:
+# Chunks of one file sent at the same time, and attempts per chunk
+PARALLEL_CHUNKS = int(os.environ.get('UPLOAD_PARALLEL_CHUNKS', '4'))
+CHUNK_RETRIES = 5
+# Times the client re-reads the upload status and resends what is missing
+RESUME_ROUNDS = 3
+# Longest wait honoured from a busy API's Retry-After before completing an upload
+MAX_RETRY_AFTER_SECONDS = 30
+
+
+def content_type_for(filename: str) -> Optional[str]:
+    """
+    Return the content type to upload a file with, or None if the API does not support it.
+
+    Parameters:
+    - filename : str
+        The name of the file.
+    """
+    return CONTENT_TYPES.get(filename.split(".")[-1].lower())
+
+
+def _send_chunk(api_url: str, upload_id: str, index: int, view: memoryview, headers: Dict[str, str]) -> None:
+    # Copied only now, so at most PARALLEL_CHUNKS chunks are held at once
+    chunk = bytes(view)
+    headers = dict(headers, **{'X-Chunk-SHA256': hashlib.sha256(chunk).hexdigest()})
+    for attempt in range(CHUNK_RETRIES):
+        try:
+            response = get_http_session().put(
+                f"{api_url}/uploads/{upload_id}/chunks/{index}", data=chunk, headers=headers)
+            if response.status_code < 500:
+                response.raise_for_status()
+                return
+        except (requests.ConnectionError, requests.Timeout) as e:
+            logger.warning(f"Chunk {index} of upload {upload_id} failed: {e}")
+        if attempt < CHUNK_RETRIES - 1:
+            time.sleep(min(10.0, 0.5 * 2 ** attempt))
+    raise requests.ConnectionError(f"Chunk {index} of upload {upload_id} failed {CHUNK_RETRIES} times")
+
+
+def _missing_chunks(api_url: str, upload_id: str, size: int, headers: Dict[str, str]) -> Optional[Tuple[int, List[int]]]:
+    """
+    Chunk size and missing chunks of an upload of `size` bytes, or None if it cannot be resumed.
+
+    An `assembled` upload, whose processing failed, misses no chunk: completing
+    it again processes the file without sending it again.
+    """
+    response = get_http_session().get(f"{api_url}/uploads/{upload_id}", headers=headers)
+    if response.status_code != 200:
+        return None
+    status = response.json()
+    if status["size"] != size:
+        return None
+    if status["status"] == "assembled":
+        return status["chunk_size"], []
+    if status["status"] != "open":
+        return None
+    return status["chunk_size"], status["missing"]
+
+
+def check_files(files: List[Tuple[str, bytes, str]], api_url: str, headers: Dict[str, str]) -> Dict[str, str]:
+    """
+    Ask the API which files it already ingested, by content, before uploading them.
+
+    Parameters:
+    - files : List[Tuple[str, bytes, str]]
+        The files about to be uploaded, as (filename, content, content type).
+    - api_url : str
+        The URL of the API.
+    - headers : Dict[str, str]
+        Headers sent with the request; the API links known files to the user in them.
+
+    Returns:
+    - Dict[str, str]
+        The document each already ingested file was stored as, by filename;
+        empty if the API does not support the check.
+    """
+    digests = [{"filename": filename, "sha256": hashlib.sha256(data).hexdigest(), "size": len(data)}
+               for filename, data, _ in files if data]
+    if not digests:
+        return {}
+    response = get_http_session().post(f"{api_url}/uploads/check", json={"files": digests}, headers=headers)
+    # An API without the check: every file is uploaded
+    if response.status_code in (404, 405):
+        return {}
+    response.raise_for_status()
+    return {result["filename"]: result["document"] for result in response.json()["results"] if result["known"]}
+
+
+def upload_file_resumable(filename: str, data: bytes, api_url: str, headers: Dict[str, str],
+                          upload_ids: Dict[str, str]) -> Dict[str, str]:
     """
-    Sends files to the API for processing.
+    Upload one file in parallel chunks and have the API process it.
+
+    An upload interrupted by a dropped connection resumes where it stopped:
+    the id of every unfinished upload is kept in `upload_ids`, and only the
+    chunks the API has not received are sent again.
+
+    Parameters:
+    - filename : str
+        The name of the file.
+    - data : bytes
+        The content of the file.
+    - api_url : str
+        The URL of the API.
+    - headers : Dict[str, str]
+        Headers sent with every request.
+    - upload_ids : Dict[str, str]
+        Unfinished upload ids by file, kept by the caller between attempts.
+
+    Returns:
+    - Dict[str, str]
+        The result the API reported for the file.
+    """
+    key = f"{filename}:{len(data)}"
+    resumed = _missing_chunks(api_url, upload_ids[key], len(data), headers) if key in upload_ids else None
+    if resumed is None:
+        response = get_http_session().post(
+            f"{api_url}/uploads/", json={"filename": filename, "size": len(data)}, headers=headers)
+        response.raise_for_status()
+        session = response.json()
+        upload_ids[key] = session["upload_id"]
+        resumed = session["chunk_size"], list(range(session["total_chunks"]))
+    else:
+        logger.info(f"Resuming upload of {filename}: {len(resumed[1])} chunks missing")
+    upload_id = upload_ids[key]
+    chunk_size, missing = resumed
+    view = memoryview(data)
+
+    for _ in range(RESUME_ROUNDS):
+        if not missing:
+            break
+        with ThreadPoolExecutor(max_workers=PARALLEL_CHUNKS) as executor:
+            futures = [
+                executor.submit(_send_chunk, api_url, upload_id, index,
+                                view[index * chunk_size:(index + 1) * chunk_size], headers)
+                for index in missing
+            ]
+            errors = [future.exception() for future in futures if future.exception() is not None]
+        if errors:
+            logger.warning(f"{len(errors)} chunks of {filename} failed, checking what the API received")
+        resumed = _missing_chunks(api_url, upload_id, len(data), headers)
+        if resumed is None:
+            raise requests.ConnectionError(f"Upload {upload_id} of {filename} can no longer be resumed")
+        missing = resumed[1]
+    if missing:
+        raise requests.ConnectionError(f"{len(missing)} chunks of {filename} could not be uploaded")
+
+    for attempt in range(CHUNK_RETRIES):
+        response = get_http_session().post(f"{api_url}/uploads/{upload_id}/complete", headers=headers)
+        # 503: the API is processing as many files as it can; the chunks are
+        # kept, so wait as told and ask again
+        if response.status_code != 503 or attempt == CHUNK_RETRIES - 1:
+            break
+        retry_after = float(response.headers.get('Retry-After', '5'))
+        logger.info(f"API busy, completing {filename} again in {retry_after} seconds")
+        time.sleep(min(MAX_RETRY_AFTER_SECONDS, retry_after))
+    response.raise_for_status()
+    result = response.json()
+    # A file the API failed to process stays assembled, and the next attempt
+    # completes the same upload again
+    if result.get("status") != "Failed":
+        upload_ids.pop(key, None)
+    return result
+
+
+def send_files_to_api(files: List[Tuple[str, bytes, str]], api_url: str, user_id: Optional[str] = None,
+                      upload_ids: Optional[Dict[str, str]] = None) -> Tuple[Optional[int], List[Dict[str, str]]]:
+    """
+    Sends files to the API for processing, using resumable chunked uploads.
+
+    Files whose content the API already ingested, under any name, are not
+    uploaded again: they are checked by digest first and reported as processed.
 
     Parameters:
     - files : List[Tuple[str, bytes, str]]
-        List of files to be sent to the API.
+        List of files to be sent to the API, as (filename, content, content type).
     - api_url : str
         The URL of the API to which the files will be sent.
+    - user_id : Optional[str]
+        The logged-in user, sent so the API can attribute usage.
+    - upload_ids : Optional[Dict[str, str]]
+        Unfinished upload ids, kept between calls (e.g. in the session state)
+        so that a later call resumes them instead of starting over.
 
     Returns:
-    - int
-        HTTP status code received from the API.
+    - Tuple[Optional[int], List[Dict[str, str]]]
+        HTTP status code of the last failed request (200 if none failed, None
+        if the API could not be reached) and the per-file results.
     """
+    headers = {'X-User-Id': user_id} if user_id else {}
+    upload_ids = upload_ids if upload_ids is not None else {}
+    status_code: Optional[int] = 200
+    results = []
     try:
-        response = requests.post(f"{api_url}/multipleupload/", files=files)
-        response.raise_for_status()  # Raise HTTPError for bad responses
-        logger.info(
-            f"Successfully sent files to {api_url}. Status code: {response.status_code}")
-        return response.status_code
+        known = check_files(files, api_url, headers)
     except requests.RequestException as e:
-        # Handle exceptions related to the HTTP request
-        logger.error(f"An error occurred while sending files to API: {e}")
-        return None  # or you could re-raise the exception: raise e
+        logger.warning(f"Could not check which files the API already has, uploading all of them: {e}")
+        known = {}
+    for filename, data, _ in files:
+        if filename in known:
+            logger.info(f"{filename} was already ingested as {known[filename]}, not uploading it.")
+            results.append({"filename": filename, "status": "Success", "message": "Archivo ya procesado",
+                            "document": known[filename], "deduplicated": True})
+            continue
+        try:
+            results.append(upload_file_resumable(filename, data, api_url, headers, upload_ids))
+            logger.info(f"Successfully sent {filename} to {api_url}.")
+        except requests.RequestException as e:
+            # Handle exceptions related to the HTTP request
+            logger.error(f"An error occurred while sending {filename} to API: {e}")
+            status_code = e.response.status_code if e.response is not None else None
+            results.append({"filename": filename, "status": "Failed", "message": str(e)})
+    return status_code, results
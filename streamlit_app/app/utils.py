@@ -1,4 +1,14 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import requests
 import streamlit as st
+from requests.adapters import HTTPAdapter
+
+# Number of recent answers kept per browser session, and for how long
+ANSWER_CACHE_SIZE = 50
+ANSWER_CACHE_TTL_SECONDS = 600
 
 
 def initialize_session_state():
@@ -11,3 +21,63 @@ def initialize_session_state():
         st.session_state.files_processed = False
     if 'submit' not in st.session_state:
         st.session_state.submit = False
+
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """
+    Return the HTTP session shared by every rerun and browser session of this server.
+
+    The session keeps connections to the API open, so requests do not pay
+    for a new TCP/TLS handshake each time.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def _answer_cache() -> "OrderedDict[str, tuple]":
+    if 'answer_cache' not in st.session_state:
+        st.session_state.answer_cache = OrderedDict()
+    return st.session_state.answer_cache
+
+
+def _normalize_question(question: str) -> str:
+    return " ".join(question.split()).lower()
+
+
+def get_cached_answer(question: str) -> Optional[str]:
+    """
+    Return a recent answer to the same question in this browser session, if any.
+
+    Parameters:
+    - question: str, The user's question.
+    """
+    cache = _answer_cache()
+    key = _normalize_question(question)
+    entry = cache.get(key)
+    if entry is None:
+        return None
+    answer, stored_at = entry
+    if time.monotonic() - stored_at > ANSWER_CACHE_TTL_SECONDS:
+        del cache[key]
+        return None
+    cache.move_to_end(key)
+    return answer
+
+
+def cache_answer(question: str, answer: str) -> None:
+    """Remember the answer to `question` for this browser session."""
+    cache = _answer_cache()
+    key = _normalize_question(question)
+    cache[key] = (answer, time.monotonic())
+    cache.move_to_end(key)
+    while len(cache) > ANSWER_CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+def clear_answer_cache() -> None:
+    """Forget the cached answers, e.g. once new documents change what the API knows."""
+    _answer_cache().clear()
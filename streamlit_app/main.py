@@ -1,9 +1,9 @@
 import logging
 import streamlit as st
 import requests
-from app.file_upload import send_files_to_api
+from app.file_upload import content_type_for, send_files_to_api
 from app.chat import chat_widget
-from app.utils import initialize_session_state
+from app.utils import clear_answer_cache, initialize_session_state
 from app.authentication import initialize_firebase, login_user
 import os
 from dotenv import load_dotenv
@@ -61,49 +61,67 @@ def handle_file_upload(api_url: str) -> None:
         )
 
         if uploaded_files:
-            with st.spinner('Procesando archivos...'):
-                files_to_send = []
-
-                # Preparar los archivos para enviar
-                for file in uploaded_files:
-                    file_extension = file.name.split(".")[-1].lower()
-                    content_type = ""
-
-                    # Determinar el tipo de contenido según la extensión
-                    if file_extension == "pdf":
-                        content_type = "application/pdf"
-                    elif file_extension == "docx":
-                        content_type = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
-                    elif file_extension == "pptx":
-                        content_type = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
-                    elif file_extension in ["mp3", "m4a"]:
-                        content_type = "audio/mpeg"
-                    else:
+            # Payloads are built once per selected file and kept across reruns;
+            # files that were already processed are not sent again
+            payloads = st.session_state.setdefault('upload_payloads', {})
+            document_status = st.session_state.setdefault('document_status', {})
+            pending = []
+            for file in uploaded_files:
+                file_key = getattr(file, 'file_id', None) or f"{file.name}:{file.size}"
+                if file_key in document_status:
+                    continue
+                if file_key not in payloads:
+                    content_type = content_type_for(file.name)
+                    if content_type is None:
                         st.warning(
                             f"Archivo no compatible: {file.name}. Se omitirá.")
+                        document_status[file_key] = "Unsupported"
                         continue  # Omitir archivos no compatibles
-
-                    files_to_send.append(
-                        ("files", (file.name, file.read(), content_type)))
-
-                try:
-                    # Enviar los archivos a tu API para procesarlos
-                    status_code = send_files_to_api(files_to_send, api_url)
-
-                    if status_code == 200:
+                    payloads[file_key] = (file.name, file.getvalue(), content_type)
+                pending.append(file_key)
+
+            if pending:
+                with st.spinner('Procesando archivos...'):
+                    try:
+                        # Enviar los archivos a tu API para procesarlos
+                        # Unfinished uploads are resumed from the chunks the API already has
+                        status_code, results = send_files_to_api(
+                            [payloads[file_key] for file_key in pending], api_url,
+                            st.session_state.get('user_email'),
+                            st.session_state.setdefault('upload_sessions', {}))
+                    except requests.exceptions.ConnectionError as e:
+                        status_code, results = None, []
+                        logging.error(f"Error de conexión: {e}")
+
+                    # Every attempt is final for the files it sent, so a rerun
+                    # (e.g. asking a question) never uploads them again
+                    statuses = {result.get('filename'): result.get('status') for result in results}
+                    for file_key in pending:
+                        filename = payloads.pop(file_key)[0]
+                        document_status[file_key] = statuses.get(filename, "Failed")
+                    failed = [file_key for file_key in pending
+                              if document_status[file_key] != "Success"]
+                    if len(failed) < len(pending):
+                        # New documents can change the answer to a question asked before
+                        clear_answer_cache()
+
+                    if status_code == 200 and not failed:
                         st.success(
                             "Los archivos se han cargado y procesado con éxito.")
                         logging.info("Files successfully processed.")
                         st.session_state.files_uploaded = True  # Actualizar el estado de la sesión
+                    elif status_code == 200:
+                        st.error(
+                            f"No se pudieron procesar {len(failed)} archivo(s). Quítelos y vuelva a subirlos para reanudar la carga.")
+                        logging.error(f"{len(failed)} files failed to process.")
+                    elif status_code is None:
+                        st.error(
+                            "Error en la conexión con el servidor. Intente de nuevo más tarde.")
                     else:
                         st.error(
                             f"Ocurrió un error al procesar los archivos. Código de estado: {status_code}")
                         logging.error(
                             f"Error en el procesamiento de archivos. Código de estado: {status_code}")
-                except requests.exceptions.ConnectionError as e:
-                    st.error(
-                        "Error en la conexión con el servidor. Intente de nuevo más tarde.")
-                    logging.error(f"Error de conexión: {e}")
 
 
 def handle_chat(api_url: str) -> None:
@@ -120,7 +138,8 @@ def handle_chat(api_url: str) -> None:
     if st.button('Enviar pregunta'):
         if user_input:
             with st.spinner('Procesando pregunta...'):
-                chat_widget(api_url, user_input)
+                chat_widget(api_url, user_input,
+                            st.session_state.get('user_email'))
 
 
 def main() -> None: